@@ -0,0 +1,21 @@
+# Amenities the search page can filter on. Listings are tagged with the terms that
+# appear in their free-text amenities column so filters hit a GIN index instead of LIKE scans.
+AMENITY_VOCABULARY = ['Kitchen', 'Iron', 'Wifi', 'Parking','Gym','Pool','Washer','Dryer','Heating','Air conditioning','TV','Cable TV','Elevator','Family/kid friendly','Smoke detector','Carbon monoxide detector','First aid kit','Fire extinguisher','Essentials','Shampoo','Hangers','Hair dryer','Laptop friendly workspace','Private entrance','Hot water']
+
+def amenity_tags(amenities):
+    """ Returns the vocabulary terms contained in a raw amenities string (same matching as LIKE '%term%') """
+    if not amenities:
+        return []
+    return [term for term in AMENITY_VOCABULARY if term in amenities]
+
+def setup_amenity_index(cursor, city_schema):
+    """ Adds the amenity_tags column and its GIN index to a listings table and tags rows that predate it """
+    cursor.execute(f"""
+        ALTER TABLE {city_schema}.listings ADD COLUMN IF NOT EXISTS amenity_tags TEXT[];
+        CREATE INDEX IF NOT EXISTS listings_amenity_tags_idx ON {city_schema}.listings USING GIN (amenity_tags);
+    """)
+    cursor.execute(f"""
+        UPDATE {city_schema}.listings
+        SET amenity_tags = ARRAY(SELECT term FROM unnest(%s::text[]) AS term WHERE amenities LIKE '%%' || term || '%%')
+        WHERE amenity_tags IS NULL
+    """, (AMENITY_VOCABULARY,))
@@ -1,9 +1,12 @@
 import json
 import uuid
-from flask import Flask, jsonify, request
+import base64
+import math
+from flask import Flask, jsonify, request, g, has_app_context, Response, stream_with_context
 from flask_cors import CORS
 from flask_login import LoginManager, UserMixin, login_user, current_user
 from psycopg2 import sql
+from psycopg2.extras import execute_values
 import psycopg2
 import csv
 import io
@@ -11,8 +14,26 @@ import random
 import string
 from tempfile import SpooledTemporaryFile
 import random
+import threading
+import time
+import logging
+import heapq
+import itertools
+from concurrent.futures import ThreadPoolExecutor, wait
+from db_pool import PoolManager
+from search_cache import SearchCache
+from amenities import amenity_tags, setup_amenity_index
+from migrations import migrate_city_schema, parse_listing_id, setup_database_extensions
+from review_stats import record_added_reviews, recompute_review_stats
+from facets import facet_statement, facet_counts, record_listing_facets
+from moderation import DELETE_REVIEWS, UPDATE_REVIEWS, REMOVE_LISTING_REVIEWS, remove_listing_reviews_query, moderation_summary
+from search_query import (LISTING_COLUMNS, SEARCH_SORT_ORDERS, search_columns, parse_limit, parse_search_filters,
+                          search_statement, count_statement, listings_by_id_statement, execute_prepared)
+from listing_index import INDEX_COLUMNS, ListingIndexes
+from metrics import TimedCursor, TimedJSONProvider, request_metrics, request_phase, begin_request, end_request
 
 app = Flask(__name__)
+app.json = TimedJSONProvider(app)
 app.config['SECRET_KEY'] = 'your_secret_key'  # Replace with your secret key
 
 CORS(app)
@@ -21,36 +42,193 @@ login_manager = LoginManager(app)
 
 login_manager.init_app(app)
 
+# Database connection parameters shared by every pool
+DB_CONFIG = {'user': 'postgres', 'password': 'toor', 'host': 'localhost'}
+
+# Connection pool sizing, one pool per shard database
+POOL_MIN_SIZE = 1
+POOL_MAX_SIZE = 10
+POOL_IDLE_TIMEOUT = 300  # seconds before an idle connection above POOL_MIN_SIZE is closed
+POOL_HEALTH_CHECK_INTERVAL = 30  # seconds of idleness after which a connection is pinged before reuse
+
+db_pools = PoolManager(minconn=POOL_MIN_SIZE, maxconn=POOL_MAX_SIZE, idle_timeout=POOL_IDLE_TIMEOUT,
+                       health_check_interval=POOL_HEALTH_CHECK_INTERVAL, cursor_factory=TimedCursor, **DB_CONFIG)
+
+def checkout_connection(db_name):
+    """ Checks out a pooled connection; inside a request it is returned automatically on teardown """
+    with request_phase('connection'):
+        conn = db_pools.getconn(db_name)
+    if has_app_context():
+        g.setdefault('db_connections', []).append(conn)
+    return conn
+
+def release_connection(conn):
+    """ Returns a connection to its pool before the request ends """
+    if has_app_context() and conn in g.get('db_connections', []):
+        g.db_connections.remove(conn)
+    db_pools.putconn(conn)
+
+def detach_connection(conn):
+    """ Takes a connection out of request teardown so a streaming response can return it when it finishes """
+    if has_app_context() and conn in g.get('db_connections', []):
+        g.db_connections.remove(conn)
+    return conn
+
+@app.teardown_appcontext
+def return_db_connections(exception):
+    for conn in g.pop('db_connections', []):
+        db_pools.putconn(conn)
+
+@app.before_request
+def start_request_timing():
+    begin_request()
+
+@app.after_request
+def record_request_timing(response):
+    end_request(request.url_rule.rule if request.url_rule else 'unmatched', request.method, response.status_code)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(request_metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/poolStats', methods=['GET'])
+def pool_stats():
+    db_pools.evict_idle()
+    return jsonify(db_pools.stats())
+
 def get_db_connection(database_name):
     """ Retrieves a database connection based on the city name and checks for overflows """
     base_db_name = database_name
     if(database_name == "cities"):
         db_name = "cities"
-    elif get_schema_count(base_db_name) >= 4:
-        db_name = check_and_create_overflow_db(base_db_name)
     else:
-        db_name = base_db_name
+        db_name = shard_placement.place(base_db_name)
     
-    conn = psycopg2.connect(database=db_name, user="postgres", password="toor", host="localhost")
-    return conn
+    return checkout_connection(db_name)
+
+def city_schema_name(city):
+    """ Maps a city name to its schema name, e.g. 'Los Angeles' -> 'los_angeles' """
+    return city.lower().replace(' ', '_').replace('-', '_')
+
+# How long the in-memory copy of city_info is trusted before it is reloaded
+ROUTING_CACHE_TTL = 300
+# Minimum gap between reloads triggered by lookups of unknown cities
+ROUTING_MISS_RELOAD_INTERVAL = 5
+
+class CityRouter:
+    """ In-memory copy of city_info mapping city_name -> (db_name, schema name) """
+
+    def __init__(self, ttl=ROUTING_CACHE_TTL, miss_reload_interval=ROUTING_MISS_RELOAD_INTERVAL):
+        self.ttl = ttl
+        self.miss_reload_interval = miss_reload_interval
+        self.routes = {}
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """ Reloads every route from the cities database; returns the routes and their load time """
+        conn = checkout_connection("cities")
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT city_name, db_name FROM city_info")
+                rows = cursor.fetchall()
+        finally:
+            release_connection(conn)
+        routes = {city_name: (db_name, city_schema_name(city_name)) for city_name, db_name in rows}
+        loaded_at = time.monotonic()
+        with self.lock:
+            self.routes = routes
+            self.loaded_at = loaded_at
+        return routes, loaded_at
+
+    def invalidate(self):
+        """ Forces the next lookup to reload city_info """
+        with self.lock:
+            self.loaded_at = None
+
+    def _ensure_fresh(self):
+        """ The current routes and their load time, reloading them first if stale """
+        # Read together, since invalidate() may reset loaded_at at any time
+        with self.lock:
+            routes, loaded_at = self.routes, self.loaded_at
+        if loaded_at is None or time.monotonic() - loaded_at > self.ttl:
+            return self.load()
+        return routes, loaded_at
+
+    def lookup(self, city_name):
+        """ Returns (db_name, schema) for a city, or None if it is not registered """
+        routes, loaded_at = self._ensure_fresh()
+        route = routes.get(city_name)
+        if route is None and time.monotonic() - loaded_at > self.miss_reload_interval:
+            # The city may have been added by another worker since our last load
+            routes, _ = self.load()
+            route = routes.get(city_name)
+        return route
+
+    def city_names(self):
+        routes, _ = self._ensure_fresh()
+        return list(routes)
+
+city_router = CityRouter()
+
+# Number of city schemas a shard database holds before new cities spill into <letter>_overflow
+SHARD_SCHEMA_CAPACITY = 4
+
+class ShardPlacement:
+    """ Tracks the city schemas in each shard database so placing a new city needs no query """
+
+    def __init__(self, capacity=SHARD_SCHEMA_CAPACITY):
+        self.capacity = capacity
+        self.schemas = {}  # db_name -> set of schema names
+        self.lock = threading.Lock()
+
+    def seed(self, db_names):
+        """ Loads schema names for the given shard databases """
+        for db_name in db_names:
+            self._schemas_for(db_name)
+
+    def _schemas_for(self, db_name):
+        schemas = self.schemas.get(db_name)
+        if schemas is None:
+            # First time we see this database: ask Postgres once, then track it in memory
+            schemas = set(get_schema_names(db_name)) if database_exists(db_name) else set()
+            with self.lock:
+                schemas = self.schemas.setdefault(db_name, schemas)
+        return schemas
+
+    def schema_count(self, db_name):
+        return len(self._schemas_for(db_name))
+
+    def record_database(self, db_name):
+        """ Registers a freshly created, empty database """
+        with self.lock:
+            self.schemas.setdefault(db_name, set())
+
+    def record_schema(self, db_name, schema_name):
+        schemas = self._schemas_for(db_name)
+        with self.lock:
+            schemas.add(schema_name)
+
+    def place(self, base_db_name):
+        """ Picks the database a new city schema should go into """
+        if self.schema_count(base_db_name) >= self.capacity:
+            return check_and_create_overflow_db(base_db_name)
+        return base_db_name
+
+    def stats(self):
+        with self.lock:
+            return {db_name: len(schemas) for db_name, schemas in self.schemas.items()}
+
+shard_placement = ShardPlacement()
 
 def find_db_connection_from_city(city_name):
-    """ Retrieves a database connection based on the city name by checking the cities database for the corresponding database entry """
-    conn = psycopg2.connect(database="cities", user="postgres", password="toor", host="localhost")
-    cursor = conn.cursor()
-    try:
-        # Assuming there's a table 'city_info' with columns 'city_name' and 'db_name'
-        cursor.execute("SELECT db_name FROM city_info WHERE city_name = %s", (city_name,))
-        result = cursor.fetchone()
-        print(city_name, result)
-        if result:
-            db_name = result[0]
-            return psycopg2.connect(database=db_name, user="postgres", password="toor", host="localhost")
-        else:
-            raise Exception(f"No database entry found for city: {city_name}")
-    finally:
-        cursor.close()
-        conn.close()
+    """ Retrieves a database connection based on the city name using the cached city_info routing table """
+    with request_phase('routing'):
+        route = city_router.lookup(city_name)
+    if route is None:
+        raise Exception(f"No database entry found for city: {city_name}")
+    return checkout_connection(route[0])
 
 # A simple user model (you may need to replace this with your database model)
 class User(UserMixin):
@@ -101,118 +279,505 @@ def register():
 
     return jsonify({'success': True, 'message': 'Registered successfully!', 'name': fullname}), 201
 
+def search_across_cities(data, cities):
+    """ Runs the search on every requested city concurrently and merges the per-city top-k lists """
+    try:
+        filters = parse_search_filters(data)
+        columns, limit, order_by, sort_key, merge_only = cross_city_search_options(data)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    cities = cities or city_router.city_names()
+
+    failed = {}
+    futures = {}
+    for city in cities:
+        route = city_router.lookup(city)
+        if route is None:
+            failed[city] = f"No database entry found for city: {city}"
+            continue
+        db_name, city_schema = route
+        statement = search_statement(city_schema, filters, columns, order_by=order_by, limit=limit)
+        futures[search_executor.submit(search_shard, db_name, statement)] = city
+
+    with request_phase('query'):
+        done, not_done = wait(futures, timeout=SEARCH_SHARD_TIMEOUT)
+    per_city = []
+    for future in done:
+        city = futures[future]
+        try:
+            per_city.append(search_rows_to_dicts(future.result(), columns, city))
+        except Exception as e:
+            failed[city] = str(e)
+    for future in not_done:
+        future.cancel()
+        failed[futures[future]] = f"Timed out after {SEARCH_SHARD_TIMEOUT}s"
+    # Partial results must not be cached
+    g.search_partial = bool(failed)
+    return jsonify(merge_city_results(per_city, sort_key, limit, cities, failed, merge_only))
+
+def cross_city_search_options(data):
+    """ Validates sort, fields and limit of a cross-city search
+
+    Returns (columns, limit, ORDER BY clause, merge key, merge-only columns): the merge key may need a column
+    the caller did not ask for, which is selected but left out of the response.
+    """
+    sort = data.get('sort', 'price')
+    if sort not in SEARCH_SORT_ORDERS:
+        raise ValueError(f"sort must be one of {', '.join(SEARCH_SORT_ORDERS)}")
+    columns = search_columns(data.get('fields'))
+    merge_only = []
+    if sort == 'rating' and 'review_scores_rating' not in columns:
+        columns.append('review_scores_rating')
+        merge_only.append('review_scores_rating')
+    limit = parse_limit(data, SEARCH_MAX_PAGE_SIZE, default=SEARCH_MAX_PAGE_SIZE)
+    order_by, sort_key = SEARCH_SORT_ORDERS[sort]
+    return columns, limit, order_by, sort_key, merge_only
+
+def merge_city_results(per_city, sort_key, limit, cities, failed, merge_only=()):
+    # Each city's rows are already sorted, so a heap merge yields the global top-k
+    results = list(itertools.islice(heapq.merge(*per_city, key=sort_key), limit))
+    for row in results:
+        for column in merge_only:
+            del row[column]
+    return {
+        'results': results,
+        'cities': cities,
+        'failed': failed,
+        'partial': bool(failed),
+    }
+
+def search_shard(db_name, statement):
+    """ Runs one city's part of a cross-city search on a pooled connection (called from search_executor threads) """
+    conn = db_pools.getconn(db_name, timeout=SEARCH_SHARD_TIMEOUT)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SET LOCAL statement_timeout = %s", (int(SEARCH_SHARD_TIMEOUT * 1000),))
+            execute_prepared(cursor, statement)
+            return cursor.fetchall()
+    finally:
+        db_pools.putconn(conn)
+
+# Threads shared by all cross-city searches, and how long each city may take before it is left out
+SEARCH_FANOUT_WORKERS = 16
+SEARCH_SHARD_TIMEOUT = 2.0
+search_executor = ThreadPoolExecutor(max_workers=SEARCH_FANOUT_WORKERS)
+
+# Cached /search responses: total size cap and how long an entry may be served
+SEARCH_CACHE_MAX_BYTES = 64 * 1024 * 1024
+SEARCH_CACHE_TTL = 60
+search_cache = SearchCache(max_bytes=SEARCH_CACHE_MAX_BYTES, ttl=SEARCH_CACHE_TTL)
+
+def invalidate_search_cache(city):
+    """ Called by write endpoints so cached searches never outlive the data they were built from """
+    search_cache.invalidate_city(city_schema_name(city))
+
+def search_cache_params(query_params):
+    """ Normalizes the query string: amenities are order-insensitive
+
+    Cities stay as requested since routing matches the exact name; make_key adds their schemas' generations.
+    """
+    params = []
+    for key in sorted(query_params.keys()):
+        values = query_params.getlist(key)
+        if key == 'amenities':
+            values = sorted(values)
+        params.append((key, tuple(values)))
+    return tuple(params)
+
+@app.route('/cacheStats', methods=['GET'])
+def cache_stats():
+    return jsonify(search_cache.stats())
+
+# Hot cities (as named in city_info) whose listings are also kept in memory as NumPy arrays, so /search and
+# /facets filters run as vectorized masks; empty to serve every city from Postgres
+LISTING_INDEX_CITIES = []
+# Seconds before an in-memory index is reloaded, picking up bulk loads done by createDBs
+LISTING_INDEX_TTL = 600
+
+def load_listing_index_rows(city_name):
+    route = city_router.lookup(city_name)
+    if route is None:
+        raise Exception(f"No database entry found for city: {city_name}")
+    db_name, city_schema = route
+    conn = checkout_connection(db_name)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT {', '.join(INDEX_COLUMNS)} FROM {city_schema}.listings")
+            return cursor.fetchall()
+    finally:
+        release_connection(conn)
+
+listing_indexes = ListingIndexes(LISTING_INDEX_CITIES, load_listing_index_rows, ttl=LISTING_INDEX_TTL)
+
+@app.route('/listingIndexStats', methods=['GET'])
+def listing_index_stats():
+    return jsonify(listing_indexes.stats())
+
+def add_to_listing_index(city_name, conn, listing_id):
+    """ Applies a listing inserted through /insert to the city's in-memory index, if it has one """
+    if listing_indexes.get(city_name) is None:
+        return
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT {', '.join(INDEX_COLUMNS)} FROM {city_schema_name(city_name)}.listings WHERE id = %s", (listing_id,))
+        row = cursor.fetchone()
+    if row is not None:
+        listing_indexes.add_listing(city_name, row)
+
 @app.route('/search', methods=['GET'])
 def search_listing():
     query_params = request.args
 
     data = {key: query_params.getlist(key) if len(query_params.getlist(key)) > 1 else query_params[key] for key in query_params}
 
-    print(data)
-    city = data.get('city').lower().replace(' ', '_').replace('-', '_')
+    if is_truthy(data.get('stream')):
+        return run_search(data, query_params)
 
-    amenities_list = ['Kitchen', 'Iron', 'Wifi', 'Parking','Gym','Pool','Washer','Dryer','Heating','Air conditioning','TV','Cable TV','Elevator','Family/kid friendly','Smoke detector','Carbon monoxide detector','First aid kit','Fire extinguisher','Essentials','Shampoo','Hangers','Hair dryer','Laptop friendly workspace','Private entrance','Hot water']
+    cities = [city_schema_name(city) for city in (query_params.getlist('city') or city_router.city_names())]
+    cache_key = search_cache.make_key(search_cache_params(query_params), cities)
+    body = search_cache.get(cache_key)
+    if body is not None:
+        return Response(body, mimetype='application/json')
 
-    sql = f"SELECT * FROM {city}.listings WHERE price >= {data['priceMin']} AND price <= {data['priceMax']} and name like '%{data['name']}%'"
+    response = run_search(data, query_params)
+    if isinstance(response, Response) and response.status_code == 200 and not g.get('search_partial'):
+        search_cache.put(cache_key, response.get_data())
+    return response
 
-    if data['bedrooms'] != '' and data['bedrooms'] != 'null':
-        sql += f" AND beds = {data['bedrooms']}"
+@app.route('/facets', methods=['GET'])
+def search_facets():
+    """ Property type, neighbourhood, amenity and price-bucket counts of the listings matching the /search filters in one city """
+    query_params = request.args
+    data = {key: query_params.getlist(key) if len(query_params.getlist(key)) > 1 else query_params[key] for key in query_params}
+    if len(query_params.getlist('city')) != 1:
+        return jsonify({'success': False, 'message': "city is required"}), 400
 
-    if data['people'] != '' and data['people'] != 'null':
-        sql += f" AND accommodates = {data['people']}"
+    try:
+        filters = parse_search_filters(data, require_price=False)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
 
-    if data['rating'] != '' and data['rating'] != 'null':
-        sql += f" AND review_scores_rating >= {data['rating']}"
+    index = listing_indexes.get(data['city'])
+    if index is not None and index.supports(filters):
+        with request_phase('index'):
+            return jsonify(index.facets(filters))
 
-    if 'amenities' in data and data['amenities'] != '' and data['amenities'] != 'null':
-        if(isinstance(data['amenities'], str)):
-            print(data['amenities'])
-            sql+= f" AND amenities LIKE '%{data['amenities']}%' "
-        else:
-            # Iterate over each element in the amenities list
-            for element in data['amenities']:
-                # Add the LIKE condition for the current element to the SQL query
-                sql += f" AND amenities LIKE '%{element}%' "
+    statement, source = facet_statement(city_schema_name(data['city']), filters)
+    conn = find_db_connection_from_city(data['city'])
+    cursor = conn.cursor()
+    execute_prepared(cursor, statement)
+    return jsonify(facet_counts(cursor.fetchall(), source))
+
+def run_search(data, query_params):
+    if len(query_params.getlist('city')) != 1:
+        # Several cities, or none for all of them
+        return search_across_cities(data, query_params.getlist('city'))
+
+    city = data.get('city').lower().replace(' ', '_').replace('-', '_')
+
+    try:
+        filters = parse_search_filters(data)
+        columns, limit, after = single_city_search_options(data)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    if limit is None and is_truthy(data.get('stream')):
+        # Named cursors cannot EXECUTE a prepared statement, so the stream binds the parameters inline
+        sql, params = search_statement(city, filters, columns).inline_sql()
+        conn = detach_connection(find_db_connection_from_city(data.get('city')))
+        return stream_json_rows(conn, sql, params, lambda row: search_row_to_dict(row, columns, data['city']))
+
+    index = listing_indexes.get(data['city'])
+    if index is not None and index.supports(filters):
+        return search_listing_index(index, city, filters, columns, limit, after, data['city'])
 
-    print(sql)
     conn = find_db_connection_from_city(data.get('city'))
     cursor = conn.cursor() 
-    cursor.execute(sql)
-    rows = cursor.fetchall()
-
-    # Transform the result into a list of dictionaries
-    res = []
-    columns = ['id', 'name', 'neighbourhood_cleansed', 'property_type', 'accommodates', 'bathrooms_text', 'beds', 'amenities', 'price', 'review_scores_rating']
-    for row in rows:
-        row_dict = {columns[i]: row[i] for i in range(len(columns))}
-        row_dict['city'] = data['city']  # Add the city to each row's dictionary
-        res.append(row_dict)
 
-    return jsonify(res)
+    if limit is None:
+        # Unpaginated: every match, as a plain list
+        execute_prepared(cursor, search_statement(city, filters, columns))
+        return jsonify(search_rows_to_dicts(cursor.fetchall(), columns, data['city']))
+
+    execute_prepared(cursor, count_statement(city, filters))
+    total = cursor.fetchone()[0]
+
+    execute_prepared(cursor, search_page_statement(city, filters, columns, limit, after))
+    return jsonify(search_page(cursor.fetchall(), total, columns, limit, data['city']))
+
+def search_listing_index(index, city, filters, columns, limit, after, city_name):
+    """ Filters and orders with the in-memory index, then reads only the returned listings from Postgres by primary key """
+    with request_phase('index'):
+        ids, total = index.search(filters, limit=None if limit is None else limit + 1, after=after)
+    rows = []
+    if ids:
+        conn = find_db_connection_from_city(city_name)
+        cursor = conn.cursor()
+        execute_prepared(cursor, listings_by_id_statement(city, columns, ids))
+        by_id = {row[columns.index('id')]: row for row in cursor.fetchall()}
+        rows = [by_id[listing_id] for listing_id in ids if listing_id in by_id]
+
+    if limit is None:
+        return jsonify(search_rows_to_dicts(rows, columns, city_name))
+    return jsonify(search_page(rows, total, columns, limit, city_name))
+
+def single_city_search_options(data):
+    """ Validates fields, limit and cursor of a single-city search; limit is None for an unpaginated search """
+    columns = search_columns(data.get('fields'))
+    limit = parse_limit(data, SEARCH_MAX_PAGE_SIZE)
+    after = decode_search_cursor(data['cursor']) if data.get('cursor') else None
+    return columns, limit, after
+
+def search_page_statement(city, filters, columns, limit, after):
+    # Keyset pagination: resume strictly after the last (price, id) of the previous page
+    return search_statement(city, filters, columns, order_by="price, id", limit=limit + 1, after=after)
+
+def search_page(rows, total, columns, limit, city):
+    """ Builds the paginated response from up to limit + 1 rows """
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = None
+    if has_more:
+        last = rows[-1]
+        next_cursor = encode_search_cursor(last[columns.index('price')], last[columns.index('id')])
+
+    return {
+        'results': search_rows_to_dicts(rows, columns, city),
+        'total': total,
+        'has_more': has_more,
+        'next_cursor': next_cursor,
+    }
+
+SEARCH_MAX_PAGE_SIZE = 500
+
+def encode_search_cursor(price, listing_id):
+    payload = json.dumps([price, str(listing_id)]).encode()
+    return base64.urlsafe_b64encode(payload).decode()
+
+def decode_search_cursor(token):
+    """ Returns the (price, id) pair a page ends on """
+    try:
+        price, listing_id = json.loads(base64.urlsafe_b64decode(token.encode()))
+        price, listing_id = float(price), int(listing_id)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if not math.isfinite(price):
+        raise ValueError("Invalid cursor")
+    return price, listing_id
+
+def search_row_to_dict(row, columns, city):
+    row_dict = {columns[i]: row[i] for i in range(len(columns))}
+    row_dict['id'] = str(row_dict['id'])  # BIGINT ids exceed JavaScript's safe integer range
+    row_dict['city'] = city  # Add the city to each row's dictionary
+    return row_dict
+
+def search_rows_to_dicts(rows, columns, city):
+    """ Transforms the result into a list of dictionaries """
+    with request_phase('convert'):
+        return [search_row_to_dict(row, columns, city) for row in rows]
+
+# Rows fetched per round trip by server-side cursors in streaming responses
+STREAM_ITERSIZE = 2000
+
+def is_truthy(value):
+    return isinstance(value, str) and value.lower() in ('1', 'true', 'yes')
+
+def stream_json_rows(conn, sql, params, to_dict):
+    """ Streams a query as a JSON array using a named (server-side) cursor, one chunk per STREAM_ITERSIZE rows """
+    # Both the generator's finally and the response's close return the connection; only the first one may,
+    # since by the second the pool can have handed the same connection to another request
+    released = threading.Lock()
+
+    def release():
+        if released.acquire(blocking=False):
+            db_pools.putconn(conn)
+
+    def generate():
+        cursor = None
+        try:
+            cursor = conn.cursor(name=f"stream_{uuid.uuid4().hex}")
+            cursor.itersize = STREAM_ITERSIZE
+            cursor.execute(sql, params)
+            yield '['
+            first = True
+            chunk = []
+            for row in cursor:
+                chunk.append(json.dumps(to_dict(row)))
+                if len(chunk) >= STREAM_ITERSIZE:
+                    yield ('' if first else ',') + ','.join(chunk)
+                    first = False
+                    chunk = []
+            if chunk:
+                yield ('' if first else ',') + ','.join(chunk)
+            yield ']'
+        finally:
+            try:
+                if cursor is not None:
+                    cursor.close()
+            finally:
+                release()
+
+    response = Response(stream_with_context(generate()), mimetype='application/json')
+    # The generator's finally never runs if the response is closed before the first chunk (e.g. the client went away)
+    response.call_on_close(release)
+    return response
 
 @app.route('/getReviews', methods=['GET'])
 def get_Reviews():
     data = request.args
-    listing_id = data.get('listing_id')
+    try:
+        listing_id = parse_listing_id(data.get('listing_id'))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
     city = data.get('city').lower().replace(' ', '_').replace('-', '_')
     # db_name = city[0]
+    columns = ['id', 'reviewer_id', 'reviewer_name', 'comments']
+    if is_truthy(data.get('stream')):
+        conn = detach_connection(find_db_connection_from_city(data.get('city')))
+        return stream_json_rows(conn, f"""
+        SELECT {city}.reviews.id, reviewer_id, reviewer_name, comments FROM {city}.reviews
+        INNER JOIN {city}.listings_reviews ON {city}.reviews.id = {city}.listings_reviews.review_id
+        WHERE {city}.listings_reviews.listing_id = %s
+        """, (listing_id,), lambda row: {columns[i]: row[i] for i in range(len(columns))})
+
     conn = find_db_connection_from_city(data.get('city'))
     cursor = conn.cursor()
+    if 'limit' in data:
+        try:
+            limit = max(1, min(int(data['limit']), REVIEWS_MAX_PAGE_SIZE))
+        except ValueError:
+            return jsonify({'success': False, 'message': 'limit must be an integer'}), 400
+        cursor.execute(*reviews_page_query(city, listing_id, limit, data.get('after')))
+        rows = cursor.fetchall()
+        # The count comes from the maintained aggregate rather than a COUNT(*) over the listing's reviews
+        cursor.execute(*review_count_query(city, listing_id))
+        return jsonify(reviews_page(rows, cursor.fetchone(), limit))
+
     cursor.execute(f"""
-    SELECT * FROM {city}.reviews
+    SELECT {city}.reviews.id, reviewer_id, reviewer_name, comments FROM {city}.reviews
     INNER JOIN {city}.listings_reviews ON {city}.reviews.id = {city}.listings_reviews.review_id
-    WHERE {city}.listings_reviews.listing_id = %s OR {city}.listings_reviews.listing_id = %s
-    """, (f"{listing_id}.0", str(listing_id)))
+    WHERE {city}.listings_reviews.listing_id = %s
+    """, (listing_id,))
     rows = cursor.fetchall()
     res = []
+    with request_phase('convert'):
+        for row in rows:
+            res.append({columns[i]: row[i] for i in range(len(columns))})
+    return jsonify(res)
+
+# Largest page /getReviews returns when limit is given
+REVIEWS_MAX_PAGE_SIZE = 200
+
+def reviews_page_query(city, listing_id, limit, after=None):
+    """ One page of a listing's reviews in review id order, resuming after the given review id """
+    # The (listing_id, review_id) primary key of listings_reviews serves both the filter and the order,
+    # so a page costs limit + 1 index entries however many reviews the listing has
+    sql = f"""
+        SELECT r.id, r.reviewer_id, r.reviewer_name, r.comments
+        FROM {city}.listings_reviews lr
+        INNER JOIN {city}.reviews r ON r.id = lr.review_id
+        WHERE lr.listing_id = %s"""
+    params = [listing_id]
+    if after:
+        sql += " AND lr.review_id > %s"
+        params.append(after)
+    sql += " ORDER BY lr.review_id LIMIT %s"
+    params.append(limit + 1)
+    return sql, params
+
+def review_count_query(city, listing_id):
+    return f"SELECT review_count FROM {city}.listing_review_stats WHERE listing_id = %s", (listing_id,)
+
+def reviews_page(rows, stats, limit):
+    """ Builds the paginated /getReviews response from up to limit + 1 rows and the listing's stats row """
+    has_more = len(rows) > limit
+    rows = rows[:limit]
     columns = ['id', 'reviewer_id', 'reviewer_name', 'comments']
+    return {
+        'results': [{columns[i]: row[i] for i in range(len(columns))} for row in rows],
+        'total': stats[0] if stats else 0,
+        'has_more': has_more,
+        'next_cursor': rows[-1][0] if has_more else None,
+    }
+
+
+# Default and maximum number of listings returned by /searchReviews
+REVIEW_SEARCH_DEFAULT_LIMIT = 20
+REVIEW_SEARCH_MAX_LIMIT = 100
+
+@app.route('/searchReviews', methods=['GET'])
+def search_reviews():
+    """ Ranks a city's listings by how well their review comments match a full-text query """
+    data = request.args
+    query = (data.get('q') or '').strip()
+    if not query or not data.get('city'):
+        return jsonify({'success': False, 'message': 'city and q are required'}), 400
+    try:
+        limit = max(1, min(int(data.get('limit', REVIEW_SEARCH_DEFAULT_LIMIT)), REVIEW_SEARCH_MAX_LIMIT))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'limit must be an integer'}), 400
+    city = city_schema_name(data.get('city'))
+
+    conn = find_db_connection_from_city(data.get('city'))
+    columns = [column for column in LISTING_COLUMNS if column != 'amenities']
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT {', '.join('l.' + column for column in columns)}, COUNT(*) AS matching_reviews, SUM(ts_rank(r.comments_tsv, q)) AS rank
+            FROM {city}.reviews r
+            CROSS JOIN websearch_to_tsquery('english', %s) q
+            INNER JOIN {city}.listings_reviews lr ON lr.review_id = r.id
+            INNER JOIN {city}.listings l ON l.id = lr.listing_id
+            WHERE r.comments_tsv @@ q
+            GROUP BY l.id
+            ORDER BY rank DESC, matching_reviews DESC
+            LIMIT %s
+        """, (query, limit))
+        rows = cursor.fetchall()
+
+    res = []
     for row in rows:
-        res.append({columns[i]: row[i] for i in range(len(columns))})
+        row_dict = search_row_to_dict(row[:len(columns)], columns, data['city'])
+        row_dict['matching_reviews'] = row[len(columns)]
+        row_dict['rank'] = row[len(columns) + 1]
+        res.append(row_dict)
     return jsonify(res)
 
-
 @app.route('/getCitites', methods=['GET'])
 def get_cities():
-    conn = get_db_connection("cities")
-    cursor = conn.cursor()
     try:
-        cursor.execute("SELECT city_name FROM city_info")
-        rows = cursor.fetchall()
-        cities = [row[0] for row in rows]
+        cities = city_router.city_names()
     except Exception as e:
         print(f"Database query failed: {e}")
         cities = []
-    finally:
-        cursor.close()
-        conn.close()
     return jsonify(cities)
 
 @app.route('/insert', methods=['POST'])
 def insert_property():
     data = request.get_json()
     city = data.get('city').lower().replace(' ', '_').replace('-', '_')
-    conn = get_db_connection("cities")
 
     try:
-        # Ensure the city exists in city_info and get db_name
         if city.lower() == "other":
+            # Registers the new city in city_info and creates its schema
             temp_city = data['otherCity']
-            db_name = create_city_database(conn, temp_city)
-            conn.close()  
+            conn = get_db_connection("cities")
+            try:
+                create_city_database(conn, temp_city)
+            finally:
+                release_connection(conn)
             city = temp_city.lower().replace(' ', '_').replace('-', '_')
-            conn = find_db_connection_from_city(temp_city)
+            city_name = temp_city
         else:
-            db_name = city[0]
-            conn = find_db_connection_from_city(data.get('city'))
+            city_name = data.get('city')
+        conn = find_db_connection_from_city(city_name)
 
-        print("in here")
-        insert_property_data(data, conn, city)
+        listing_id = insert_property_data(data, conn, city)
+        add_to_listing_index(city_name, conn, listing_id)
+        invalidate_search_cache(city)
 
         return jsonify({'success': True, 'message': 'Property inserted successfully!'}), 201
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
-    finally:
-        if conn:
-            conn.close()
 
 @app.route('/deleteReview', methods=['POST'])
 def delete_review():
@@ -229,19 +794,19 @@ def delete_review():
     try:
         with conn.cursor() as cur:
             # Delete from listings_reviews first to maintain referential integrity
-            cur.execute(f"DELETE FROM {city}.listings_reviews WHERE review_id = %s", (review_id,))
+            cur.execute(f"DELETE FROM {city}.listings_reviews WHERE review_id = %s RETURNING listing_id", (review_id,))
+            listing_ids = [row[0] for row in cur.fetchall()]
             # Delete from reviews
             cur.execute(f"DELETE FROM {city}.reviews WHERE id = %s", (review_id,))
+            recompute_review_stats(cur, city, listing_ids)
 
             conn.commit()  # Ensure changes are committed to the database
+            invalidate_search_cache(city)
 
             return jsonify({'success': True, 'message': 'Review deleted successfully!'}), 200
     except Exception as e:
         conn.rollback()  # Rollback the transaction on error
         return jsonify({'success': False, 'message': str(e)}), 500
-    finally:
-        if conn:
-            conn.close()
 
 @app.route('/updateReview/<review_id>', methods=['PUT'])
 def update_review(review_id):
@@ -254,18 +819,22 @@ def update_review(review_id):
             cur.execute(f"""
                 UPDATE {city}.reviews SET comments = %s WHERE id = %s
             """, (data['comments'], review_id))
+            cur.execute(f"SELECT listing_id FROM {city}.listings_reviews WHERE review_id = %s", (review_id,))
+            recompute_review_stats(cur, city, [row[0] for row in cur.fetchall()])
             conn.commit()
+            invalidate_search_cache(city)
             return jsonify({'success': True, 'message': 'Review updated successfully'}), 200
     except Exception as e:
         conn.rollback()
         return jsonify({'success': False, 'message': str(e)}), 500
-    finally:
-        if conn:
-            conn.close()
 
 @app.route('/addReview', methods=['POST'])
 def add_review():
     data = request.get_json()
+    try:
+        listing_id = parse_listing_id(data.get('listing_id'))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
     city = data['city'].lower().replace(' ', '_').replace('-', '_')  # Use city in your database queries if needed
     # db_name = city[0]  # For database selection
     conn = find_db_connection_from_city(data['city'])
@@ -286,75 +855,82 @@ def add_review():
             cur.execute(f"""
                 INSERT INTO {city}.listings_reviews (listing_id, review_id)
                 VALUES (%s, %s)
-            """, (data['listing_id'], new_review_id))
+            """, (listing_id, new_review_id))
+            record_added_reviews(cur, city, [(listing_id, new_review_id, data['comments'])])
             conn.commit()
+            invalidate_search_cache(city)
             
             return jsonify({'success': True, 'message': 'New review added successfully', 'review_id': new_review_id, 'reviewer_id': new_reviewer_id}), 201
     except Exception as e:
         conn.rollback()
         return jsonify({'success': False, 'message': str(e)}), 500
-    finally:
-        conn.close()
 
-def get_schema_count(db_name):
-    """ Utility function to get the count of schemas in a specific database """
-    conn = psycopg2.connect(database=db_name, user="postgres", password="toor", host="localhost")
+def get_schema_names(db_name):
+    """ Utility function to list the city schemas in a specific database """
+    conn = checkout_connection(db_name)
     cursor = conn.cursor()
     cursor.execute("""
-        SELECT COUNT(schema_name) FROM information_schema.schemata
+        SELECT schema_name FROM information_schema.schemata
         WHERE catalog_name = %s AND schema_name NOT IN ('public', 'information_schema', 'pg_catalog', 'pg_toast')
+        AND schema_name NOT LIKE 'pg_%%'
     """, (db_name,))
-    count = cursor.fetchone()[0]
-    print(f"Schema count for {db_name}: {count}")
+    names = [row[0] for row in cursor.fetchall()]
     cursor.close()
-    conn.close()
-    return count
+    release_connection(conn)
+    return names
 
 def check_and_create_overflow_db(base_db_name):
     """ Checks for overflow databases and creates a new one if necessary """
     overflow_db_name = f"{base_db_name}_overflow"
+    if overflow_db_name in shard_placement.schemas:
+        return overflow_db_name
     if not database_exists(overflow_db_name):
         create_database(overflow_db_name)
+        shard_placement.record_database(overflow_db_name)
     return overflow_db_name
 
 def database_exists(db_name):
     """ Checks if a database exists """
-    conn = psycopg2.connect(database="postgres", user="postgres", password="toor", host="localhost")
+    conn = checkout_connection("postgres")
     conn.autocommit = True
     cursor = conn.cursor()
     cursor.execute("SELECT 1 FROM pg_database WHERE datname=%s", (db_name,))
     exists = cursor.fetchone() is not None
     cursor.close()
-    conn.close()
+    release_connection(conn)
     return exists
 
 def create_database(db_name):
     """ Creates a new database """
-    conn = psycopg2.connect(database="postgres", user="postgres", password="toor", host="localhost")
+    conn = checkout_connection("postgres")
     conn.autocommit = True
     cursor = conn.cursor()
     cursor.execute(f"CREATE DATABASE {db_name}")
     cursor.close()
-    conn.close()
+    release_connection(conn)
+    # Before any city schema is migrated into it
+    conn = checkout_connection(db_name)
+    with conn.cursor() as cursor:
+        setup_database_extensions(cursor)
+    conn.commit()
+    release_connection(conn)
     print(f"Database {db_name} created successfully.")
 
 def create_city_database(conn, city):
     base_db_name = city.lower().replace(' ', '_').replace('-', '_')[0]  # Assumes databases are named after the first letter of the city
     print(f"Creating database for {city} with base name {base_db_name}")
     
-    if get_schema_count(base_db_name) >= 4:
-        db_name = check_and_create_overflow_db(base_db_name)
-    else:
-        db_name = base_db_name
+    db_name = shard_placement.place(base_db_name)
     print(f"Creating database for {city} with name {db_name}")
     with conn.cursor() as cur:
         cur.execute("INSERT INTO city_info (city_name, db_name) VALUES (%s, %s) ON CONFLICT (city_name) DO NOTHING", (city, db_name))
         conn.commit()
+    city_router.invalidate()
     create_new_city_database(db_name, city)
     return db_name
 
 def create_new_city_database(db_name, city):
-    conn1 = psycopg2.connect(database="postgres", user="postgres", password="toor", host="localhost")
+    conn1 = checkout_connection("postgres")
     conn1.autocommit = True
     cursor = conn1.cursor()
     try:
@@ -368,13 +944,13 @@ def create_new_city_database(db_name, city):
         print(f"Failed to create database {db_name}: {e}")
     finally:
         cursor.close()
-        conn1.close()
+        release_connection(conn1)
 
     # Connect to the new database and set up schema
     conn = find_db_connection_from_city(city)
     create_schema_if_not_exists(city, conn)
     setup_schema(conn, city)
-    conn.close()
+    release_connection(conn)
 
 def create_schema_if_not_exists(schema_name, connection):
     city_schema = schema_name.lower().replace(' ', '_').replace('-', '_')
@@ -382,6 +958,7 @@ def create_schema_if_not_exists(schema_name, connection):
         with connection.cursor() as cursor:
             cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {city_schema}")
             connection.commit()
+            shard_placement.record_schema(connection.info.dbname, city_schema)
             print(f"Schema {city_schema} created or already exists.")
     except psycopg2.Error as e:
         print(f"Failed to create or check schema {city_schema}: {e.pgerror}")
@@ -392,7 +969,7 @@ def setup_schema(conn, city):
     with conn.cursor() as cur:
         cur.execute(f"""
             CREATE TABLE IF NOT EXISTS {city_schema}.listings (
-                id TEXT PRIMARY KEY,
+                id BIGINT PRIMARY KEY,
                 name TEXT,
                 neighbourhood_cleansed VARCHAR(255),
                 property_type VARCHAR(255), 
@@ -401,20 +978,25 @@ def setup_schema(conn, city):
                 beds FLOAT, 
                 amenities TEXT, 
                 price FLOAT, 
-                review_scores_rating FLOAT
+                review_scores_rating FLOAT,
+                amenity_tags TEXT[],
+                row_hash TEXT
             );
             CREATE TABLE IF NOT EXISTS {city_schema}.reviews (
                 id TEXT PRIMARY KEY,
                 reviewer_id TEXT,
                 reviewer_name TEXT,
-                comments TEXT
+                comments TEXT,
+                row_hash TEXT
             );
             CREATE TABLE IF NOT EXISTS {city_schema}.listings_reviews (
-                listing_id TEXT,
+                listing_id BIGINT,
                 review_id TEXT,
                 PRIMARY KEY (listing_id, review_id)
             );
         """)
+        setup_amenity_index(cur, city_schema)
+        migrate_city_schema(cur, city_schema)
         conn.commit()
 
 def my_random(d):
@@ -427,7 +1009,6 @@ def insert_property_data(data, conn, city):
     listing_id = str(my_random(5))
     id = str(my_random(5))
     review_id = str(my_random(5))
-    print(listing_id,review_id)
 
     # Convert the comma-separated string into a list
     amenities_list = data['amenities'].split(',')
@@ -439,8 +1020,8 @@ def insert_property_data(data, conn, city):
         # Insert into listings
         
         cur.execute(f"""
-            INSERT INTO {city}.listings (id, name, neighbourhood_cleansed, property_type, accommodates, bathrooms_text, beds, amenities, price, review_scores_rating)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            INSERT INTO {city}.listings (id, name, neighbourhood_cleansed, property_type, accommodates, bathrooms_text, beds, amenities, price, review_scores_rating, amenity_tags)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
         """, (
             listing_id,
             data['name'],
@@ -451,7 +1032,8 @@ def insert_property_data(data, conn, city):
             str(data['bedrooms']),
             amenities_json,
             float(data['price']),
-            float(data['rating'])  # Assuming rating maps to review_scores_rating
+            float(data['rating']),  # Assuming rating maps to review_scores_rating
+            amenity_tags(amenities_json)
         ))
         # print("Listings data inserted successfully.")
         # Insert into reviews
@@ -470,65 +1052,228 @@ def insert_property_data(data, conn, city):
             INSERT INTO {city_schema}.listings_reviews (listing_id, review_id)
             VALUES (%s, %s)
         """, (listing_id, id))
+        record_added_reviews(cur, city_schema, [(listing_id, id, data['review'])])
+        record_listing_facets(cur, city_schema, listing_id)
 
         conn.commit()
+    return listing_id
 
-def insert_data(cursor, listing_id, city, comment):
-    review_id = ''.join(random.choices(string.ascii_uppercase + string.digits, k=10))
+# Rows per bulk insert (and per transaction) in /upload_csv, per city
+UPLOAD_BATCH_SIZE = 1000
+# Rejected rows listed individually in the /upload_csv report
+UPLOAD_MAX_REPORTED_ERRORS = 1000
+
+def new_upload_review_id():
+    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=10))
+
+def reject_upload_row(report, line, city, reason):
+    report['rejected'] += 1
+    if len(report['errors']) < UPLOAD_MAX_REPORTED_ERRORS:
+        report['errors'].append({'line': line, 'city': city, 'error': reason})
+    else:
+        report['errors_truncated'] = True
+
+def insert_review_batch(conn, city, batch, report):
+    """ Inserts a batch of (line, listing_id, comment) rows for one city in one transaction; if the batch fails it is retried row by row to isolate the bad rows """
+    city_schema = city_schema_name(city)
+    rows = [(new_upload_review_id(), line, listing_id, comment) for line, listing_id, comment in batch]
     try:
-        cursor.execute(f"INSERT INTO {city.lower().replace(' ', '_').replace('-', '_')}.reviews VALUES (%s, 0000, 'admin', %s)", (review_id, comment))
-        cursor.execute(f"INSERT INTO {city.lower().replace(' ', '_').replace('-', '_')}.listings_reviews VALUES (%s, %s)", (listing_id,review_id))
-    except psycopg2.Error as e:
-        print(f"Error inserting data: {e}")
+        with conn.cursor() as cur:
+            execute_values(cur, f"INSERT INTO {city_schema}.reviews (id, reviewer_id, reviewer_name, comments) VALUES %s",
+                           [(review_id, '0', 'admin', comment) for review_id, _, _, comment in rows], page_size=UPLOAD_BATCH_SIZE)
+            execute_values(cur, f"INSERT INTO {city_schema}.listings_reviews (listing_id, review_id) VALUES %s",
+                           [(listing_id, review_id) for review_id, _, listing_id, _ in rows], page_size=UPLOAD_BATCH_SIZE)
+            record_added_reviews(cur, city_schema, [(listing_id, review_id, comment) for review_id, _, listing_id, comment in rows])
+        conn.commit()
+        report['accepted'] += len(rows)
+        return
+    except psycopg2.Error:
+        conn.rollback()
+
+    with conn.cursor() as cur:
+        added = []
+        for review_id, line, listing_id, comment in rows:
+            cur.execute("SAVEPOINT upload_row")
+            try:
+                cur.execute(f"INSERT INTO {city_schema}.reviews (id, reviewer_id, reviewer_name, comments) VALUES (%s, '0', 'admin', %s)", (review_id, comment))
+                cur.execute(f"INSERT INTO {city_schema}.listings_reviews (listing_id, review_id) VALUES (%s, %s)", (listing_id, review_id))
+                cur.execute("RELEASE SAVEPOINT upload_row")
+                report['accepted'] += 1
+                added.append((listing_id, review_id, comment))
+            except psycopg2.Error as e:
+                cur.execute("ROLLBACK TO SAVEPOINT upload_row")
+                reject_upload_row(report, line, city, (e.pgerror or str(e)).strip())
+        record_added_reviews(cur, city_schema, added)
+    conn.commit()
+
+def flush_upload_batch(connections, city, batch, report):
+    """ Inserts a city's batch, checking out the city's connection on its first batch """
+    conn = connections.get(city)
+    if conn is None:
+        try:
+            conn = connections[city] = find_db_connection_from_city(city)
+        except Exception as e:
+            # e.g. PoolExhausted: this batch is rejected and the next one tries again
+            for line, _, _ in batch:
+                reject_upload_row(report, line, city, str(e))
+            return
+    insert_review_batch(conn, city, batch, report)
 
 @app.route('/upload_csv', methods=['POST'])
 def upload_csv():
-    file = request.files['file']
+    file = request.files.get('file')
     if not file:
         return jsonify({'error': 'No file provided'}), 400
 
-    data_stream = io.StringIO(file.read().decode('utf-8-sig'))
+    # Parse straight from the uploaded stream instead of reading the whole file into memory
+    data_stream = io.TextIOWrapper(file.stream, encoding='utf-8-sig', newline='')
     csv_reader = csv.DictReader(data_stream)
-
-    grouped_data = {}
-    for row in csv_reader:
-        city = row['City'].strip()
-        if city not in grouped_data:
-            grouped_data[city] = []
-        grouped_data[city].append(row)
-    print(grouped_data)
-
-    for city, records in grouped_data.items():
-        print(city)
-        conn = find_db_connection_from_city(city)
-        if conn:
-            with conn.cursor() as cursor:
-                for record in records:
-                    insert_data(cursor, record['Listing_id'], city, record['Comment'])
-                conn.commit()
-            conn.close()
-
-    return jsonify({'message': 'File uploaded and processed successfully!'}), 200
+    missing = [column for column in ('City', 'Listing_id', 'Comment') if column not in (csv_reader.fieldnames or [])]
+    if missing:
+        return jsonify({'error': f"Missing columns: {', '.join(missing)}"}), 400
+
+    report = {'accepted': 0, 'rejected': 0, 'errors': [], 'errors_truncated': False}
+    connections = {}
+    batches = {}
+    unknown_cities = set()
+    try:
+        for row in csv_reader:
+            line = csv_reader.line_num
+            city = (row['City'] or '').strip()
+            comment = row['Comment']
+            if not city or comment is None or comment == '':
+                reject_upload_row(report, line, city, 'City and Comment are required')
+                continue
+            try:
+                listing_id = parse_listing_id(row['Listing_id'])
+            except ValueError as e:
+                reject_upload_row(report, line, city, str(e))
+                continue
+            if city in unknown_cities:
+                reject_upload_row(report, line, city, f"No database entry found for city: {city}")
+                continue
+            if city not in batches:
+                try:
+                    with request_phase('routing'):
+                        route = city_router.lookup(city)
+                except Exception as e:
+                    # A transient failure (e.g. the cities database) only rejects this row
+                    reject_upload_row(report, line, city, str(e))
+                    continue
+                if route is None:
+                    unknown_cities.add(city)
+                    reject_upload_row(report, line, city, f"No database entry found for city: {city}")
+                    continue
+                batches[city] = []
+
+            batches[city].append((line, listing_id, comment))
+            if len(batches[city]) >= UPLOAD_BATCH_SIZE:
+                flush_upload_batch(connections, city, batches[city], report)
+                batches[city] = []
+    except (UnicodeDecodeError, csv.Error) as e:
+        report['error'] = f"Could not parse the file past line {csv_reader.line_num}: {e}"
+
+    for city, batch in batches.items():
+        if batch:
+            flush_upload_batch(connections, city, batch, report)
+        invalidate_search_cache(city)
+
+    report['message'] = 'File uploaded and processed successfully!' if 'error' not in report else 'File partially processed'
+    return jsonify(report), 200 if 'error' not in report else 400
 
 @app.route('/removeAllReviews', methods=['GET'])
 def removeReviews():
-    listing_id = request.args.get('listing_id')
+    try:
+        listing_id = parse_listing_id(request.args.get('listing_id'))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
     city = request.args.get('city').lower().replace(' ', '_').replace('-', '_')
     # db_name = city[0]
     conn = find_db_connection_from_city(request.args.get('city'))
     try:
         with conn.cursor() as cur:
-            cur.execute(f"DELETE FROM {city}.reviews WHERE id IN (SELECT review_id FROM {city}.listings_reviews WHERE listing_id = %s OR listing_id = %s)", (f"{listing_id}", f"{listing_id}.0"))
-            cur.execute(f"DELETE FROM {city}.listings_reviews WHERE listing_id = %s", (listing_id,))
+            cur.execute(*remove_listing_reviews_query(city, [listing_id]))
             conn.commit()
+            invalidate_search_cache(city)
             return jsonify({'success': True, 'message': 'Reviews deleted successfully!'}), 200
     except Exception as e:
         conn.rollback()
         return jsonify({'success': False, 'message': str(e)}), 500
+
+def moderate_shard(action, db_name, cities):
+    """ Runs the items of one shard's cities in a single transaction; returns index -> outcome """
+    outcomes = {}
+    conn = checkout_connection(db_name)
+    try:
+        with conn.cursor() as cur:
+            for city_schema, entries in cities.items():
+                cur.execute(*action.query(city_schema, [parsed for _, parsed in entries]))
+                city_outcomes, listing_ids = action.results(entries, cur.fetchall())
+                recompute_review_stats(cur, city_schema, listing_ids)
+                outcomes.update(city_outcomes)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
     finally:
-        if conn:
-            conn.close()
+        release_connection(conn)
+    return outcomes
 
+def run_moderation(action, data):
+    """ Applies a bulk moderation action: items are grouped per shard and city, each city's items run as one
+    statement and each shard commits once, so a failing shard only fails its own items """
+    try:
+        items = action.items(data)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    results = [None] * len(items)
+    shards = {}  # db_name -> {city_schema: [(index, parsed item)]}
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict) or not item.get('city'):
+                raise ValueError("city is required")
+            parsed = action.parse_item(item)
+            with request_phase('routing'):
+                route = city_router.lookup(item['city'])
+            if route is None:
+                raise ValueError(f"No database entry found for city: {item['city']}")
+        except ValueError as e:
+            results[index] = action.result(item, {'status': 'failed', 'message': str(e)})
+            continue
+        db_name, city_schema = route
+        shards.setdefault(db_name, {}).setdefault(city_schema, []).append((index, parsed))
+
+    for db_name, cities in shards.items():
+        try:
+            outcomes = moderate_shard(action, db_name, cities)
+        except Exception as e:
+            # Also covers a shard we could not check out a connection to
+            outcomes = {index: {'status': 'failed', 'message': str(e)} for entries in cities.values() for index, _ in entries}
+        for index, outcome in outcomes.items():
+            results[index] = action.result(items[index], outcome)
+        for city_schema in cities:
+            invalidate_search_cache(city_schema)
+
+    return jsonify(moderation_summary(results)), 200
+
+@app.route('/bulkDeleteReviews', methods=['POST'])
+def bulk_delete_reviews():
+    """ Deletes {"reviews": [{"city", "review_id"}, ...]} """
+    return run_moderation(DELETE_REVIEWS, request.get_json(silent=True))
+
+@app.route('/bulkUpdateReviews', methods=['POST'])
+def bulk_update_reviews():
+    """ Sets comments for {"reviews": [{"city", "review_id", "comments"}, ...]} """
+    return run_moderation(UPDATE_REVIEWS, request.get_json(silent=True))
+
+@app.route('/bulkRemoveReviews', methods=['POST'])
+def bulk_remove_reviews():
+    """ Deletes every review of {"listings": [{"city", "listing_id"}, ...]} """
+    return run_moderation(REMOVE_LISTING_REVIEWS, request.get_json(silent=True))
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(message)s')
+    city_router.load()
+    shard_placement.seed({db_name for db_name, _ in city_router.routes.values()})
     app.run(debug=True)
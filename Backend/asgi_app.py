@@ -0,0 +1,495 @@
+import asyncio
+import json
+import time
+import uuid
+from contextlib import asynccontextmanager
+from psycopg import AsyncClientCursor
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool
+from quart import Quart, jsonify, request, g, Response
+from quart_cors import cors
+from app import (DB_CONFIG, POOL_MIN_SIZE, POOL_IDLE_TIMEOUT, ROUTING_CACHE_TTL, ROUTING_MISS_RELOAD_INTERVAL,
+                 SEARCH_CACHE_MAX_BYTES, SEARCH_CACHE_TTL, SEARCH_SHARD_TIMEOUT, STREAM_ITERSIZE, REVIEWS_MAX_PAGE_SIZE,
+                 city_schema_name, search_cache_params, search_row_to_dict, search_rows_to_dicts, single_city_search_options,
+                 search_page_statement, search_page, cross_city_search_options, merge_city_results, reviews_page_query,
+                 review_count_query, reviews_page, is_truthy, my_random)
+from migrations import parse_listing_id
+from review_stats import record_added_reviews_query, recompute_review_stats_query
+from facets import facet_statement, facet_counts
+from moderation import DELETE_REVIEWS, UPDATE_REVIEWS, REMOVE_LISTING_REVIEWS, remove_listing_reviews_query, moderation_summary
+from search_cache import SearchCache
+from search_query import parse_search_filters, search_statement, count_statement, execute_prepared_async
+
+# Async serving mode: the same routes and JSON as app.py, served by an ASGI server on one event loop
+# with psycopg 3 async pools, e.g. `hypercorn asgi_app:app`. `python app.py` still runs the Flask server.
+
+app = Quart(__name__)
+app = cors(app, allow_origin='*')
+
+# Each in-flight query holds a connection, so the async pools are larger than the Flask ones
+ASYNC_POOL_MAX_SIZE = 50
+# Seconds a request waits for a pooled connection before failing
+ASYNC_POOL_CHECKOUT_TIMEOUT = 10
+
+
+class AsyncPoolManager:
+    """ One AsyncConnectionPool per shard database, opened on first use """
+
+    def __init__(self, minconn=POOL_MIN_SIZE, maxconn=ASYNC_POOL_MAX_SIZE, idle_timeout=POOL_IDLE_TIMEOUT, **connect_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.idle_timeout = idle_timeout
+        self.connect_kwargs = connect_kwargs
+        self.pools = {}
+        self.lock = asyncio.Lock()
+
+    async def get_pool(self, db_name):
+        pool = self.pools.get(db_name)
+        if pool is not None:
+            return pool
+        async with self.lock:
+            pool = self.pools.get(db_name)
+            if pool is None:
+                # Client-side binding keeps the psycopg2 %s placeholders and multi-statement queries working unchanged
+                pool = AsyncConnectionPool(make_conninfo(dbname=db_name, **self.connect_kwargs), min_size=self.minconn,
+                                           max_size=self.maxconn, max_idle=self.idle_timeout, timeout=ASYNC_POOL_CHECKOUT_TIMEOUT,
+                                           kwargs={'cursor_factory': AsyncClientCursor}, open=False)
+                await pool.open()
+                self.pools[db_name] = pool
+        return pool
+
+    @asynccontextmanager
+    async def connection(self, db_name, timeout=None):
+        pool = await self.get_pool(db_name)
+        async with pool.connection(timeout=timeout) as conn:
+            yield conn
+
+    async def closeall(self):
+        for pool in list(self.pools.values()):
+            await pool.close()
+        self.pools.clear()
+
+    def stats(self):
+        return {db_name: pool.get_stats() for db_name, pool in self.pools.items()}
+
+db_pools = AsyncPoolManager(**DB_CONFIG)
+
+
+class AsyncCityRouter:
+    """ In-memory copy of city_info mapping city_name -> (db_name, schema name), loaded through the async pools """
+
+    def __init__(self, ttl=ROUTING_CACHE_TTL, miss_reload_interval=ROUTING_MISS_RELOAD_INTERVAL):
+        self.ttl = ttl
+        self.miss_reload_interval = miss_reload_interval
+        self.routes = {}
+        self.loaded_at = None
+
+    async def load(self):
+        """ Reloads every route; returns the routes and their load time """
+        async with db_pools.connection("cities") as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("SELECT city_name, db_name FROM city_info")
+                rows = await cursor.fetchall()
+        self.routes = {city_name: (db_name, city_schema_name(city_name)) for city_name, db_name in rows}
+        self.loaded_at = time.monotonic()
+        return self.routes, self.loaded_at
+
+    async def _ensure_fresh(self):
+        routes, loaded_at = self.routes, self.loaded_at
+        if loaded_at is None or time.monotonic() - loaded_at > self.ttl:
+            return await self.load()
+        return routes, loaded_at
+
+    async def lookup(self, city_name):
+        """ Returns (db_name, schema) for a city, or None if it is not registered """
+        routes, loaded_at = await self._ensure_fresh()
+        route = routes.get(city_name)
+        if route is None and time.monotonic() - loaded_at > self.miss_reload_interval:
+            routes, _ = await self.load()
+            route = routes.get(city_name)
+        return route
+
+    async def city_names(self):
+        routes, _ = await self._ensure_fresh()
+        return list(routes)
+
+city_router = AsyncCityRouter()
+
+async def find_db_name_from_city(city_name):
+    route = await city_router.lookup(city_name)
+    if route is None:
+        raise Exception(f"No database entry found for city: {city_name}")
+    return route[0]
+
+search_cache = SearchCache(max_bytes=SEARCH_CACHE_MAX_BYTES, ttl=SEARCH_CACHE_TTL)
+
+def invalidate_search_cache(city):
+    search_cache.invalidate_city(city_schema_name(city))
+
+@app.before_serving
+async def load_routes():
+    await city_router.load()
+
+@app.after_serving
+async def close_pools():
+    await db_pools.closeall()
+
+@app.route('/poolStats', methods=['GET'])
+async def pool_stats():
+    return jsonify(db_pools.stats())
+
+@app.route('/cacheStats', methods=['GET'])
+async def cache_stats():
+    return jsonify(search_cache.stats())
+
+@app.route('/getCitites', methods=['GET'])
+async def get_cities():
+    try:
+        cities = await city_router.city_names()
+    except Exception as e:
+        print(f"Database query failed: {e}")
+        cities = []
+    return jsonify(cities)
+
+@app.route('/search', methods=['GET'])
+async def search_listing():
+    query_params = request.args
+
+    data = {key: query_params.getlist(key) if len(query_params.getlist(key)) > 1 else query_params[key] for key in query_params}
+
+    if is_truthy(data.get('stream')):
+        return await run_search(data, query_params)
+
+    cities = [city_schema_name(city) for city in (query_params.getlist('city') or await city_router.city_names())]
+    cache_key = search_cache.make_key(search_cache_params(query_params), cities)
+    body = search_cache.get(cache_key)
+    if body is not None:
+        return Response(body, mimetype='application/json')
+
+    response = await run_search(data, query_params)
+    if isinstance(response, Response) and response.status_code == 200 and not g.get('search_partial'):
+        search_cache.put(cache_key, await response.get_data())
+    return response
+
+@app.route('/facets', methods=['GET'])
+async def search_facets():
+    query_params = request.args
+    data = {key: query_params.getlist(key) if len(query_params.getlist(key)) > 1 else query_params[key] for key in query_params}
+    if len(query_params.getlist('city')) != 1:
+        return jsonify({'success': False, 'message': "city is required"}), 400
+
+    try:
+        filters = parse_search_filters(data, require_price=False)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    statement, source = facet_statement(city_schema_name(data['city']), filters)
+    async with db_pools.connection(await find_db_name_from_city(data['city'])) as conn:
+        async with conn.cursor() as cursor:
+            await execute_prepared_async(cursor, statement)
+            return jsonify(facet_counts(await cursor.fetchall(), source))
+
+async def run_search(data, query_params):
+    if len(query_params.getlist('city')) != 1:
+        # Several cities, or none for all of them
+        return await search_across_cities(data, query_params.getlist('city'))
+
+    city = city_schema_name(data.get('city'))
+
+    try:
+        filters = parse_search_filters(data)
+        columns, limit, after = single_city_search_options(data)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    db_name = await find_db_name_from_city(data.get('city'))
+    if limit is None and is_truthy(data.get('stream')):
+        sql, params = search_statement(city, filters, columns).inline_sql()
+        rows = stream_json_rows(db_name, sql, params, lambda row: search_row_to_dict(row, columns, data['city']))
+        return Response(rows, mimetype='application/json')
+
+    async with db_pools.connection(db_name) as conn:
+        async with conn.cursor() as cursor:
+            if limit is None:
+                # Unpaginated: every match, as a plain list
+                await execute_prepared_async(cursor, search_statement(city, filters, columns))
+                return jsonify(search_rows_to_dicts(await cursor.fetchall(), columns, data['city']))
+
+            await execute_prepared_async(cursor, count_statement(city, filters))
+            total = (await cursor.fetchone())[0]
+            await execute_prepared_async(cursor, search_page_statement(city, filters, columns, limit, after))
+            return jsonify(search_page(await cursor.fetchall(), total, columns, limit, data['city']))
+
+async def search_across_cities(data, cities):
+    """ Runs the search on every requested city concurrently and merges the per-city top-k lists """
+    try:
+        filters = parse_search_filters(data)
+        columns, limit, order_by, sort_key, merge_only = cross_city_search_options(data)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    cities = cities or await city_router.city_names()
+
+    failed = {}
+    tasks = {}
+    for city in cities:
+        route = await city_router.lookup(city)
+        if route is None:
+            failed[city] = f"No database entry found for city: {city}"
+            continue
+        db_name, city_schema = route
+        statement = search_statement(city_schema, filters, columns, order_by=order_by, limit=limit)
+        tasks[asyncio.ensure_future(search_shard(db_name, statement))] = city
+
+    per_city = []
+    if tasks:
+        done, not_done = await asyncio.wait(tasks, timeout=SEARCH_SHARD_TIMEOUT)
+        for task in done:
+            city = tasks[task]
+            try:
+                per_city.append(search_rows_to_dicts(task.result(), columns, city))
+            except Exception as e:
+                failed[city] = str(e)
+        for task in not_done:
+            task.cancel()
+            failed[tasks[task]] = f"Timed out after {SEARCH_SHARD_TIMEOUT}s"
+    # Partial results must not be cached
+    g.search_partial = bool(failed)
+    return jsonify(merge_city_results(per_city, sort_key, limit, cities, failed, merge_only))
+
+async def search_shard(db_name, statement):
+    async with db_pools.connection(db_name, timeout=SEARCH_SHARD_TIMEOUT) as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute("SET LOCAL statement_timeout = %s", (int(SEARCH_SHARD_TIMEOUT * 1000),))
+            await execute_prepared_async(cursor, statement)
+            return await cursor.fetchall()
+
+async def stream_json_rows(db_name, sql, params, to_dict):
+    """ Streams a query as a JSON array from a server-side cursor, one chunk per STREAM_ITERSIZE rows """
+    async with db_pools.connection(db_name) as conn:
+        async with conn.cursor(name=f"stream_{uuid.uuid4().hex}") as cursor:
+            cursor.itersize = STREAM_ITERSIZE
+            await cursor.execute(sql, params)
+            yield '['
+            first = True
+            chunk = []
+            async for row in cursor:
+                chunk.append(json.dumps(to_dict(row)))
+                if len(chunk) >= STREAM_ITERSIZE:
+                    yield ('' if first else ',') + ','.join(chunk)
+                    first = False
+                    chunk = []
+            if chunk:
+                yield ('' if first else ',') + ','.join(chunk)
+            yield ']'
+
+@app.route('/getReviews', methods=['GET'])
+async def get_Reviews():
+    data = request.args
+    try:
+        listing_id = parse_listing_id(data.get('listing_id'))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    city = city_schema_name(data.get('city'))
+    columns = ['id', 'reviewer_id', 'reviewer_name', 'comments']
+    db_name = await find_db_name_from_city(data.get('city'))
+    if is_truthy(data.get('stream')):
+        rows = stream_json_rows(db_name, f"""
+        SELECT {city}.reviews.id, reviewer_id, reviewer_name, comments FROM {city}.reviews
+        INNER JOIN {city}.listings_reviews ON {city}.reviews.id = {city}.listings_reviews.review_id
+        WHERE {city}.listings_reviews.listing_id = %s
+        """, (listing_id,), lambda row: {columns[i]: row[i] for i in range(len(columns))})
+        return Response(rows, mimetype='application/json')
+
+    if 'limit' in data:
+        try:
+            limit = max(1, min(int(data['limit']), REVIEWS_MAX_PAGE_SIZE))
+        except ValueError:
+            return jsonify({'success': False, 'message': 'limit must be an integer'}), 400
+
+    async with db_pools.connection(db_name) as conn:
+        async with conn.cursor() as cursor:
+            if 'limit' in data:
+                await cursor.execute(*reviews_page_query(city, listing_id, limit, data.get('after')))
+                rows = await cursor.fetchall()
+                await cursor.execute(*review_count_query(city, listing_id))
+                return jsonify(reviews_page(rows, await cursor.fetchone(), limit))
+
+            await cursor.execute(f"""
+            SELECT {city}.reviews.id, reviewer_id, reviewer_name, comments FROM {city}.reviews
+            INNER JOIN {city}.listings_reviews ON {city}.reviews.id = {city}.listings_reviews.review_id
+            WHERE {city}.listings_reviews.listing_id = %s
+            """, (listing_id,))
+            rows = await cursor.fetchall()
+    return jsonify([{columns[i]: row[i] for i in range(len(columns))} for row in rows])
+
+@app.route('/deleteReview', methods=['POST'])
+async def delete_review():
+    data = await request.get_json()
+    review_id = data.get('review_id')
+    city = city_schema_name(data.get('city'))
+
+    if not review_id:
+        return jsonify({'success': False, 'message': 'Failure'}), 400
+
+    db_name = await find_db_name_from_city(data.get('city'))
+    async with db_pools.connection(db_name) as conn:
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute(f"DELETE FROM {city}.listings_reviews WHERE review_id = %s RETURNING listing_id", (review_id,))
+                listing_ids = [row[0] for row in await cur.fetchall()]
+                await cur.execute(f"DELETE FROM {city}.reviews WHERE id = %s", (review_id,))
+                query = recompute_review_stats_query(city, listing_ids)
+                if query:
+                    await cur.execute(*query)
+            await conn.commit()
+        except Exception as e:
+            await conn.rollback()
+            return jsonify({'success': False, 'message': str(e)}), 500
+    invalidate_search_cache(city)
+    return jsonify({'success': True, 'message': 'Review deleted successfully!'}), 200
+
+@app.route('/updateReview/<review_id>', methods=['PUT'])
+async def update_review(review_id):
+    data = await request.get_json()
+    city = city_schema_name(data['city'])
+    db_name = await find_db_name_from_city(data['city'])
+    async with db_pools.connection(db_name) as conn:
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute(f"""
+                    UPDATE {city}.reviews SET comments = %s WHERE id = %s
+                """, (data['comments'], review_id))
+                await cur.execute(f"SELECT listing_id FROM {city}.listings_reviews WHERE review_id = %s", (review_id,))
+                query = recompute_review_stats_query(city, [row[0] for row in await cur.fetchall()])
+                if query:
+                    await cur.execute(*query)
+            await conn.commit()
+        except Exception as e:
+            await conn.rollback()
+            return jsonify({'success': False, 'message': str(e)}), 500
+    invalidate_search_cache(city)
+    return jsonify({'success': True, 'message': 'Review updated successfully'}), 200
+
+@app.route('/addReview', methods=['POST'])
+async def add_review():
+    data = await request.get_json()
+    try:
+        listing_id = parse_listing_id(data.get('listing_id'))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    city = city_schema_name(data['city'])
+    db_name = await find_db_name_from_city(data['city'])
+
+    new_review_id = str(my_random(5))
+    new_reviewer_id = str(my_random(5))
+
+    async with db_pools.connection(db_name) as conn:
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute(f"""
+                    INSERT INTO {city}.reviews (id, reviewer_id, reviewer_name, comments)
+                    VALUES (%s, %s, %s, %s)
+                """, (new_review_id, new_reviewer_id, data['reviewer_name'], data['comments']))
+                await cur.execute(f"""
+                    INSERT INTO {city}.listings_reviews (listing_id, review_id)
+                    VALUES (%s, %s)
+                """, (listing_id, new_review_id))
+                await cur.execute(*record_added_reviews_query(city, [(listing_id, new_review_id, data['comments'])]))
+            await conn.commit()
+        except Exception as e:
+            await conn.rollback()
+            return jsonify({'success': False, 'message': str(e)}), 500
+    invalidate_search_cache(city)
+    return jsonify({'success': True, 'message': 'New review added successfully', 'review_id': new_review_id, 'reviewer_id': new_reviewer_id}), 201
+
+@app.route('/removeAllReviews', methods=['GET'])
+async def removeReviews():
+    try:
+        listing_id = parse_listing_id(request.args.get('listing_id'))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    city = city_schema_name(request.args.get('city'))
+    db_name = await find_db_name_from_city(request.args.get('city'))
+    async with db_pools.connection(db_name) as conn:
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute(*remove_listing_reviews_query(city, [listing_id]))
+            await conn.commit()
+        except Exception as e:
+            await conn.rollback()
+            return jsonify({'success': False, 'message': str(e)}), 500
+    invalidate_search_cache(city)
+    return jsonify({'success': True, 'message': 'Reviews deleted successfully!'}), 200
+
+
+async def moderate_shard(action, db_name, cities):
+    """ Same as app.moderate_shard """
+    outcomes = {}
+    async with db_pools.connection(db_name) as conn:
+        try:
+            async with conn.cursor() as cur:
+                for city_schema, entries in cities.items():
+                    await cur.execute(*action.query(city_schema, [parsed for _, parsed in entries]))
+                    city_outcomes, listing_ids = action.results(entries, await cur.fetchall())
+                    query = recompute_review_stats_query(city_schema, listing_ids)
+                    if query:
+                        await cur.execute(*query)
+                    outcomes.update(city_outcomes)
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+    return outcomes
+
+async def run_moderation(action, data):
+    """ Same as app.run_moderation: one statement per city, one transaction per shard """
+    try:
+        items = action.items(data)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    results = [None] * len(items)
+    shards = {}  # db_name -> {city_schema: [(index, parsed item)]}
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict) or not item.get('city'):
+                raise ValueError("city is required")
+            parsed = action.parse_item(item)
+            route = await city_router.lookup(item['city'])
+            if route is None:
+                raise ValueError(f"No database entry found for city: {item['city']}")
+        except ValueError as e:
+            results[index] = action.result(item, {'status': 'failed', 'message': str(e)})
+            continue
+        db_name, city_schema = route
+        shards.setdefault(db_name, {}).setdefault(city_schema, []).append((index, parsed))
+
+    for db_name, cities in shards.items():
+        try:
+            outcomes = await moderate_shard(action, db_name, cities)
+        except Exception as e:
+            # Also covers a shard we could not get a connection to
+            outcomes = {index: {'status': 'failed', 'message': str(e)} for entries in cities.values() for index, _ in entries}
+        for index, outcome in outcomes.items():
+            results[index] = action.result(items[index], outcome)
+        for city_schema in cities:
+            invalidate_search_cache(city_schema)
+
+    return jsonify(moderation_summary(results)), 200
+
+@app.route('/bulkDeleteReviews', methods=['POST'])
+async def bulk_delete_reviews():
+    return await run_moderation(DELETE_REVIEWS, await request.get_json(silent=True))
+
+@app.route('/bulkUpdateReviews', methods=['POST'])
+async def bulk_update_reviews():
+    return await run_moderation(UPDATE_REVIEWS, await request.get_json(silent=True))
+
+@app.route('/bulkRemoveReviews', methods=['POST'])
+async def bulk_remove_reviews():
+    return await run_moderation(REMOVE_LISTING_REVIEWS, await request.get_json(silent=True))
+
+
+if __name__ == '__main__':
+    app.run()
@@ -0,0 +1,257 @@
+import os
+import io
+import csv
+import json
+import math
+import time
+import random
+import argparse
+import subprocess
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+import createDBs
+import filterData
+from amenities import AMENITY_VOCABULARY
+from db_pool import PoolManager
+
+# Synthetic cities, one per shard letter; run the benchmark against a scratch Postgres since they are
+# registered in city_info like real cities
+SYNTHETIC_CITIES = ['Ashford', 'Brightwater', 'Coldharbour', 'Dunmere', 'Eastvale', 'Fairhaven', 'Glenrock', 'Highmoor',
+                    'Ironbridge', 'Juniper Bay', 'Kingsreach', 'Lowfield']
+PROPERTY_TYPES = ['Entire rental unit', 'Private room in home', 'Entire home', 'Private room in condo', 'Entire loft']
+NEIGHBOURHOODS = ['Old Town', 'Riverside', 'Harbour', 'University', 'Hillside', 'Market District']
+WORDS = ['cozy', 'bright', 'quiet', 'spacious', 'modern', 'charming', 'loft', 'studio', 'garden', 'view', 'central', 'suite']
+REVIEW_WORDS = ['great', 'clean', 'location', 'host', 'stay', 'comfortable', 'quiet', 'would', 'recommend', 'again', 'noisy', 'small']
+
+# Extra columns the raw Airbnb files carry that filterData.py drops
+RAW_LISTINGS_COLUMNS = filterData.LISTINGS_COLUMNS + ['host_id', 'availability_365']
+RAW_REVIEWS_COLUMNS = ['listing_id', 'id', 'date', 'reviewer_id', 'reviewer_name', 'comments']
+
+def generate_city(city_path, rng, listings, reviews_per_listing):
+    """ Writes raw listings.csv and reviews.csv for one city in the Airbnb layout; returns the listing ids """
+    os.makedirs(city_path, exist_ok=True)
+    listing_ids = []
+    with open(os.path.join(city_path, 'listings.csv'), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(RAW_LISTINGS_COLUMNS)
+        for _ in range(listings):
+            # Recent Airbnb ids are 18 digits, beyond JavaScript's safe integer range
+            listing_id = rng.randrange(10 ** 17, 10 ** 18)
+            listing_ids.append(listing_id)
+            amenities = rng.sample(AMENITY_VOCABULARY, rng.randint(3, 12))
+            writer.writerow([
+                listing_id,
+                ' '.join(rng.choice(WORDS) for _ in range(4)).capitalize(),
+                rng.choice(NEIGHBOURHOODS),
+                rng.choice(PROPERTY_TYPES),
+                rng.randint(1, 8),
+                f"{rng.randint(1, 3)} baths",
+                rng.randint(1, 5),
+                json.dumps(amenities),
+                f"${rng.randint(30, 1500):,}.00",
+                round(rng.uniform(3.0, 5.0), 2),
+                rng.randint(1, 10 ** 8),
+                rng.randint(0, 365),
+            ])
+
+    with open(os.path.join(city_path, 'reviews.csv'), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(RAW_REVIEWS_COLUMNS)
+        review_id = rng.randrange(10 ** 8, 10 ** 9)
+        for listing_id in listing_ids:
+            for _ in range(rng.randint(0, 2 * reviews_per_listing)):
+                review_id += rng.randint(1, 1000)
+                writer.writerow([listing_id, review_id, '2024-01-01', rng.randint(1, 10 ** 8), 'Guest',
+                                 ' '.join(rng.choice(REVIEW_WORDS) for _ in range(rng.randint(5, 60)))])
+    return listing_ids
+
+def generate_data(raw_dir, cities, listings, reviews_per_listing, seed):
+    """ Generates every synthetic city; returns city -> listing ids """
+    rng = random.Random(seed)
+    return {city: generate_city(os.path.join(raw_dir, city), rng, listings, reviews_per_listing) for city in cities}
+
+def percentile(sorted_values, p):
+    """ Nearest-rank percentile of an already sorted list """
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+def summarize(latencies, errors, seconds, concurrency):
+    latencies = sorted(latencies)
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'concurrency': concurrency,
+        'seconds': round(seconds, 3),
+        'throughput': round(len(latencies) / seconds, 2) if seconds > 0 else None,
+        'mean_ms': ms(sum(latencies) / len(latencies)) if latencies else None,
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+    }
+
+def run_scenario(flask_app, make_request, requests, concurrency, seed):
+    """ Sends requests from concurrency threads, each with its own test client, and summarizes their latencies """
+    def worker(index, count):
+        rng = random.Random(seed * 1000 + index)
+        client = flask_app.test_client()
+        latencies, errors = [], 0
+        for _ in range(count):
+            method, url, kwargs = make_request(rng)
+            start = time.perf_counter()
+            response = client.open(url, method=method, **kwargs)
+            response.get_data()
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+        return latencies, errors
+
+    counts = [requests // concurrency + (1 if i < requests % concurrency else 0) for i in range(concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(worker, range(concurrency), counts))
+    seconds = time.perf_counter() - start
+    return summarize([latency for latencies, _ in results for latency in latencies], sum(errors for _, errors in results), seconds, concurrency)
+
+def search_params(rng, city=None, **extra):
+    low = rng.randint(30, 1200)
+    params = {'priceMin': low, 'priceMax': low + rng.randint(10, 300), 'name': '', 'bedrooms': '', 'people': '', 'rating': '', **extra}
+    if city:
+        params['city'] = city
+    return params
+
+def upload_body(rng, catalog, rows):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(['City', 'Listing_id', 'Comment'])
+    cities = list(catalog)
+    for _ in range(rows):
+        city = rng.choice(cities)
+        writer.writerow([city, rng.choice(catalog[city]), ' '.join(rng.choice(REVIEW_WORDS) for _ in range(20))])
+    return out.getvalue().encode()
+
+def build_scenarios(catalog, upload_rows):
+    """ Endpoint name -> function building one (method, url, kwargs) request from an RNG """
+    cities = list(catalog)
+
+    def listing(rng):
+        city = rng.choice(cities)
+        return city, rng.choice(catalog[city])
+
+    def get_reviews(rng, **extra):
+        city, listing_id = listing(rng)
+        return 'GET', '/getReviews', {'query_string': {'city': city, 'listing_id': listing_id, **extra}}
+
+    def upload_csv(rng):
+        body = upload_body(rng, catalog, upload_rows)
+        return 'POST', '/upload_csv', {'data': {'file': (io.BytesIO(body), 'reviews.csv')}, 'content_type': 'multipart/form-data'}
+
+    return {
+        'search': lambda rng: ('GET', '/search', {'query_string': search_params(rng, rng.choice(cities))}),
+        'search_page': lambda rng: ('GET', '/search', {'query_string': search_params(rng, rng.choice(cities), limit=20)}),
+        'search_all_cities': lambda rng: ('GET', '/search', {'query_string': search_params(rng, limit=20)}),
+        # Price bounds only are answered from the facet summary, any other filter aggregates the listings
+        'facets': lambda rng: ('GET', '/facets', {'query_string': search_params(rng, rng.choice(cities))}),
+        'facets_filtered': lambda rng: ('GET', '/facets', {'query_string': search_params(rng, rng.choice(cities), people=rng.randint(1, 8))}),
+        'getReviews': get_reviews,
+        'getReviews_page': lambda rng: get_reviews(rng, limit=20),
+        'upload_csv': upload_csv,
+    }
+
+def ingest(raw_dir, data_dir, user, password, host, workers):
+    """ Cleans the raw files with filterData.py and loads them through createDBs.py; returns ingest statistics """
+    start = time.perf_counter()
+    filterData.process_and_save_files(raw_dir, data_dir)
+    filter_seconds = time.perf_counter() - start
+
+    createDBs.create_database("cities", user, password, host)
+    createDBs.create_cities_table("cities", user, password, host, data_dir)
+    start = time.perf_counter()
+    results = createDBs.ingest_all_cities(data_dir, user, password, host, workers=workers)
+    load_seconds = time.perf_counter() - start
+    rows = sum(result['listings'] + result['reviews'] for result in results.values() if result['success'])
+    return {
+        'filter_seconds': round(filter_seconds, 3),
+        'load_seconds': round(load_seconds, 3),
+        'rows': rows,
+        'rows_per_sec': round(rows / load_seconds, 2) if load_seconds > 0 else None,
+        'failed_cities': [city for city, result in results.items() if not result['success']],
+    }
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline_path):
+    """ Prints throughput and p95 changes against an earlier results file """
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"Compared with {baseline_path} ({baseline.get('commit')}):")
+    for name, current in results['endpoints'].items():
+        previous = baseline.get('endpoints', {}).get(name)
+        if not previous or not previous.get('throughput') or not previous.get('p95_ms'):
+            continue
+        print(f"  {name}: throughput {current['throughput'] / previous['throughput'] - 1:+.1%}, "
+              f"p95 {current['p95_ms'] / previous['p95_ms'] - 1:+.1%}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic cities, load them and benchmark the backend endpoints")
+    parser.add_argument('--cities', type=int, default=3, help=f"number of synthetic cities (at most {len(SYNTHETIC_CITIES)})")
+    parser.add_argument('--listings', type=int, default=2000, help="listings per city")
+    parser.add_argument('--reviews-per-listing', type=int, default=10, help="average reviews per listing")
+    parser.add_argument('--requests', type=int, default=500, help="requests per endpoint")
+    parser.add_argument('--concurrency', type=int, default=8, help="concurrent clients per endpoint")
+    parser.add_argument('--upload-rows', type=int, default=200, help="rows per /upload_csv request")
+    parser.add_argument('--endpoints', default=None, help="comma-separated subset of endpoints to run")
+    parser.add_argument('--seed', type=int, default=1090)
+    parser.add_argument('--work-dir', default='./benchmark_data', help="where the raw and cleaned synthetic files are written")
+    parser.add_argument('--skip-ingest', action='store_true', help="reuse data loaded by an earlier run with the same seed and sizes")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="cities loaded in parallel")
+    parser.add_argument('--with-cache', action='store_true', help="keep the /search response cache enabled")
+    parser.add_argument('--output', default=None, help="results file (default <work-dir>/results/<commit>.json)")
+    parser.add_argument('--compare', default=None, help="earlier results file to compare against")
+    parser.add_argument('--host', default="localhost")
+    parser.add_argument('--user', default="postgres")
+    parser.add_argument('--password', default="toor")
+    args = parser.parse_args()
+
+    cities = SYNTHETIC_CITIES[:args.cities]
+    raw_dir = os.path.join(args.work_dir, 'raw')
+    data_dir = os.path.join(args.work_dir, 'Citywise_Data')
+    catalog = generate_data(raw_dir, cities, args.listings, args.reviews_per_listing, args.seed)
+    ingest_stats = None if args.skip_ingest else ingest(raw_dir, data_dir, args.user, args.password, args.host, args.workers)
+
+    import app
+    from search_cache import SearchCache
+    app.db_pools = PoolManager(minconn=app.POOL_MIN_SIZE, maxconn=max(app.POOL_MAX_SIZE, args.concurrency * 2), idle_timeout=app.POOL_IDLE_TIMEOUT,
+                               health_check_interval=app.POOL_HEALTH_CHECK_INTERVAL, cursor_factory=app.TimedCursor, user=args.user, password=args.password, host=args.host)
+    if not args.with_cache:
+        # Every request should reach Postgres; a zero-byte cache stores nothing
+        app.search_cache = SearchCache(max_bytes=0)
+
+    scenarios = build_scenarios(catalog, args.upload_rows)
+    selected = args.endpoints.split(',') if args.endpoints else list(scenarios)
+    endpoints = {}
+    for name in selected:
+        endpoints[name] = run_scenario(app.app, scenarios[name], args.requests, args.concurrency, args.seed)
+        stats = endpoints[name]
+        print(f"{name}: {stats['throughput']} req/s, p50 {stats['p50_ms']} ms, p95 {stats['p95_ms']} ms, p99 {stats['p99_ms']} ms, {stats['errors']} errors")
+
+    commit = current_commit()
+    results = {
+        'commit': commit,
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('password', 'output', 'compare')},
+        'ingest': ingest_stats,
+        'endpoints': endpoints,
+    }
+    output = args.output or os.path.join(args.work_dir, 'results', f"{commit or 'unknown'}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+    if args.compare:
+        compare(results, args.compare)
@@ -0,0 +1,110 @@
+import uuid
+import psycopg2
+import pytest
+from psycopg2 import extensions
+from createDBs import create_database, create_schema_if_not_exists, setup_schema_and_tables
+from db_pool import ConnectionPool, PoolManager
+from migrations import setup_shard_database
+from search_query import parse_search_filters
+
+# Scratch database for the tests that need Postgres; they are skipped when it cannot be reached
+TEST_DATABASE = 'airbnb_tests'
+TEST_CREDENTIALS = {'user': 'postgres', 'password': 'toor', 'host': 'localhost'}
+
+
+class FakeCursor:
+    def __init__(self, conn, name=None):
+        self.conn = conn
+        self.connection = conn
+        self.name = name
+        self.itersize = 2000
+        self.closed = False
+
+    def execute(self, sql, params=None):
+        self.conn.executed.append((sql, params))
+        self.conn.status = extensions.TRANSACTION_STATUS_INTRANS
+
+    def __iter__(self):
+        return iter(self.conn.rows)
+
+    def fetchall(self):
+        return list(self.conn.rows)
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FakeConnection:
+    """ Stands in for a psycopg2 connection in pool and request tests; rows is what every query returns """
+
+    def __init__(self):
+        self.closed = 0
+        self.autocommit = False
+        self.status = extensions.TRANSACTION_STATUS_IDLE
+        self.rows = []
+        self.executed = []
+        self.rollbacks = 0
+
+    def cursor(self, name=None):
+        return FakeCursor(self, name)
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.status = extensions.TRANSACTION_STATUS_IDLE
+
+    def commit(self):
+        self.status = extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def fake_pools(monkeypatch):
+    """ A PoolManager whose pools open FakeConnections """
+    monkeypatch.setattr(ConnectionPool, '_connect', lambda self: FakeConnection())
+    pools = PoolManager(minconn=0, maxconn=2, checkout_timeout=0.1)
+    yield pools
+    pools.closeall()
+
+
+@pytest.fixture
+def filters():
+    """ Builds parsed /search filters from query parameters, e.g. filters(priceMin=10, people=2) """
+    def build(**data):
+        return parse_search_filters({key: str(value) for key, value in data.items()}, require_price=False)
+    return build
+
+
+@pytest.fixture(scope='session')
+def test_database():
+    try:
+        psycopg2.connect(database='postgres', connect_timeout=3, **TEST_CREDENTIALS).close()
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"Postgres is not available: {e}")
+    create_database(TEST_DATABASE, **TEST_CREDENTIALS)
+    setup_shard_database(TEST_DATABASE, **TEST_CREDENTIALS)
+    return TEST_DATABASE
+
+@pytest.fixture
+def city_db(test_database):
+    """ A connection to the test database and a fresh city schema with every table, dropped afterwards """
+    conn = psycopg2.connect(database=test_database, **TEST_CREDENTIALS)
+    city_schema = f"test_{uuid.uuid4().hex[:12]}"
+    create_schema_if_not_exists(city_schema, conn)
+    setup_schema_and_tables(city_schema, conn)
+    yield conn, city_schema
+    conn.rollback()
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA {city_schema} CASCADE")
+    conn.commit()
+    conn.close()
@@ -1,8 +1,16 @@
 import psycopg2
-import pandas as pd
-import numpy as np  
+from psycopg2 import sql
 import json
 import os
+import io
+import csv
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from amenities import AMENITY_VOCABULARY, setup_amenity_index
+from migrations import migrate_city_schema, setup_shard_database
+from review_stats import rebuild_review_stats, recompute_review_stats
+from facets import rebuild_listing_facets
 
 def create_database(dbname, user, password, host):
     conn = psycopg2.connect(database="postgres", user=user, password=password, host=host)
@@ -31,67 +39,218 @@ def create_schema_if_not_exists(schema_name, connection):
         print(f"Failed to create or check schema {schema_name}: {e.pgerror}")
         connection.rollback()
 
-def insert_data_into_tables(city_schema, city_path, connection):
-    # Assume city_path is the directory containing both listings.csv and reviews.csv
-    listings_file = os.path.join(city_path, "listings.csv")
-    reviews_file = os.path.join(city_path, "reviews.csv")
-
-    listings_dtype_spec = {
-        'id': str,
-        'name': str,
-        'neighbourhood_cleansed': str,
-        'property_type': str,
-        'accommodates': int,
-        'bathrooms': str,
-        'beds': float,
-        'price': float,
-        'review_scores_rating': float
-    }
-
-    reviews_dtype_spec = {
-        'id': str,
-        'comments': str
-    }
+LISTINGS_COLUMNS = ['id', 'name', 'neighbourhood_cleansed', 'property_type', 'accommodates', 'bathrooms_text', 'beds', 'amenities', 'price', 'review_scores_rating']
+REVIEWS_COLUMNS = ['id', 'listing_id', 'reviewer_id', 'reviewer_name', 'comments']
 
-    try:
-        # Load and process listings data
-        df_listings = pd.read_csv(listings_file, dtype=listings_dtype_spec)
-        # Assuming 'amenities' is stored as a JSON-like string and needs special handling
-        # df_listings['amenities'] = df_listings['amenities'].apply(json.loads)
-        df_listings = df_listings.replace(np.nan, None)  # Replace NaN with None
+def copy_csv_to_staging(cur, staging_table, csv_file, required_columns):
+    """ Streams a CSV into a temporary all-TEXT staging table with COPY FROM STDIN and returns the row count """
+    with open(csv_file, newline='', encoding='utf-8') as f:
+        header = next(csv.reader(f))
+    missing = [column for column in required_columns if column not in header]
+    if missing:
+        raise ValueError(f"{csv_file} is missing columns: {', '.join(missing)}")
 
-        # Load and process reviews data
-        df_reviews = pd.read_csv(reviews_file, dtype=reviews_dtype_spec)
-        df_reviews.replace(np.nan, None)
+    cur.execute(sql.SQL("CREATE TEMP TABLE {} ({}) ON COMMIT DROP").format(
+        sql.Identifier(staging_table),
+        sql.SQL(', ').join(sql.SQL("{} TEXT").format(sql.Identifier(column)) for column in header)
+    ))
+    with open(csv_file, newline='', encoding='utf-8') as f:
+        cur.copy_expert(sql.SQL("COPY {} FROM STDIN WITH (FORMAT csv, HEADER true)").format(sql.Identifier(staging_table)).as_string(cur), f)
+    if cur.rowcount >= 0:
+        return cur.rowcount
+    cur.execute(sql.SQL("SELECT COUNT(*) FROM {}").format(sql.Identifier(staging_table)))
+    return cur.fetchone()[0]
 
-        # Insert listings data into database
-        with connection.cursor() as cur:
-            for _, row in df_listings.iterrows():
-                columns = ', '.join(row.index)
-                placeholders = ', '.join(['%s'] * len(row))
-                sql = f"INSERT INTO {city_schema}.listings ({columns}) VALUES ({placeholders}) ON CONFLICT (id) DO NOTHING;"
-                cur.execute(sql, tuple(row))
+def copy_parquet_to_staging(cur, staging_table, parquet_file, required_columns):
+    """ Streams the needed columns of a memory-mapped Parquet file into a temporary staging table and returns the row count """
+    import pyarrow.csv as pacsv
+    import pyarrow.parquet as pq
+
+    parquet = pq.ParquetFile(parquet_file, memory_map=True)
+    cur.execute(sql.SQL("CREATE TEMP TABLE {} ({}) ON COMMIT DROP").format(
+        sql.Identifier(staging_table),
+        sql.SQL(', ').join(sql.SQL("{} TEXT").format(sql.Identifier(column)) for column in required_columns)
+    ))
+    copy_sql = sql.SQL("COPY {} FROM STDIN WITH (FORMAT csv)").format(sql.Identifier(staging_table)).as_string(cur)
+    rows = 0
+    for batch in parquet.iter_batches(columns=required_columns):
+        buffer = io.BytesIO()
+        pacsv.write_csv(batch, buffer, write_options=pacsv.WriteOptions(include_header=False))
+        buffer.seek(0)
+        cur.copy_expert(copy_sql, buffer)
+        rows += batch.num_rows
+    return rows
+
+def city_data_format(city_path):
+    """ Returns 'parquet' or 'csv' according to the manifest written by filterData.py """
+    return read_city_manifest(city_path).get('format', 'csv')
+
+def read_city_manifest(city_path):
+    """ Returns the manifest.json written by filterData.py, or an empty dict """
+    manifest_path = os.path.join(city_path, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            return json.load(f)
+    return {}
+
+def copy_to_staging(cur, staging_table, city_path, table_name, required_columns):
+    if city_data_format(city_path) == 'parquet':
+        return copy_parquet_to_staging(cur, staging_table, os.path.join(city_path, f"{table_name}.parquet"), required_columns)
+    return copy_csv_to_staging(cur, staging_table, os.path.join(city_path, f"{table_name}.csv"), required_columns)
 
+def insert_data_into_tables(city_schema, city_path, connection, incremental=False):
+    """ Bulk loads a city's listings and reviews through staging tables; returns load statistics and re-raises on failure
+
+    Every loaded row carries a row_hash of its content. In incremental mode rows whose hash changed are updated and
+    source rows missing from the new files are deleted; rows added through the app (row_hash NULL) are left alone.
+    """
+    # Assume city_path is the directory containing both listings and reviews, as CSV or Parquet
+    if incremental:
+        listings_conflict = """DO UPDATE SET name = EXCLUDED.name, neighbourhood_cleansed = EXCLUDED.neighbourhood_cleansed,
+                    property_type = EXCLUDED.property_type, accommodates = EXCLUDED.accommodates, bathrooms_text = EXCLUDED.bathrooms_text,
+                    beds = EXCLUDED.beds, amenities = EXCLUDED.amenities, price = EXCLUDED.price,
+                    review_scores_rating = EXCLUDED.review_scores_rating, amenity_tags = EXCLUDED.amenity_tags, row_hash = EXCLUDED.row_hash
+                    WHERE {table}.row_hash IS DISTINCT FROM EXCLUDED.row_hash"""
+        reviews_conflict = """DO UPDATE SET reviewer_id = EXCLUDED.reviewer_id, reviewer_name = EXCLUDED.reviewer_name,
+                    comments = EXCLUDED.comments, row_hash = EXCLUDED.row_hash
+                    WHERE {table}.row_hash IS DISTINCT FROM EXCLUDED.row_hash"""
+    else:
+        listings_conflict = reviews_conflict = "DO NOTHING"
+
+    start = time.perf_counter()
+    stats = {'deleted_listings': 0, 'deleted_reviews': 0}
+    try:
+        with connection.cursor() as cur:
+            if incremental:
+                # Listings whose reviews changed, so only their review aggregates are recomputed
+                cur.execute("CREATE TEMP TABLE affected_listings (listing_id BIGINT) ON COMMIT DROP")
+            listings_rows = copy_to_staging(cur, "staging_listings", city_path, "listings", LISTINGS_COLUMNS)
+            # Ids may be float-formatted ('123.0'); amenity_tags mirrors amenities.amenity_tags
+            cur.execute(f"""
+                WITH source AS (
+                    SELECT DISTINCT ON (id::numeric::bigint) id::numeric::bigint AS id, name, neighbourhood_cleansed, property_type,
+                           accommodates::numeric::int AS accommodates, bathrooms_text, beds::float AS beds, amenities,
+                           price::float AS price, review_scores_rating::float AS review_scores_rating
+                    FROM staging_listings ORDER BY id::numeric::bigint
+                ), upserted AS (
+                    INSERT INTO {city_schema}.listings (id, name, neighbourhood_cleansed, property_type, accommodates, bathrooms_text, beds, amenities, price, review_scores_rating, amenity_tags, row_hash)
+                    SELECT id, name, neighbourhood_cleansed, property_type, accommodates, bathrooms_text, beds, amenities, price, review_scores_rating,
+                           ARRAY(SELECT term FROM unnest(%s::text[]) AS term WHERE amenities LIKE '%%' || term || '%%'),
+                           md5(ROW(name, neighbourhood_cleansed, property_type, accommodates, bathrooms_text, beds, amenities, price, review_scores_rating)::text)
+                    FROM source
+                    ON CONFLICT (id) {listings_conflict.format(table=f"{city_schema}.listings")}
+                    RETURNING (xmax = 0) AS inserted
+                )
+                SELECT COUNT(*) FILTER (WHERE inserted), COUNT(*) FILTER (WHERE NOT inserted) FROM upserted;
+            """, (AMENITY_VOCABULARY,))
+            stats['inserted_listings'], stats['updated_listings'] = cur.fetchone()
+            if incremental:
+                cur.execute(f"""
+                    WITH deleted AS (
+                        DELETE FROM {city_schema}.listings l
+                        WHERE l.row_hash IS NOT NULL
+                        AND NOT EXISTS (SELECT 1 FROM staging_listings st WHERE st.id::numeric::bigint = l.id)
+                        RETURNING l.id
+                    ), unlinked AS (
+                        DELETE FROM {city_schema}.listings_reviews lr USING deleted d WHERE lr.listing_id = d.id
+                        RETURNING lr.listing_id
+                    ), affected AS (
+                        INSERT INTO affected_listings SELECT listing_id FROM unlinked
+                    )
+                    SELECT COUNT(*) FROM deleted;
+                """)
+                stats['deleted_listings'] = cur.fetchone()[0]
             print("Listings data inserted successfully.")
-            
-            for _, row in df_reviews.iterrows():
-                cur.execute(f"INSERT INTO {city_schema}.reviews (id, reviewer_id, reviewer_name, comments) VALUES (%s, %s, %s, %s) ON CONFLICT (id) DO NOTHING;", (row['id'], row['reviewer_id'], row['reviewer_name'], row['comments']))
-                
-                cur.execute(f"INSERT INTO {city_schema}.listings_reviews (listing_id, review_id) VALUES (%s, %s) ON CONFLICT DO NOTHING;", (row['listing_id'], row['id']))
-            
+
+            reviews_rows = copy_to_staging(cur, "staging_reviews", city_path, "reviews", REVIEWS_COLUMNS)
+            # Updated comments change the comment-length aggregate of the listings they belong to
+            updated_reviews = f"""
+                , changed AS (
+                    INSERT INTO affected_listings
+                    SELECT lr.listing_id FROM upserted u INNER JOIN {city_schema}.listings_reviews lr ON lr.review_id = u.id
+                    WHERE NOT u.inserted
+                )""" if incremental else ""
+            cur.execute(f"""
+                WITH source AS (
+                    SELECT DISTINCT ON (id) id, reviewer_id, reviewer_name, comments FROM staging_reviews ORDER BY id
+                ), upserted AS (
+                    INSERT INTO {city_schema}.reviews (id, reviewer_id, reviewer_name, comments, row_hash)
+                    SELECT id, reviewer_id, reviewer_name, comments, md5(ROW(reviewer_id, reviewer_name, comments)::text)
+                    FROM source
+                    ON CONFLICT (id) {reviews_conflict.format(table=f"{city_schema}.reviews")}
+                    RETURNING id, (xmax = 0) AS inserted
+                ){updated_reviews}
+                SELECT COUNT(*) FILTER (WHERE inserted), COUNT(*) FILTER (WHERE NOT inserted) FROM upserted;
+            """)
+            stats['inserted_reviews'], stats['updated_reviews'] = cur.fetchone()
+            if incremental:
+                cur.execute(f"""
+                    WITH deleted AS (
+                        DELETE FROM {city_schema}.reviews r
+                        WHERE r.row_hash IS NOT NULL
+                        AND NOT EXISTS (SELECT 1 FROM staging_reviews st WHERE st.id = r.id)
+                        RETURNING r.id
+                    ), unlinked AS (
+                        DELETE FROM {city_schema}.listings_reviews lr USING deleted d WHERE lr.review_id = d.id
+                        RETURNING lr.listing_id
+                    ), affected AS (
+                        INSERT INTO affected_listings SELECT listing_id FROM unlinked
+                    )
+                    SELECT COUNT(*) FROM deleted;
+                """)
+                stats['deleted_reviews'] = cur.fetchone()[0]
+                # Reviews that moved to another listing in the source
+                cur.execute(f"""
+                    WITH moved AS (
+                        DELETE FROM {city_schema}.listings_reviews lr USING staging_reviews st
+                        WHERE lr.review_id = st.id AND lr.listing_id <> st.listing_id::numeric::bigint
+                        RETURNING lr.listing_id
+                    )
+                    INSERT INTO affected_listings SELECT listing_id FROM moved;
+                """)
+                cur.execute(f"""
+                    WITH linked AS (
+                        INSERT INTO {city_schema}.listings_reviews (listing_id, review_id)
+                        SELECT listing_id::numeric::bigint, id FROM staging_reviews
+                        ON CONFLICT DO NOTHING
+                        RETURNING listing_id
+                    )
+                    INSERT INTO affected_listings SELECT listing_id FROM linked;
+                """)
+            else:
+                cur.execute(f"""
+                    INSERT INTO {city_schema}.listings_reviews (listing_id, review_id)
+                    SELECT listing_id::numeric::bigint, id FROM staging_reviews
+                    ON CONFLICT DO NOTHING;
+                """)
             print("Reviews data inserted successfully.")
-            
+            if incremental:
+                cur.execute("SELECT DISTINCT listing_id FROM affected_listings")
+                recompute_review_stats(cur, city_schema, [row[0] for row in cur.fetchall()])
+            else:
+                rebuild_review_stats(cur, city_schema)
+            rebuild_listing_facets(cur, city_schema)
+
             connection.commit()
 
     except Exception as e:
         print(f"Failed to insert data into database: {e}")
         connection.rollback()  # Roll back the transaction on error
+        raise
+
+    elapsed = time.perf_counter() - start
+    rows = listings_rows + reviews_rows
+    rows_per_sec = rows / elapsed if elapsed > 0 else 0.0
+    print(f"Loaded {city_schema}: {listings_rows} listings, {reviews_rows} reviews in {elapsed:.1f}s ({rows_per_sec:,.0f} rows/sec); "
+          f"listings +{stats['inserted_listings']} ~{stats['updated_listings']} -{stats['deleted_listings']}, "
+          f"reviews +{stats['inserted_reviews']} ~{stats['updated_reviews']} -{stats['deleted_reviews']}")
+    return {'listings': listings_rows, 'reviews': reviews_rows, 'seconds': elapsed, 'rows_per_sec': rows_per_sec, **stats}
 
 def setup_schema_and_tables(city_schema, connection):
     with connection.cursor() as cursor:
         cursor.execute(f"""
             CREATE TABLE IF NOT EXISTS {city_schema}.listings (
-                id TEXT PRIMARY KEY,
+                id BIGINT PRIMARY KEY,
                 name TEXT,
                 neighbourhood_cleansed VARCHAR(255),
                 property_type VARCHAR(255), 
@@ -100,24 +259,29 @@ def setup_schema_and_tables(city_schema, connection):
                 beds FLOAT, 
                 amenities TEXT, 
                 price FLOAT, 
-                review_scores_rating FLOAT
+                review_scores_rating FLOAT,
+                amenity_tags TEXT[],
+                row_hash TEXT
             );
             CREATE TABLE IF NOT EXISTS {city_schema}.reviews (
                 id TEXT PRIMARY KEY,
                 reviewer_id TEXT,
                 reviewer_name TEXT,
-                comments TEXT
+                comments TEXT,
+                row_hash TEXT
             );
             CREATE TABLE IF NOT EXISTS {city_schema}.listings_reviews (
-                listing_id TEXT,
+                listing_id BIGINT,
                 review_id TEXT,
                 PRIMARY KEY (listing_id, review_id)
             );
         """)
+        setup_amenity_index(cursor, city_schema)
+        migrate_city_schema(cursor, city_schema)
         connection.commit()
         print(f"Tables created or already exist in schema {city_schema}")
 
-def create_cities_table(dbname, user, password, host):
+def create_cities_table(dbname, user, password, host, directory_path='Citywise_Data'):
     try:
         conn = psycopg2.connect(database=dbname, user=user, password=password, host=host)
         cursor = conn.cursor()
@@ -128,6 +292,14 @@ def create_cities_table(dbname, user, password, host):
                 db_name VARCHAR(255)
             )
         """)
+        # Last version of each city's data applied by an (incremental) refresh
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS city_refresh_manifest (
+                city_name VARCHAR(255) PRIMARY KEY,
+                content_hash TEXT,
+                applied_at TIMESTAMPTZ DEFAULT now()
+            )
+        """)
 
         # Loop through files in the directory
         for folder_name in os.listdir(directory_path):
@@ -148,7 +320,114 @@ def create_cities_table(dbname, user, password, host):
     except Exception as e:
         print(f"Failed to insert data into the city database: {e}")
 
+def get_applied_versions(user, password, host):
+    """ Returns city_name -> content_hash of the last applied refresh """
+    conn = psycopg2.connect(database="cities", user=user, password=password, host=host)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT city_name, content_hash FROM city_refresh_manifest")
+            return dict(cursor.fetchall())
+    finally:
+        conn.close()
+
+def record_applied_version(city, content_hash, user, password, host):
+    conn = psycopg2.connect(database="cities", user=user, password=password, host=host)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO city_refresh_manifest (city_name, content_hash, applied_at) VALUES (%s, %s, now())
+                ON CONFLICT (city_name) DO UPDATE SET content_hash = EXCLUDED.content_hash, applied_at = EXCLUDED.applied_at
+            """, (city, content_hash))
+        conn.commit()
+    finally:
+        conn.close()
+
+def ingest_city(city, city_path, city_db_name, user, password, host, incremental=False):
+    """ Worker entry point: sets up one city's schema in its shard database and bulk loads it """
+    city_schema = city.lower().replace(' ', '_').replace('-', '_')
+    conn = psycopg2.connect(database=city_db_name, user=user, password=password, host=host)
+    try:
+        # Ensure the schema exists
+        create_schema_if_not_exists(city_schema, conn)
+
+        setup_schema_and_tables(city_schema, conn)  # Setup tables in the new city database
+
+        return insert_data_into_tables(city_schema, city_path, conn, incremental)
+    finally:
+        conn.close()
+
+def ingest_all_cities(directory_path, user, password, host, workers=None, per_shard_limit=1, incremental=False):
+    """ Loads every city directory concurrently, running at most per_shard_limit cities per shard database at once
+
+    In incremental mode cities whose content hash matches city_refresh_manifest are skipped and the rest are diffed.
+    """
+    cities = sorted(city for city in os.listdir(directory_path) if os.path.isdir(os.path.join(directory_path, city)))
+    content_hashes = {city: read_city_manifest(os.path.join(directory_path, city)).get('content_hash') for city in cities}
+    if incremental:
+        applied = get_applied_versions(user, password, host)
+        unchanged = [city for city in cities if content_hashes[city] and applied.get(city) == content_hashes[city]]
+        for city in unchanged:
+            print(f"Skipping {city}: already at version {content_hashes[city][:12]}")
+        cities = [city for city in cities if city not in unchanged]
+
+    # Databases and their extensions are created up front so workers never race on CREATE DATABASE or CREATE EXTENSION
+    pending = {}
+    for city in cities:
+        city_db_name = city[0].lower()
+        if city_db_name not in pending:
+            create_database(city_db_name, user, password, host)  # Create a new database for each shard
+            setup_shard_database(city_db_name, user, password, host)
+            pending[city_db_name] = []
+        pending[city_db_name].append(city)
+
+    running = {}  # future -> (city, shard)
+    in_flight = {shard: 0 for shard in pending}
+    results = {}
+    total_rows = 0
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        def submit_ready():
+            for shard, queue in pending.items():
+                while queue and in_flight[shard] < per_shard_limit:
+                    city = queue.pop(0)
+                    future = executor.submit(ingest_city, city, os.path.join(directory_path, city), shard, user, password, host, incremental)
+                    running[future] = (city, shard)
+                    in_flight[shard] += 1
+
+        submit_ready()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                city, shard = running.pop(future)
+                in_flight[shard] -= 1
+                try:
+                    stats = future.result()
+                    results[city] = {'success': True, **stats}
+                    total_rows += stats['listings'] + stats['reviews']
+                    if content_hashes[city]:
+                        record_applied_version(city, content_hashes[city], user, password, host)
+                    status = f"ok, {stats['listings'] + stats['reviews']} rows at {stats['rows_per_sec']:,.0f} rows/sec"
+                except Exception as e:
+                    results[city] = {'success': False, 'error': str(e)}
+                    status = f"FAILED: {e}"
+                elapsed = time.perf_counter() - start
+                print(f"[{len(results)}/{len(cities)}] {city} ({shard}): {status} | overall {total_rows / elapsed if elapsed > 0 else 0:,.0f} rows/sec")
+            submit_ready()
+
+    failed = [city for city, result in results.items() if not result['success']]
+    print(f"Ingest finished in {time.perf_counter() - start:.1f}s: {len(cities) - len(failed)} succeeded, {len(failed)} failed")
+    for city in failed:
+        print(f"  {city}: {results[city]['error']}")
+    return results
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create the city databases and load Citywise_Data into them")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="number of cities loaded in parallel")
+    parser.add_argument('--per-shard', type=int, default=1, help="maximum cities loaded at once into the same shard database")
+    parser.add_argument('--incremental', action='store_true', help="skip unchanged cities and apply only inserted, updated and deleted rows")
+    args = parser.parse_args()
+
     # Database connection parameters
     host = "localhost"
     user = "postgres"
@@ -157,24 +436,6 @@ if __name__ == "__main__":
     directory_path = 'Citywise_Data'
 
     create_database("cities", user, password, host)
-    create_cities_table("cities", user, password, host)
-
-    for city in os.listdir(directory_path):
-        city_path = os.path.join(directory_path, city)
-        if os.path.isdir(city_path):
-            city_db_name = city[0].lower()
-            city_schema = city.lower().replace(' ', '_').replace('-', '_')
-            create_database(city_db_name, user, password, host)  # Create a new database for each city
-
-            # Connect to the city's database
-            conn = psycopg2.connect(database=city_db_name, user=user, password=password, host=host)
-            
-            # Ensure the schema exists
-            create_schema_if_not_exists(city_schema, conn)
-            
-            setup_schema_and_tables(city_schema, conn)  # Setup tables in the new city database
-            
-            # Insert data into tables (needs to be implemented similarly to existing code)
-            insert_data_into_tables(city_schema, city_path, conn)
-            
-            conn.close()
\ No newline at end of file
+    create_cities_table("cities", user, password, host, directory_path)
+
+    ingest_all_cities(directory_path, user, password, host, workers=args.workers, per_shard_limit=args.per_shard, incremental=args.incremental)
@@ -0,0 +1,235 @@
+import threading
+import time
+import psycopg2
+from psycopg2 import extensions
+
+
+class PoolExhausted(Exception):
+    """ Raised when no connection becomes available before the checkout timeout """
+
+
+class ConnectionPool:
+    """ Thread-safe pool of connections to a single database with health checks and idle eviction """
+
+    def __init__(self, db_name, minconn=1, maxconn=10, idle_timeout=300, health_check_interval=30, checkout_timeout=10, **connect_kwargs):
+        self.db_name = db_name
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.checkout_timeout = checkout_timeout
+        self.connect_kwargs = connect_kwargs
+
+        self._lock = threading.Condition()
+        self._idle = []  # list of (connection, returned_at), most recently used last
+        self._in_use = set()
+        self._returning = set()  # connections being rolled back by putconn
+        self._connecting = 0  # slots reserved by checkouts that are opening a connection
+        self.stats_counters = {'checkouts': 0, 'created': 0, 'evicted': 0, 'health_check_failures': 0, 'waits': 0, 'timeouts': 0}
+
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+            self.stats_counters['created'] += 1
+
+    def _connect(self):
+        return psycopg2.connect(database=self.db_name, **self.connect_kwargs)
+
+    def _is_healthy(self, conn, returned_at):
+        if conn.closed:
+            return False
+        if time.monotonic() - returned_at < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self, timeout=None):
+        """ Checks out a connection, reusing an idle one when possible
+
+        Only the bookkeeping happens under the lock: a slot is reserved first and the connect or health
+        check round trip runs outside it, so a slow database does not hold up other checkouts and returns.
+        """
+        timeout = self.checkout_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                self._evict_idle_locked()
+                while True:
+                    if self._idle:
+                        conn, returned_at = self._idle.pop()
+                        self._in_use.add(conn)
+                        break
+                    if len(self._in_use) + self._connecting < self.maxconn:
+                        conn, returned_at = None, None
+                        self._connecting += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.stats_counters['timeouts'] += 1
+                        raise PoolExhausted(f"No free connection to {self.db_name} after {timeout}s")
+                    self.stats_counters['waits'] += 1
+                    self._lock.wait(remaining)
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._connecting -= 1
+                        self._lock.notify()
+                    raise
+                with self._lock:
+                    self._connecting -= 1
+                    self._in_use.add(conn)
+                    self.stats_counters['created'] += 1
+                    self.stats_counters['checkouts'] += 1
+                return conn
+
+            if self._is_healthy(conn, returned_at):
+                with self._lock:
+                    self.stats_counters['checkouts'] += 1
+                return conn
+            self._close_quietly(conn)
+            with self._lock:
+                self._in_use.discard(conn)
+                self.stats_counters['health_check_failures'] += 1
+                self._lock.notify()
+
+    def putconn(self, conn, close=False):
+        """ Returns a connection to the pool, discarding it if it is broken """
+        with self._lock:
+            if conn not in self._in_use or conn in self._returning:
+                return
+            # Still counted as in use while it is rolled back outside the lock
+            self._returning.add(conn)
+        if not close and not conn.closed:
+            try:
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+            except psycopg2.Error:
+                close = True
+        if close or conn.closed:
+            self._close_quietly(conn)
+        with self._lock:
+            self._returning.discard(conn)
+            self._in_use.discard(conn)
+            if not (close or conn.closed):
+                self._idle.append((conn, time.monotonic()))
+            self._lock.notify()
+
+    def _evict_idle_locked(self):
+        now = time.monotonic()
+        total = len(self._idle) + len(self._in_use)
+        kept = []
+        # Oldest connections sit at the front of the list
+        for conn, returned_at in self._idle:
+            if total > self.minconn and now - returned_at > self.idle_timeout:
+                self._close_quietly(conn)
+                self.stats_counters['evicted'] += 1
+                total -= 1
+            else:
+                kept.append((conn, returned_at))
+        self._idle = kept
+
+    def evict_idle(self):
+        """ Closes connections that have sat idle longer than idle_timeout, keeping at least minconn """
+        with self._lock:
+            self._evict_idle_locked()
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def closeall(self):
+        with self._lock:
+            for conn, _ in self._idle:
+                self._close_quietly(conn)
+            for conn in self._in_use:
+                self._close_quietly(conn)
+            self._idle = []
+            self._in_use = set()
+
+    def stats(self):
+        with self._lock:
+            in_use = len(self._in_use)
+            return {
+                'db_name': self.db_name,
+                'in_use': in_use,
+                'idle': len(self._idle),
+                'max_size': self.maxconn,
+                'utilization': in_use / self.maxconn if self.maxconn else 0.0,
+                **self.stats_counters,
+            }
+
+
+class PoolManager:
+    """ Keeps one ConnectionPool per shard database, created lazily on first checkout """
+
+    def __init__(self, minconn=1, maxconn=10, idle_timeout=300, health_check_interval=30, checkout_timeout=10, **connect_kwargs):
+        self.pool_kwargs = {
+            'minconn': minconn,
+            'maxconn': maxconn,
+            'idle_timeout': idle_timeout,
+            'health_check_interval': health_check_interval,
+            'checkout_timeout': checkout_timeout,
+        }
+        self.connect_kwargs = connect_kwargs
+        self._pools = {}
+        self._owners = {}
+        self._lock = threading.Lock()
+
+    def get_pool(self, db_name):
+        with self._lock:
+            pool = self._pools.get(db_name)
+        if pool is not None:
+            return pool
+        # Opening minconn connections can be slow, so it happens outside the lock every shard's checkouts and returns need
+        pool = ConnectionPool(db_name, **self.pool_kwargs, **self.connect_kwargs)
+        with self._lock:
+            existing = self._pools.setdefault(db_name, pool)
+        if existing is not pool:
+            # Another request created this shard's pool first
+            pool.closeall()
+        return existing
+
+    def getconn(self, db_name, timeout=None):
+        pool = self.get_pool(db_name)
+        conn = pool.getconn(timeout)
+        with self._lock:
+            self._owners[id(conn)] = pool
+        return conn
+
+    def putconn(self, conn, close=False):
+        with self._lock:
+            pool = self._owners.pop(id(conn), None)
+        if pool is None:
+            # Already returned (or never checked out from here); nothing to do
+            return
+        pool.putconn(conn, close=close)
+
+    def evict_idle(self):
+        with self._lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            pool.evict_idle()
+
+    def closeall(self):
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools = {}
+            self._owners = {}
+        for pool in pools:
+            pool.closeall()
+
+    def stats(self):
+        with self._lock:
+            pools = list(self._pools.values())
+        return {pool.db_name: pool.stats() for pool in pools}
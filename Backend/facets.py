@@ -0,0 +1,148 @@
+import math
+from amenities import AMENITY_VOCABULARY
+from search_query import StatementBuilder, search_conditions, where_sql
+
+# Facet counts for the search page kept in <city>.listing_facet_counts: for every facet value (property type,
+# neighbourhood, amenity tag, plus a 'total' row) the number of listings per price bucket. The table is a few
+# rows per facet value, so unfiltered and price-filtered /facets requests (the page's initial state and its
+# price slider) sum a small table instead of scanning listings. Other filters are not in the summary and
+# aggregate the matching listings directly. Rebuilt after a bulk load; /insert adds new listings incrementally.
+
+# Width of the price histogram buckets
+FACET_PRICE_BUCKET = 50
+
+PRICE_BUCKET_SQL = f"floor(l.price / {FACET_PRICE_BUCKET})::int"
+
+# One (facet, value) row per listing attribute; amenity_tags only holds AMENITY_VOCABULARY terms
+LISTING_FACET_VALUES_SQL = """CROSS JOIN LATERAL (
+            SELECT 'total' AS facet, '' AS value
+            UNION ALL SELECT 'property_type', COALESCE(l.property_type, '')
+            UNION ALL SELECT 'neighbourhood', COALESCE(l.neighbourhood_cleansed, '')
+            UNION ALL SELECT 'amenity', tag FROM unnest(l.amenity_tags) AS tag
+        ) f"""
+
+def listing_facet_rows_sql(city_schema):
+    """ (facet, value, priced, price_bucket) per listing and facet value; unpriced listings use bucket 0 """
+    return (f"SELECT f.facet, f.value, l.price IS NOT NULL AS priced, COALESCE({PRICE_BUCKET_SQL}, 0) AS price_bucket"
+            f" FROM {city_schema}.listings l {LISTING_FACET_VALUES_SQL}")
+
+def setup_listing_facets(cursor, city_schema):
+    cursor.execute(f"""
+        DROP TABLE IF EXISTS {city_schema}.listing_facets;
+        CREATE TABLE IF NOT EXISTS {city_schema}.listing_facet_counts (
+            facet TEXT NOT NULL,
+            value TEXT NOT NULL,
+            priced BOOLEAN NOT NULL,
+            price_bucket INT NOT NULL,
+            listing_count INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (facet, value, priced, price_bucket)
+        );
+    """)
+
+def rebuild_listing_facets(cursor, city_schema):
+    """ Recomputes the facet summary of a city from its listings, e.g. after a bulk load """
+    # DELETE rather than TRUNCATE so concurrent /facets requests keep reading the old rows until commit
+    cursor.execute(f"""
+        DELETE FROM {city_schema}.listing_facet_counts;
+        INSERT INTO {city_schema}.listing_facet_counts (facet, value, priced, price_bucket, listing_count)
+        SELECT facet, value, priced, price_bucket, COUNT(*)
+        FROM ({listing_facet_rows_sql(city_schema)}) rows
+        GROUP BY facet, value, priced, price_bucket;
+    """)
+
+def record_listing_facets(cursor, city_schema, listing_id):
+    """ Adds a newly inserted listing to the facet summary """
+    cursor.execute(f"""
+        INSERT INTO {city_schema}.listing_facet_counts AS c (facet, value, priced, price_bucket, listing_count)
+        SELECT facet, value, priced, price_bucket, COUNT(*)
+        FROM ({listing_facet_rows_sql(city_schema)} WHERE l.id = %s) rows
+        GROUP BY facet, value, priced, price_bucket
+        ON CONFLICT (facet, value, priced, price_bucket) DO UPDATE SET listing_count = c.listing_count + EXCLUDED.listing_count
+    """, (listing_id,))
+
+
+def summary_answers(filters):
+    return not (filters['name'] or filters['amenities'] or filters['bedrooms'] is not None
+                or filters['people'] is not None or filters['rating'] is not None)
+
+def price_bucket_range(filters):
+    """ First and last price bucket lying entirely inside the price bounds (None for an open side)
+
+    The first bucket starts after price_min and the last ends at or below price_max, so floating point
+    rounding can only move a listing to the edge side, which is read from listings.
+    """
+    first = math.floor(filters['price_min'] / FACET_PRICE_BUCKET) + 1 if filters['price_min'] is not None else None
+    last = math.floor(filters['price_max'] / FACET_PRICE_BUCKET) - 1 if filters['price_max'] is not None else None
+    return first, last
+
+def facet_statement(city_schema, filters):
+    """ Facet counts of the listings matching the filters, as (facet, value, count) rows
+
+    Without filters, or with only price bounds, whole price buckets inside the bounds come from
+    listing_facet_counts and only listings in the partially covered edge buckets are read from listings,
+    so the counts stay exact. Any other filter aggregates the matching listings directly.
+    """
+    builder = StatementBuilder()
+    listing_rows = f"SELECT f.facet, f.value, l.price IS NOT NULL, COALESCE({PRICE_BUCKET_SQL}, 0), 1 FROM {city_schema}.listings l {LISTING_FACET_VALUES_SQL}"
+    if not summary_answers(filters):
+        matched = listing_rows + where_sql(search_conditions(builder, filters))
+        return builder.statement(facet_aggregate_sql(matched)), 'listings'
+
+    first, last = price_bucket_range(filters)
+    if first is not None and last is not None and first > last:
+        # The bounds do not cover a whole bucket
+        matched = listing_rows + where_sql(search_conditions(builder, filters))
+        return builder.statement(facet_aggregate_sql(matched)), 'listings'
+
+    summary_conditions = []
+    edge_conditions = []
+    if filters['price_min'] is not None or filters['price_max'] is not None:
+        summary_conditions.append("priced")
+    # Each edge also gets a price range containing its buckets, so the price index only reads the edge listings;
+    # the upper one starts a unit lower in case price / FACET_PRICE_BUCKET rounds up to the bucket boundary
+    if first is not None:
+        bucket = builder.param(first, 'int4')
+        summary_conditions.append(f"price_bucket >= {bucket}")
+        edge_conditions.append(f"price < {builder.param(first * FACET_PRICE_BUCKET, 'float8')} AND {PRICE_BUCKET_SQL} < {bucket}")
+    if last is not None:
+        bucket = builder.param(last, 'int4')
+        summary_conditions.append(f"price_bucket <= {bucket}")
+        edge_conditions.append(f"price > {builder.param((last + 1) * FACET_PRICE_BUCKET - 1, 'float8')} AND {PRICE_BUCKET_SQL} > {bucket}")
+
+    matched = (f"SELECT facet, value, priced, price_bucket, listing_count FROM {city_schema}.listing_facet_counts"
+               + where_sql(summary_conditions))
+    conditions = search_conditions(builder, filters)
+    for edge in edge_conditions:
+        # The edges are disjoint since first <= last
+        matched += " UNION ALL " + listing_rows + where_sql(conditions + [edge])
+    return builder.statement(facet_aggregate_sql(matched)), 'summary'
+
+def facet_aggregate_sql(matched):
+    return f"""
+        WITH matched (facet, value, priced, price_bucket, listing_count) AS ({matched})
+        SELECT facet, value, SUM(listing_count) FROM matched WHERE facet <> 'total' GROUP BY facet, value
+        UNION ALL SELECT 'price_bucket', price_bucket::text, SUM(listing_count) FROM matched WHERE facet = 'total' AND priced GROUP BY price_bucket
+        UNION ALL SELECT 'total', '', COALESCE(SUM(listing_count), 0) FROM matched WHERE facet = 'total'
+    """
+
+def facet_counts(rows, source):
+    """ Builds the /facets response from (facet, value, count) rows; listings missing an attribute only count towards total """
+    facets = {'total': 0, 'property_types': {}, 'neighbourhoods': {}, 'amenities': {}, 'price_histogram': [], 'source': source}
+    for facet, value, count in rows:
+        count = int(count)
+        if facet == 'total':
+            facets['total'] = count
+        elif facet == 'property_type':
+            if value:
+                facets['property_types'][value] = count
+        elif facet == 'neighbourhood':
+            if value:
+                facets['neighbourhoods'][value] = count
+        elif facet == 'price_bucket':
+            bucket = int(value)
+            facets['price_histogram'].append({'min': bucket * FACET_PRICE_BUCKET, 'max': (bucket + 1) * FACET_PRICE_BUCKET, 'count': count})
+        elif facet == 'amenity':
+            if value in AMENITY_VOCABULARY and count:
+                facets['amenities'][value] = count
+    facets['price_histogram'].sort(key=lambda bucket: bucket['min'])
+    return facets
@@ -1,27 +1,125 @@
 import os
+import time
+import json
+import hashlib
+import argparse
 import pandas as pd
 
-def is_ascii(s):
-    try:
-        s.encode(encoding='ascii')
-    except UnicodeEncodeError:
-        return False
+# Rows read per chunk; peak memory depends on this rather than on the size of a city's files
+CHUNK_SIZE = 100_000
+
+LISTINGS_COLUMNS = ['id', 'name', 'neighbourhood_cleansed', 'property_type', 'accommodates', 'bathrooms_text', 'beds', 'amenities', 'price', 'review_scores_rating']
+REVIEWS_COLUMNS = ['id', 'listing_id', 'reviewer_id','reviewer_name', 'comments']
+
+# Column types of the Parquet output; ids stay text so large ids keep full precision
+LISTINGS_TYPES = {'id': 'string', 'name': 'string', 'neighbourhood_cleansed': 'string', 'property_type': 'string', 'accommodates': 'int64',
+                  'bathrooms_text': 'string', 'beds': 'float64', 'amenities': 'string', 'price': 'float64', 'review_scores_rating': 'float64'}
+REVIEWS_TYPES = {'id': 'string', 'listing_id': 'string', 'reviewer_id': 'string', 'reviewer_name': 'string', 'comments': 'string'}
+
+def ascii_mask(df):
+    """ True for rows whose every value can be encoded as ASCII """
+    mask = pd.Series(True, index=df.index)
+    for column in df.columns:
+        values = df[column]
+        if not pd.api.types.is_numeric_dtype(values):
+            mask &= ~values.str.contains(r'[^\x00-\x7f]', regex=True, na=False)
+    return mask
+
+def numeric_mask(series):
+    """ True where the value parses as a number """
+    return pd.to_numeric(series, errors='coerce').notna()
+
+def clean_listings_chunk(df):
+    # Remove $ sign from price and convert to float
+    df['price'] = pd.to_numeric(df['price'].str.replace(r'[\$,]', '', regex=True), errors='coerce').astype(float)
+    df = df[numeric_mask(df['id'])]  # Ensure id is numeric
+    return df[ascii_mask(df)]
+
+def clean_reviews_chunk(df):
+    df = df[numeric_mask(df['listing_id']) & numeric_mask(df['id'])]  # Ensure listing_id and id are numeric
+    return df[ascii_mask(df)]
+
+def arrow_schema(types):
+    import pyarrow as pa
+    return pa.schema([(column, getattr(pa, type_name)()) for column, type_name in types.items()])
+
+def to_arrow_table(df, types):
+    """ Casts a cleaned chunk to the fixed Parquet schema """
+    import pyarrow as pa
+    df = df.copy()
+    for column, type_name in types.items():
+        if type_name == 'float64':
+            df[column] = pd.to_numeric(df[column], errors='coerce').astype(float)
+        elif type_name == 'int64':
+            df[column] = pd.to_numeric(df[column], errors='coerce').astype('Int64')
+        else:
+            df[column] = df[column].astype(object).where(df[column].notna(), None)
+    return pa.Table.from_pandas(df, schema=arrow_schema(types), preserve_index=False)
+
+def clean_csv(source_path, dest_path, columns, clean_chunk, types=None):
+    """ Cleans a CSV chunk by chunk, appending each cleaned chunk to dest_path; returns (rows_in, rows_out)
+
+    With types given the output is Parquet with that schema, one row group per chunk, instead of CSV.
+    """
+    start = time.perf_counter()
+    rows_in = rows_out = 0
+    tmp_path = dest_path + '.tmp'
+    # Everything is read as text so ids and other columns are written back exactly as they came in
+    chunks = pd.read_csv(source_path, usecols=columns, dtype=str, chunksize=CHUNK_SIZE)
+    if types is None:
+        with open(tmp_path, 'w', newline='', encoding='utf-8') as out:
+            header = True
+            for chunk in chunks:
+                rows_in += len(chunk)
+                chunk = clean_chunk(chunk[columns])
+                rows_out += len(chunk)
+                chunk.to_csv(out, index=False, header=header)
+                header = False
+            if header:
+                pd.DataFrame(columns=columns).to_csv(out, index=False)
     else:
-        return True
-    
-def is_numeric(id):
-    """Check if the id is a numeric value."""
-    try:
-        float(id)  # Try converting to float
-        return True
-    except ValueError:
-        return False
-    
-def process_and_save_files(source_directory, destination_directory):
+        import pyarrow.parquet as pq
+        with pq.ParquetWriter(tmp_path, arrow_schema(types)) as writer:
+            for chunk in chunks:
+                rows_in += len(chunk)
+                chunk = clean_chunk(chunk[columns])
+                rows_out += len(chunk)
+                writer.write_table(to_arrow_table(chunk, types))
+    os.replace(tmp_path, dest_path)
+    print(f"{source_path}: {rows_in} rows in, {rows_out} rows out in {time.perf_counter() - start:.1f}s")
+    return rows_in, rows_out
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def source_hashes(city_path):
+    """ Fingerprints the raw files of a city so unchanged cities can be skipped """
+    return {name: file_hash(os.path.join(city_path, name)) for name in ('listings.csv', 'reviews.csv') if os.path.exists(os.path.join(city_path, name))}
+
+def read_manifest(city_dest_path):
+    manifest_path = os.path.join(city_dest_path, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+def write_manifest(city_dest_path, output_format, file_names, sources=None):
+    """ Records the content hash of each output file and of the city as a whole in manifest.json """
+    files = {name: file_hash(os.path.join(city_dest_path, name)) for name in file_names if os.path.exists(os.path.join(city_dest_path, name))}
+    content_hash = hashlib.sha256(''.join(f"{name}:{digest};" for name, digest in sorted(files.items())).encode()).hexdigest()
+    with open(os.path.join(city_dest_path, 'manifest.json'), 'w') as f:
+        json.dump({'format': output_format, 'files': files, 'content_hash': content_hash, 'sources': sources or {}}, f, indent=2)
+    return content_hash
+
+def process_and_save_files(source_directory, destination_directory, output_format='csv', incremental=False):
     # Ensure destination directory exists
     if not os.path.exists(destination_directory):
         os.makedirs(destination_directory)
-    
+
     # Loop through all the directories in the source directory
     for city in os.listdir(source_directory):
         city_path = os.path.join(source_directory, city)
@@ -29,47 +127,43 @@ def process_and_save_files(source_directory, destination_directory):
             # Define source file paths
             listings_source_path = os.path.join(city_path, 'listings.csv')
             reviews_source_path = os.path.join(city_path, 'reviews.csv')
-            
+
             # Define destination directory and file paths
             city_dest_path = os.path.join(destination_directory, city)
             if not os.path.exists(city_dest_path):
                 os.makedirs(city_dest_path)
-            listings_dest_path = os.path.join(city_dest_path, 'listings.csv')
-            reviews_dest_path = os.path.join(city_dest_path, 'reviews.csv')
-            
-            # Process listings.csv if it exists
-            if os.path.exists(listings_source_path):
-                df_listings = pd.read_csv(listings_source_path)
-                # Filter and process the data
-                df_listings = df_listings[['id', 'name', 'neighbourhood_cleansed', 'property_type', 'accommodates', 'bathrooms_text', 'beds', 'amenities', 'price', 'review_scores_rating']]
-
-                # Remove $ sign from price and convert to float
-                df_listings['price'] = df_listings['price'].replace('[\$,]', '', regex=True).astype(float)
-                df_listings = df_listings[df_listings['id'].apply(is_numeric)]  # Ensure id is numeric
+            parquet = output_format == 'parquet'
+            listings_name = 'listings.parquet' if parquet else 'listings.csv'
+            reviews_name = 'reviews.parquet' if parquet else 'reviews.csv'
+            listings_dest_path = os.path.join(city_dest_path, listings_name)
+            reviews_dest_path = os.path.join(city_dest_path, reviews_name)
 
-                is_ascii_vectorized = lambda col: col.apply(lambda x: is_ascii(str(x)))
-                df_listings = df_listings[df_listings.apply(is_ascii_vectorized, axis=0).all(axis=1)]
+            sources = source_hashes(city_path)
+            if incremental:
+                manifest = read_manifest(city_dest_path)
+                if (manifest and manifest.get('format') == output_format and manifest.get('sources') == sources
+                        and all(os.path.exists(os.path.join(city_dest_path, name)) for name in manifest.get('files', {}))):
+                    print(f"Skipping {city}: source files unchanged")
+                    continue
 
-                # Save to new CSV
-                df_listings.to_csv(listings_dest_path, index=False)
+            # Process listings.csv if it exists
+            if os.path.exists(listings_source_path):
+                clean_csv(listings_source_path, listings_dest_path, LISTINGS_COLUMNS, clean_listings_chunk, LISTINGS_TYPES if parquet else None)
                 print(f"Processed listings for {city} saved to {listings_dest_path}")
-            
+
             # Process reviews.csv if it exists
             if os.path.exists(reviews_source_path):
-                df_reviews = pd.read_csv(reviews_source_path)
-                # Filter and process the data
-                df_reviews = df_reviews[['id', 'listing_id', 'reviewer_id','reviewer_name', 'comments']]
-                df_reviews = df_reviews[df_reviews['listing_id'].apply(is_numeric)]  # Ensure listing_id is numeric
-                df_reviews = df_reviews[df_reviews['id'].apply(is_numeric)]  # Ensure listing_id is numeric
-
-                is_ascii_vectorized = lambda col: col.apply(lambda x: is_ascii(str(x)))
-                df_reviews = df_reviews[df_reviews.apply(is_ascii_vectorized, axis=0).all(axis=1)]
-
-                # Save to new CSV
-                df_reviews.to_csv(reviews_dest_path, index=False)
+                clean_csv(reviews_source_path, reviews_dest_path, REVIEWS_COLUMNS, clean_reviews_chunk, REVIEWS_TYPES if parquet else None)
                 print(f"Processed reviews for {city} saved to {reviews_dest_path}")
 
+            write_manifest(city_dest_path, output_format, [listings_name, reviews_name], sources)
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Clean the raw Airbnb files into Citywise_Data")
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv', help="output format (parquet requires pyarrow)")
+    parser.add_argument('--incremental', action='store_true', help="skip cities whose source files are unchanged since the last run")
+    args = parser.parse_args()
+
     source_dir = '../Airbnb Data'
     dest_dir = './Citywise_Data'
-    process_and_save_files(source_dir, dest_dir)
+    process_and_save_files(source_dir, dest_dir, args.format, args.incremental)
@@ -0,0 +1,286 @@
+import sys
+import threading
+import time
+import numpy as np
+from amenities import AMENITY_VOCABULARY
+from facets import FACET_PRICE_BUCKET
+
+# Columns loaded into a ListingIndex, in this order
+INDEX_COLUMNS = ['id', 'price', 'review_scores_rating', 'accommodates', 'beds', 'property_type', 'neighbourhood_cleansed', 'amenity_tags', 'name']
+
+# One bit per vocabulary term
+AMENITY_BITS_DTYPE = np.uint32 if len(AMENITY_VOCABULARY) <= 32 else np.uint64
+AMENITY_BITS = {term: 1 << position for position, term in enumerate(AMENITY_VOCABULARY)}
+
+
+class Interner:
+    """ Maps repeated strings to small integer codes; code 0 is NULL """
+
+    def __init__(self, values=None):
+        self.values = [None] + list(values or [])
+        self.codes = {value: code for code, value in enumerate(self.values) if code}
+
+    def code(self, value):
+        if value is None:
+            return 0
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def copy(self):
+        return Interner(self.values[1:])
+
+    def nbytes(self):
+        return sys.getsizeof(self.values) + sum(sys.getsizeof(value) for value in self.values[1:])
+
+
+def appended(array, value):
+    """ np.append keeping the array's dtype """
+    return np.append(array, np.array([value], dtype=array.dtype))
+
+def code_dtype(interner):
+    """ Smallest unsigned dtype holding every code of the interner """
+    return np.uint16 if len(interner.values) <= np.iinfo(np.uint16).max + 1 else np.uint32
+
+def appended_code(codes, code):
+    """ appended() for interned codes, widening the array once a code no longer fits its dtype """
+    if code > np.iinfo(codes.dtype).max:
+        codes = codes.astype(np.uint32)
+    return appended(codes, code)
+
+def amenity_bits(tags):
+    bits = 0
+    for tag in tags or ():
+        bits |= AMENITY_BITS.get(tag, 0)
+    return bits
+
+
+class ListingIndex:
+    """ Columnar copy of one city's listings, sorted by (price, id) like paginated /search
+
+    Numeric filter columns are float arrays with NaN for NULL, property type and neighbourhood are
+    interned codes and amenity tags are a bitset over AMENITY_VOCABULARY. Instances are never modified:
+    add() returns a new index, so searches can run without a lock while a refresh swaps one in.
+    """
+
+    def __init__(self, ids, price, rating, accommodates, beds, property_types, neighbourhoods, amenities, names,
+                 property_type_values, neighbourhood_values):
+        self.ids = ids
+        self.price = price
+        self.rating = rating
+        self.accommodates = accommodates
+        self.beds = beds
+        self.property_types = property_types
+        self.neighbourhoods = neighbourhoods
+        self.amenities = amenities
+        self.names = names  # casefolded, for substring matching like ILIKE
+        self.property_type_values = property_type_values
+        self.neighbourhood_values = neighbourhood_values
+        self.loaded_at = time.monotonic()
+
+    @classmethod
+    def from_rows(cls, rows, property_type_values=None, neighbourhood_values=None):
+        """ Builds an index from rows of INDEX_COLUMNS """
+        property_type_values = property_type_values or Interner()
+        neighbourhood_values = neighbourhood_values or Interner()
+        columns = list(zip(*rows)) or [()] * len(INDEX_COLUMNS)
+        ids = np.array(columns[0], dtype=np.int64)
+        price = np.array([np.nan if value is None else value for value in columns[1]], dtype=np.float64)
+        order = np.lexsort((ids, price))  # NULL (NaN) prices last
+        take = lambda values, dtype: np.array(values, dtype=dtype)[order]
+        property_types = [property_type_values.code(value) for value in columns[5]]
+        neighbourhoods = [neighbourhood_values.code(value) for value in columns[6]]
+        return cls(
+            ids=ids[order],
+            price=price[order],
+            rating=take([np.nan if value is None else value for value in columns[2]], np.float64),
+            accommodates=take([np.nan if value is None else value for value in columns[3]], np.float32),
+            beds=take([np.nan if value is None else value for value in columns[4]], np.float32),
+            property_types=take(property_types, code_dtype(property_type_values)),
+            neighbourhoods=take(neighbourhoods, code_dtype(neighbourhood_values)),
+            amenities=take([amenity_bits(tags) for tags in columns[7]], AMENITY_BITS_DTYPE),
+            names=[columns[8][position].casefold() if columns[8][position] else '' for position in order],
+            property_type_values=property_type_values,
+            neighbourhood_values=neighbourhood_values,
+        )
+
+    def add(self, row):
+        """ Returns a copy of the index with one more listing (a row of INDEX_COLUMNS) """
+        property_type_values = self.property_type_values.copy()
+        neighbourhood_values = self.neighbourhood_values.copy()
+        ids = appended(self.ids, row[0])
+        price = appended(self.price, np.nan if row[1] is None else row[1])
+        order = np.lexsort((ids, price))
+        names = self.names + [row[8].casefold() if row[8] else '']
+        index = ListingIndex(
+            ids=ids[order],
+            price=price[order],
+            rating=appended(self.rating, np.nan if row[2] is None else row[2])[order],
+            accommodates=appended(self.accommodates, np.nan if row[3] is None else row[3])[order],
+            beds=appended(self.beds, np.nan if row[4] is None else row[4])[order],
+            property_types=appended_code(self.property_types, property_type_values.code(row[5]))[order],
+            neighbourhoods=appended_code(self.neighbourhoods, neighbourhood_values.code(row[6]))[order],
+            amenities=appended(self.amenities, amenity_bits(row[7]))[order],
+            names=[names[position] for position in order],
+            property_type_values=property_type_values,
+            neighbourhood_values=neighbourhood_values,
+        )
+        index.loaded_at = self.loaded_at  # still due for the periodic reload
+        return index
+
+    @staticmethod
+    def supports(filters):
+        """ Free-text amenities outside the vocabulary are only searchable in Postgres """
+        return all(element in AMENITY_BITS for element in filters['amenities'])
+
+    def mask(self, filters):
+        """ Boolean mask of the listings matching /search filters, with the same NULL semantics as the SQL """
+        mask = np.ones(len(self.ids), dtype=bool)
+        if filters['price_min'] is not None:
+            mask &= self.price >= filters['price_min']
+        if filters['price_max'] is not None:
+            mask &= self.price <= filters['price_max']
+        if filters['bedrooms'] is not None:
+            mask &= self.beds == np.float32(filters['bedrooms'])
+        if filters['people'] is not None:
+            mask &= self.accommodates == np.float32(filters['people'])
+        if filters['rating'] is not None:
+            mask &= self.rating >= filters['rating']
+        required = amenity_bits(filters['amenities'])
+        if required:
+            mask &= (self.amenities & AMENITY_BITS_DTYPE(required)) == required
+        if filters['name']:
+            needle = filters['name'].casefold()
+            candidates = np.flatnonzero(mask)
+            mask[candidates] = [needle in self.names[position] for position in candidates]
+        return mask
+
+    def search(self, filters, limit=None, after=None):
+        """ Ids of the matching listings in (price, id) order and the total number of matches """
+        mask = self.mask(filters)
+        total = int(mask.sum())
+        if after is not None:
+            mask &= (self.price > after[0]) | ((self.price == after[0]) & (self.ids > after[1]))
+        positions = np.flatnonzero(mask)
+        if limit is not None:
+            positions = positions[:limit]
+        return self.ids[positions].tolist(), total
+
+    def facets(self, filters):
+        """ The /facets response computed from the arrays """
+        mask = self.mask(filters)
+        property_types = np.bincount(self.property_types[mask], minlength=len(self.property_type_values.values))
+        neighbourhoods = np.bincount(self.neighbourhoods[mask], minlength=len(self.neighbourhood_values.values))
+        prices = self.price[mask]
+        buckets = np.floor(prices[~np.isnan(prices)] / FACET_PRICE_BUCKET).astype(np.int64)
+        histogram = zip(*np.unique(buckets, return_counts=True))
+        amenities = self.amenities[mask]
+        return {
+            'total': int(mask.sum()),
+            'property_types': {value: int(count) for value, count in zip(self.property_type_values.values[1:], property_types[1:]) if count and value},
+            'neighbourhoods': {value: int(count) for value, count in zip(self.neighbourhood_values.values[1:], neighbourhoods[1:]) if count and value},
+            'amenities': {term: int(count) for term, count in
+                          ((term, np.count_nonzero(amenities & AMENITY_BITS_DTYPE(bit))) for term, bit in AMENITY_BITS.items()) if count},
+            'price_histogram': [{'min': bucket * FACET_PRICE_BUCKET, 'max': (bucket + 1) * FACET_PRICE_BUCKET, 'count': int(count)}
+                                for bucket, count in ((int(bucket), count) for bucket, count in histogram)],
+            'source': 'memory',
+        }
+
+    def memory_bytes(self):
+        arrays = (self.ids, self.price, self.rating, self.accommodates, self.beds, self.property_types, self.neighbourhoods, self.amenities)
+        return {
+            'arrays': sum(array.nbytes for array in arrays),
+            'names': sys.getsizeof(self.names) + sum(sys.getsizeof(name) for name in self.names),
+            'interned': self.property_type_values.nbytes() + self.neighbourhood_values.nbytes(),
+        }
+
+
+class ListingIndexes:
+    """ The ListingIndex of every hot city, loaded on first use and reloaded in the background after ttl seconds
+
+    Cities are keyed by their city_info name. load_rows(city) returns the rows of INDEX_COLUMNS for a city.
+    Listings added through /insert are applied with add_listing(); the periodic reload picks up bulk loads
+    done outside this process.
+    """
+
+    def __init__(self, cities, load_rows, ttl=600):
+        self.cities = set(cities)
+        self.load_rows = load_rows
+        self.ttl = ttl
+        self.indexes = {}
+        self.reloading = set()  # cities with a load in progress
+        self.loads = {}  # city -> loads in flight
+        self.added_during_load = {}  # city -> rows passed to add_listing while a load is in flight
+        self.lock = threading.Lock()
+
+    def get(self, city):
+        """ The index of a hot city, or None for cities served from Postgres
+
+        Requests arriving while another one loads a city for the first time also get None rather than each
+        building the whole index.
+        """
+        if city not in self.cities:
+            return None
+        index = self.indexes.get(city)
+        if index is not None and time.monotonic() - index.loaded_at <= self.ttl:
+            return index
+        with self.lock:
+            start = city not in self.reloading
+            self.reloading.add(city)
+        if index is None:
+            return self.load(city) if start else None
+        if start:
+            # Searches keep using the current index until the new one is ready
+            threading.Thread(target=self.load, args=(city,), daemon=True).start()
+        return index
+
+    def load(self, city):
+        # Listings added while the rows are being read may be missing from them; they are re-applied before the swap
+        with self.lock:
+            self.loads[city] = self.loads.get(city, 0) + 1
+            self.added_during_load.setdefault(city, [])
+        try:
+            index = ListingIndex.from_rows(self.load_rows(city))
+            with self.lock:
+                for row in self.added_during_load[city]:
+                    if not np.any(index.ids == row[0]):
+                        index = index.add(row)
+                self.indexes[city] = index
+            return index
+        finally:
+            with self.lock:
+                self.loads[city] -= 1
+                if not self.loads[city]:
+                    del self.loads[city]
+                    del self.added_during_load[city]
+                self.reloading.discard(city)
+
+    def add_listing(self, city, row):
+        with self.lock:
+            if city in self.added_during_load:
+                self.added_during_load[city].append(row)
+            index = self.indexes.get(city)
+            if index is not None:
+                self.indexes[city] = index.add(row)
+
+    def stats(self):
+        with self.lock:
+            indexes = dict(self.indexes)
+        stats = {}
+        for city in sorted(self.cities):
+            index = indexes.get(city)
+            if index is None:
+                stats[city] = {'loaded': False}
+                continue
+            memory = index.memory_bytes()
+            stats[city] = {
+                'loaded': True,
+                'listings': len(index.ids),
+                'property_types': len(index.property_type_values.values) - 1,
+                'neighbourhoods': len(index.neighbourhood_values.values) - 1,
+                'age_seconds': round(time.monotonic() - index.loaded_at, 1),
+                'memory_bytes': {**memory, 'total': sum(memory.values())},
+            }
+        return stats
@@ -0,0 +1,213 @@
+import json
+import logging
+import random
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+import psycopg2
+from psycopg2 import extensions
+from flask import g, has_app_context
+from flask.json.provider import DefaultJSONProvider
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Queries slower than this are logged with their normalized SQL and EXPLAIN plan
+SLOW_QUERY_THRESHOLD = 0.5
+# Fraction of requests written to the request log; slow and failed requests are always written
+REQUEST_LOG_SAMPLE_RATE = 0.01
+SLOW_REQUEST_THRESHOLD = 1.0
+# Normalized statements kept per request for the request log
+REQUEST_LOG_MAX_QUERIES = 20
+
+request_log = logging.getLogger('airbnb.requests')
+slow_query_log = logging.getLogger('airbnb.slow_queries')
+
+
+class Histogram:
+    """ Cumulative-bucket latency histogram in the Prometheus layout """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{format_labels({**labels, 'le': str(bound)})} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(labels)} {self.sum}")
+        lines.append(f"{name}_count{format_labels(labels)} {self.count}")
+        return lines
+
+
+def format_labels(labels):
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+
+class RequestMetrics:
+    """ Per-route request and phase histograms, rendered in the Prometheus text format at /metrics """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.requests = {}  # (route, method) -> Histogram
+        self.phases = {}  # (route, phase) -> Histogram
+        self.statuses = {}  # (route, method, status) -> count
+        self.slow_queries = 0
+
+    def observe_request(self, route, method, status, seconds, phases):
+        with self.lock:
+            self.requests.setdefault((route, method), Histogram(self.buckets)).observe(seconds)
+            for phase, phase_seconds in phases.items():
+                self.phases.setdefault((route, phase), Histogram(self.buckets)).observe(phase_seconds)
+            key = (route, method, status)
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+
+    def record_slow_query(self):
+        with self.lock:
+            self.slow_queries += 1
+
+    def render(self):
+        with self.lock:
+            lines = ['# HELP http_request_duration_seconds Time spent handling a request, by route',
+                     '# TYPE http_request_duration_seconds histogram']
+            for (route, method), histogram in sorted(self.requests.items()):
+                lines += histogram.render('http_request_duration_seconds', {'route': route, 'method': method})
+            lines += ['# HELP http_request_phase_duration_seconds Time spent per request in each phase (routing, connection, index, query, convert, serialize)',
+                      '# TYPE http_request_phase_duration_seconds histogram']
+            for (route, phase), histogram in sorted(self.phases.items()):
+                lines += histogram.render('http_request_phase_duration_seconds', {'route': route, 'phase': phase})
+            lines += ['# HELP http_requests_total Requests handled, by route and status',
+                      '# TYPE http_requests_total counter']
+            for (route, method, status), count in sorted(self.statuses.items()):
+                lines.append(f"http_requests_total{format_labels({'route': route, 'method': method, 'status': status})} {count}")
+            lines += ['# HELP slow_queries_total Queries slower than the slow-query threshold',
+                      '# TYPE slow_queries_total counter',
+                      f"slow_queries_total {self.slow_queries}"]
+        return '\n'.join(lines) + '\n'
+
+request_metrics = RequestMetrics()
+
+
+def add_phase_time(phase, seconds):
+    """ Adds time to a phase of the current request; a no-op outside a Flask request """
+    if has_app_context():
+        phases = g.setdefault('request_phases', {})
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+@contextmanager
+def request_phase(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase_time(phase, time.perf_counter() - start)
+
+def begin_request():
+    g.request_started = time.perf_counter()
+    g.request_phases = {}
+
+def end_request(route, method, status):
+    """ Records the request in the histograms and writes a sampled structured log line """
+    started = g.get('request_started')
+    if started is None:
+        return
+    seconds = time.perf_counter() - started
+    phases = g.get('request_phases', {})
+    request_metrics.observe_request(route, method, status, seconds, phases)
+
+    slow = seconds >= SLOW_REQUEST_THRESHOLD
+    if status >= 500 or slow or random.random() < REQUEST_LOG_SAMPLE_RATE:
+        record = {
+            'event': 'request',
+            'route': route,
+            'method': method,
+            'status': status,
+            'ms': round(seconds * 1000, 3),
+            'phases_ms': {phase: round(phase_seconds * 1000, 3) for phase, phase_seconds in phases.items()},
+            'queries': g.get('request_queries', []),
+        }
+        request_log.log(logging.WARNING if status >= 500 or slow else logging.INFO, json.dumps(record))
+
+
+def normalize_sql(sql):
+    """ Replaces literals with ? and collapses whitespace so statements group by shape """
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+(?:\.\d+)?\b', '?', sql)
+    return ' '.join(sql.split())
+
+def query_text(cursor, query):
+    if isinstance(query, bytes):
+        return query.decode()
+    if not isinstance(query, str):
+        return query.as_string(cursor.connection)  # psycopg2.sql.Composed
+    return query
+
+def explain(conn, query, params):
+    """ Returns the plan of a statement; without ANALYZE, so nothing is executed twice """
+    first_word = query.lstrip().split(None, 1)[0].upper() if query.strip() else ''
+    if first_word not in ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'EXECUTE') or ';' in query.strip().rstrip(';'):
+        return None
+    cursor = conn.cursor(cursor_factory=extensions.cursor)
+    try:
+        # A failed EXPLAIN must not abort the request's transaction
+        if not conn.autocommit:
+            cursor.execute("SAVEPOINT slow_query_explain")
+        try:
+            cursor.execute("EXPLAIN " + query, params)
+            plan = [row[0] for row in cursor.fetchall()]
+        except psycopg2.Error:
+            plan = None
+            if not conn.autocommit:
+                cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+        if not conn.autocommit:
+            cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+        return plan
+    finally:
+        cursor.close()
+
+def record_query(cursor, query, params, seconds):
+    text = query_text(cursor, query)
+    add_phase_time('query', seconds)
+    if has_app_context():
+        queries = g.setdefault('request_queries', [])
+        if len(queries) < REQUEST_LOG_MAX_QUERIES:
+            queries.append({'sql': normalize_sql(text), 'ms': round(seconds * 1000, 3)})
+    if seconds >= SLOW_QUERY_THRESHOLD:
+        request_metrics.record_slow_query()
+        slow_query_log.warning(json.dumps({
+            'event': 'slow_query',
+            'ms': round(seconds * 1000, 3),
+            'database': cursor.connection.info.dbname,
+            'sql': normalize_sql(text),
+            'plan': explain(cursor.connection, text, params),
+        }))
+
+
+class TimedCursor(extensions.cursor):
+    """ Cursor for pooled connections: times every statement into the request's query phase and logs slow ones """
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        result = super().execute(query, vars)
+        record_query(self, query, vars, time.perf_counter() - start)
+        return result
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """ Times jsonify() into the request's serialize phase """
+
+    def response(self, *args, **kwargs):
+        with request_phase('serialize'):
+            return super().response(*args, **kwargs)
@@ -0,0 +1,139 @@
+from decimal import Decimal, InvalidOperation
+import psycopg2
+from review_stats import setup_review_stats, rebuild_review_stats
+from facets import setup_listing_facets, rebuild_listing_facets
+
+# Range of the BIGINT listing id columns
+BIGINT_MIN = -2 ** 63
+BIGINT_MAX = 2 ** 63 - 1
+
+def parse_listing_id(value):
+    """ Normalizes a listing id that may have been stored float-formatted ('123.0') to an int """
+    try:
+        number = Decimal(str(value).strip())
+    except (InvalidOperation, ValueError):
+        raise ValueError(f"Invalid listing id: {value}")
+    # Rejects inf/nan and fractional ids ('12.7') rather than truncating them onto another listing
+    if not number.is_finite() or number != number.to_integral_value():
+        raise ValueError(f"Invalid listing id: {value}")
+    listing_id = int(number)
+    if not BIGINT_MIN <= listing_id <= BIGINT_MAX:
+        raise ValueError(f"Invalid listing id: {value}")
+    return listing_id
+
+def column_type(cursor, city_schema, table, column):
+    cursor.execute("""
+        SELECT data_type FROM information_schema.columns
+        WHERE table_schema = %s AND table_name = %s AND column_name = %s
+    """, (city_schema, table, column))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def migrate_city_schema(cursor, city_schema):
+    """ Converts text listing ids to BIGINT and adds the secondary indexes used by /search and review lookups """
+    if column_type(cursor, city_schema, 'listings', 'id') == 'text':
+        # '123' and '123.0' collapse to the same key, so drop the duplicates before changing the type
+        cursor.execute(f"""
+            DELETE FROM {city_schema}.listings WHERE ctid IN (
+                SELECT ctid FROM (
+                    SELECT ctid, row_number() OVER (PARTITION BY id::numeric ORDER BY id) AS rn
+                    FROM {city_schema}.listings
+                ) dup WHERE rn > 1
+            );
+            ALTER TABLE {city_schema}.listings ALTER COLUMN id TYPE BIGINT USING id::numeric::bigint;
+        """)
+        print(f"Migrated {city_schema}.listings.id to BIGINT")
+
+    if column_type(cursor, city_schema, 'listings_reviews', 'listing_id') == 'text':
+        cursor.execute(f"""
+            DELETE FROM {city_schema}.listings_reviews WHERE ctid IN (
+                SELECT ctid FROM (
+                    SELECT ctid, row_number() OVER (PARTITION BY listing_id::numeric, review_id ORDER BY listing_id) AS rn
+                    FROM {city_schema}.listings_reviews
+                ) dup WHERE rn > 1
+            );
+            ALTER TABLE {city_schema}.listings_reviews ALTER COLUMN listing_id TYPE BIGINT USING listing_id::numeric::bigint;
+        """)
+        print(f"Migrated {city_schema}.listings_reviews.listing_id to BIGINT")
+
+    # Content hash of rows loaded from the source files, used by incremental refreshes
+    cursor.execute(f"""
+        ALTER TABLE {city_schema}.listings ADD COLUMN IF NOT EXISTS row_hash TEXT;
+        ALTER TABLE {city_schema}.reviews ADD COLUMN IF NOT EXISTS row_hash TEXT;
+    """)
+
+    cursor.execute(f"""
+        CREATE INDEX IF NOT EXISTS listings_price_idx ON {city_schema}.listings (price);
+        CREATE INDEX IF NOT EXISTS listings_price_id_idx ON {city_schema}.listings (price, id);
+        CREATE INDEX IF NOT EXISTS listings_rating_idx ON {city_schema}.listings (review_scores_rating);
+        CREATE INDEX IF NOT EXISTS listings_accommodates_beds_idx ON {city_schema}.listings (accommodates, beds);
+        CREATE INDEX IF NOT EXISTS listings_reviews_review_id_idx ON {city_schema}.listings_reviews (review_id);
+    """)
+    setup_text_search(cursor, city_schema)
+
+    # Backfill the review aggregates the first time the table is created
+    cursor.execute("SELECT to_regclass(%s)", (f"{city_schema}.listing_review_stats",))
+    stats_exist = cursor.fetchone()[0] is not None
+    setup_review_stats(cursor, city_schema)
+    if not stats_exist:
+        rebuild_review_stats(cursor, city_schema)
+
+    # Same for the facet summary behind /facets
+    cursor.execute("SELECT to_regclass(%s)", (f"{city_schema}.listing_facet_counts",))
+    facets_exist = cursor.fetchone()[0] is not None
+    setup_listing_facets(cursor, city_schema)
+    if not facets_exist:
+        rebuild_listing_facets(cursor, city_schema)
+
+def setup_database_extensions(cursor):
+    """ Extensions the city schemas rely on; run once per shard database before its schemas are migrated,
+    since concurrent CREATE EXTENSION on the same database can fail with a duplicate key error """
+    cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+def setup_text_search(cursor, city_schema):
+    """ Trigram index for substring search on listing names and a generated tsvector for review comments (needs pg_trgm) """
+    cursor.execute(f"""
+        CREATE INDEX IF NOT EXISTS listings_name_trgm_idx ON {city_schema}.listings USING GIN (name gin_trgm_ops);
+        ALTER TABLE {city_schema}.reviews ADD COLUMN IF NOT EXISTS comments_tsv tsvector
+            GENERATED ALWAYS AS (to_tsvector('english', coalesce(comments, ''))) STORED;
+        CREATE INDEX IF NOT EXISTS reviews_comments_tsv_idx ON {city_schema}.reviews USING GIN (comments_tsv);
+    """)
+
+def setup_shard_database(db_name, user, password, host):
+    """ Creates the extensions of one shard database """
+    conn = psycopg2.connect(database=db_name, user=user, password=password, host=host)
+    try:
+        with conn.cursor() as cursor:
+            setup_database_extensions(cursor)
+        conn.commit()
+    finally:
+        conn.close()
+
+def migrate_all_shards(user, password, host):
+    """ Backfills every city registered in city_info """
+    conn = psycopg2.connect(database="cities", user=user, password=password, host=host)
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT city_name, db_name FROM city_info")
+        cities = cursor.fetchall()
+    conn.close()
+
+    for db_name in sorted({db_name for _, db_name in cities}):
+        setup_shard_database(db_name, user, password, host)
+
+    for city_name, db_name in cities:
+        city_schema = city_name.lower().replace(' ', '_').replace('-', '_')
+        conn = psycopg2.connect(database=db_name, user=user, password=password, host=host)
+        try:
+            with conn.cursor() as cursor:
+                migrate_city_schema(cursor, city_schema)
+                cursor.execute(f"ANALYZE {city_schema}.listings; ANALYZE {city_schema}.listings_reviews;")
+            conn.commit()
+            print(f"Migrated schema {city_schema} in {db_name}")
+        except psycopg2.Error as e:
+            conn.rollback()
+            print(f"Failed to migrate schema {city_schema} in {db_name}: {e}")
+        finally:
+            conn.close()
+
+if __name__ == "__main__":
+    migrate_all_shards("postgres", "toor", "localhost")
@@ -0,0 +1,124 @@
+from migrations import parse_listing_id
+
+# Bulk review moderation. Items may span cities; the servers group them per shard database and run every
+# city's items as one set-based statement, all of a shard's cities in one transaction. The statements are
+# (sql, params) builders like the review_stats *_query ones, so both servers run the same SQL.
+
+# Items accepted by one bulk request
+MODERATION_MAX_ITEMS = 10000
+
+
+class ModerationAction:
+    """ One bulk operation: how to read an item, the statement for a city's items and how to turn its rows into per-item results """
+
+    def __init__(self, items_key, id_key, parse_item, query, results):
+        self.items_key = items_key
+        self.id_key = id_key
+        self.parse_item = parse_item
+        self.query = query
+        self.results = results
+
+    def items(self, data):
+        items = (data or {}).get(self.items_key)
+        if not isinstance(items, list) or not items:
+            raise ValueError(f"{self.items_key} must be a non-empty list")
+        if len(items) > MODERATION_MAX_ITEMS:
+            raise ValueError(f"At most {MODERATION_MAX_ITEMS} {self.items_key} per request")
+        return items
+
+    def result(self, item, outcome):
+        identity = {'city': item.get('city'), self.id_key: item.get(self.id_key)} if isinstance(item, dict) else {}
+        return {**identity, **outcome}
+
+
+def parse_review_id(item):
+    review_id = item.get('review_id')
+    if not review_id or not isinstance(review_id, (str, int)):
+        raise ValueError("review_id is required")
+    return str(review_id)
+
+def parse_review_update(item):
+    comments = item.get('comments')
+    if not isinstance(comments, str):
+        raise ValueError("comments is required")
+    return parse_review_id(item), comments
+
+def parse_moderated_listing(item):
+    return parse_listing_id(item.get('listing_id'))
+
+
+def delete_reviews_query(city_schema, review_ids):
+    """ Deletes the reviews and their listing links; one (review_id, listing_id) row per deleted review or link """
+    return f"""
+        WITH targets AS (SELECT DISTINCT unnest(%s::text[]) AS id),
+        links AS (
+            DELETE FROM {city_schema}.listings_reviews lr USING targets t
+            WHERE lr.review_id = t.id
+            RETURNING lr.review_id, lr.listing_id
+        ),
+        deleted AS (
+            DELETE FROM {city_schema}.reviews r USING targets t
+            WHERE r.id = t.id
+            RETURNING r.id
+        )
+        SELECT COALESCE(d.id, l.review_id), l.listing_id FROM deleted d FULL JOIN links l ON l.review_id = d.id
+    """, (list(review_ids),)
+
+def deleted_review_results(entries, rows):
+    deleted = {review_id for review_id, _ in rows}
+    results = {index: {'status': 'deleted' if review_id in deleted else 'not_found'} for index, review_id in entries}
+    return results, {listing_id for _, listing_id in rows if listing_id is not None}
+
+def update_reviews_query(city_schema, updates):
+    """ Sets the comments of many reviews; one (review_id, listing_id) row per updated review and link """
+    latest = dict(updates)  # the last update of a review given twice wins
+    return f"""
+        WITH updated AS (
+            UPDATE {city_schema}.reviews r SET comments = v.comments
+            FROM unnest(%s::text[], %s::text[]) AS v(id, comments)
+            WHERE r.id = v.id
+            RETURNING r.id
+        )
+        SELECT u.id, lr.listing_id FROM updated u LEFT JOIN {city_schema}.listings_reviews lr ON lr.review_id = u.id
+    """, (list(latest), list(latest.values()))
+
+def updated_review_results(entries, rows):
+    updated = {review_id for review_id, _ in rows}
+    results = {index: {'status': 'updated' if review_id in updated else 'not_found'} for index, (review_id, _) in entries}
+    return results, {listing_id for _, listing_id in rows if listing_id is not None}
+
+def remove_listing_reviews_query(city_schema, listing_ids):
+    """ Deletes every review of the listings along with their links and aggregates; one (listing_id, reviews deleted) row per listing that had reviews """
+    return f"""
+        WITH targets AS (SELECT DISTINCT unnest(%s::bigint[]) AS listing_id),
+        links AS (
+            DELETE FROM {city_schema}.listings_reviews lr USING targets t
+            WHERE lr.listing_id = t.listing_id
+            RETURNING lr.listing_id, lr.review_id
+        ),
+        deleted AS (
+            DELETE FROM {city_schema}.reviews r USING links l
+            WHERE r.id = l.review_id
+        ),
+        stats AS (
+            DELETE FROM {city_schema}.listing_review_stats s USING targets t
+            WHERE s.listing_id = t.listing_id
+        )
+        SELECT listing_id, COUNT(*) FROM links GROUP BY listing_id
+    """, (list(listing_ids),)
+
+def removed_listing_results(entries, rows):
+    removed = dict(rows)
+    # Aggregates were deleted by the statement itself
+    return {index: {'status': 'removed', 'reviews_deleted': removed.get(listing_id, 0)} for index, listing_id in entries}, set()
+
+
+DELETE_REVIEWS = ModerationAction('reviews', 'review_id', parse_review_id, delete_reviews_query, deleted_review_results)
+UPDATE_REVIEWS = ModerationAction('reviews', 'review_id', parse_review_update, update_reviews_query, updated_review_results)
+REMOVE_LISTING_REVIEWS = ModerationAction('listings', 'listing_id', parse_moderated_listing, remove_listing_reviews_query, removed_listing_results)
+
+def moderation_summary(results):
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    return {'results': results, 'counts': counts}
@@ -0,0 +1,74 @@
+# Per-listing review aggregates kept in <city>.listing_review_stats so listing cards can show review
+# counts without fetching every review. latest_review_id is the most recently added review (the highest
+# id when a listing is recomputed from scratch).
+
+def setup_review_stats(cursor, city_schema):
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {city_schema}.listing_review_stats (
+            listing_id BIGINT PRIMARY KEY,
+            review_count INT NOT NULL DEFAULT 0,
+            latest_review_id TEXT,
+            total_comment_length BIGINT NOT NULL DEFAULT 0
+        );
+    """)
+
+def rebuild_review_stats(cursor, city_schema):
+    """ Recomputes the aggregates of every listing in a city, e.g. after a full bulk load """
+    # DELETE rather than TRUNCATE: TRUNCATE's ACCESS EXCLUSIVE lock would block every /search joining the table until commit
+    cursor.execute(f"""
+        DELETE FROM {city_schema}.listing_review_stats;
+        INSERT INTO {city_schema}.listing_review_stats (listing_id, review_count, latest_review_id, total_comment_length)
+        SELECT lr.listing_id, COUNT(*),
+               (array_agg(lr.review_id ORDER BY length(lr.review_id) DESC, lr.review_id DESC))[1],
+               COALESCE(SUM(length(r.comments)), 0)
+        FROM {city_schema}.listings_reviews lr
+        INNER JOIN {city_schema}.reviews r ON r.id = lr.review_id
+        GROUP BY lr.listing_id;
+    """)
+
+def recompute_review_stats(cursor, city_schema, listing_ids):
+    """ Recomputes the aggregates of the given listings, dropping rows of listings left without reviews """
+    query = recompute_review_stats_query(city_schema, listing_ids)
+    if query:
+        cursor.execute(*query)
+
+def record_added_reviews(cursor, city_schema, added):
+    """ Applies newly inserted (listing_id, review_id, comment) rows to the aggregates """
+    query = record_added_reviews_query(city_schema, added)
+    if query:
+        cursor.execute(*query)
+
+# The *_query builders return (sql, params), or None when there is nothing to do, so the async
+# server can run the same statements on its own driver
+
+def recompute_review_stats_query(city_schema, listing_ids):
+    listing_ids = list(listing_ids)
+    if not listing_ids:
+        return None
+    return f"""
+        DELETE FROM {city_schema}.listing_review_stats WHERE listing_id = ANY(%s::bigint[]);
+        INSERT INTO {city_schema}.listing_review_stats (listing_id, review_count, latest_review_id, total_comment_length)
+        SELECT lr.listing_id, COUNT(*),
+               (array_agg(lr.review_id ORDER BY length(lr.review_id) DESC, lr.review_id DESC))[1],
+               COALESCE(SUM(length(r.comments)), 0)
+        FROM {city_schema}.listings_reviews lr
+        INNER JOIN {city_schema}.reviews r ON r.id = lr.review_id
+        WHERE lr.listing_id = ANY(%s::bigint[])
+        GROUP BY lr.listing_id;
+    """, (listing_ids, listing_ids)
+
+def record_added_reviews_query(city_schema, added):
+    if not added:
+        return None
+    totals = {}
+    for listing_id, review_id, comment in added:
+        count, _, length = totals.get(listing_id, (0, None, 0))
+        totals[listing_id] = (count + 1, review_id, length + len(comment or ''))
+    return f"""
+        INSERT INTO {city_schema}.listing_review_stats AS s (listing_id, review_count, latest_review_id, total_comment_length)
+        SELECT * FROM unnest(%s::bigint[], %s::int[], %s::text[], %s::bigint[])
+        ON CONFLICT (listing_id) DO UPDATE SET
+            review_count = s.review_count + EXCLUDED.review_count,
+            latest_review_id = EXCLUDED.latest_review_id,
+            total_comment_length = s.total_comment_length + EXCLUDED.total_comment_length
+    """, (list(totals), [t[0] for t in totals.values()], [t[1] for t in totals.values()], [t[2] for t in totals.values()])
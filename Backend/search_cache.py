@@ -0,0 +1,85 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class SearchCache:
+    """ LRU/TTL cache of serialized /search responses, bounded by total size in bytes
+
+    Keys include a generation counter for every city the search touched. Write endpoints bump the counter of the
+    city they modified, so entries built from older data can never be served again. Counters live in this process,
+    so with several workers a write only invalidates its own worker's cache; the TTL bounds staleness elsewhere.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=60):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (body, stored_at), least recently used first
+        self.city_keys = {}  # city -> keys that depend on it
+        self.generations = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+
+    def make_key(self, params, cities):
+        """ Builds the cache key from normalized request parameters and the current generation of each city """
+        with self.lock:
+            generations = tuple((city, self.generations.get(city, 0)) for city in sorted(set(cities)))
+        return (params, generations)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            body, stored_at = entry
+            if time.monotonic() - stored_at > self.ttl:
+                self._remove(key)
+                self.counters['expirations'] += 1
+                self.counters['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return body
+
+    def put(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            # A write may have happened while this response was being built
+            if any(self.generations.get(city, 0) != generation for city, generation in key[1]):
+                return
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (body, time.monotonic())
+            self.size += len(body)
+            for city, _ in key[1]:
+                self.city_keys.setdefault(city, set()).add(key)
+            while self.size > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.counters['evictions'] += 1
+
+    def invalidate_city(self, city):
+        """ Bumps the city's generation and drops every entry that depended on it """
+        with self.lock:
+            self.generations[city] = self.generations.get(city, 0) + 1
+            for key in list(self.city_keys.pop(city, ())):
+                if key in self.entries:
+                    self._remove(key)
+            self.counters['invalidations'] += 1
+
+    def _remove(self, key):
+        body, _ = self.entries.pop(key)
+        self.size -= len(body)
+        for city, _ in key[1]:
+            keys = self.city_keys.get(city)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.city_keys[city]
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.size, 'max_bytes': self.max_bytes, **self.counters}
@@ -0,0 +1,248 @@
+import re
+import math
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+from amenities import AMENITY_VOCABULARY
+
+# Builds /search statements in a small set of canonical parameterized shapes. Every filter value is a bound
+# parameter, so the text only varies with which filters are present, the projection, the city and the sort.
+# Each shape is PREPAREd once per pooled connection and then run with EXECUTE, skipping parse and plan.
+
+LISTING_COLUMNS = ['id', 'name', 'neighbourhood_cleansed', 'property_type', 'accommodates', 'bathrooms_text', 'beds', 'amenities', 'price', 'review_scores_rating']
+
+# Review aggregates returned inline with each listing, read from listing_review_stats
+REVIEW_STATS_COLUMNS = {
+    'review_count': "COALESCE(rs.review_count, 0)",
+    'latest_review_id': "rs.latest_review_id",
+    'avg_comment_length': "CASE WHEN rs.review_count > 0 THEN rs.total_comment_length::float / rs.review_count END",
+}
+SEARCH_FIELDS = LISTING_COLUMNS + list(REVIEW_STATS_COLUMNS)
+
+# sort= value -> (ORDER BY clause per city, merge key over result dicts)
+SEARCH_SORT_ORDERS = {
+    'price': ("price, id", lambda row: (row['price'], int(row['id']))),
+    'rating': ("review_scores_rating DESC NULLS LAST, id",
+               lambda row: (row['review_scores_rating'] is None, -(row['review_scores_rating'] or 0), int(row['id']))),
+}
+
+# Prepared statements kept per connection; the least recently used are deallocated beyond this
+PREPARED_STATEMENTS_PER_CONNECTION = 64
+
+def search_columns(fields):
+    """ Resolves the fields= projection; id and price are always returned since the cursor is built from them """
+    if not fields:
+        return list(SEARCH_FIELDS)
+    requested = fields if isinstance(fields, list) else fields.split(',')
+    requested = [field.strip() for field in requested if field.strip()]
+    unknown = [field for field in requested if field not in SEARCH_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return [column for column in SEARCH_FIELDS if column in requested or column in ('id', 'price')]
+
+def search_select_sql(columns, city_schema):
+    """ SELECT ... FROM for a search, joining the review aggregates only when one of them was requested """
+    select = ', '.join(f"{REVIEW_STATS_COLUMNS[column]} AS {column}" if column in REVIEW_STATS_COLUMNS else column for column in columns)
+    sql = f"SELECT {select} FROM {city_schema}.listings"
+    if any(column in REVIEW_STATS_COLUMNS for column in columns):
+        sql += f" LEFT JOIN {city_schema}.listing_review_stats rs ON rs.listing_id = {city_schema}.listings.id"
+    return sql
+
+def is_blank(value):
+    return value is None or value == '' or value == 'null'
+
+def parse_number(data, key, cast, required=False):
+    value = data.get(key)
+    if isinstance(value, list):
+        raise ValueError(f"{key} may only be given once")
+    if is_blank(value):
+        if required:
+            raise ValueError(f"{key} is required")
+        return None
+    try:
+        number = cast(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{key} must be a number")
+    if not math.isfinite(number):
+        raise ValueError(f"{key} must be a number")
+    return number
+
+def parse_limit(data, maximum, default=None):
+    """ The limit parameter clamped to 1..maximum, or default when it is not given """
+    value = data.get('limit')
+    if value is None:
+        return default
+    if isinstance(value, list):
+        raise ValueError("limit may only be given once")
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        raise ValueError("limit must be an integer")
+    return max(1, min(limit, maximum))
+
+def parse_search_filters(data, require_price=True):
+    """ Validates and typecasts the /search filter parameters """
+    name = data.get('name') or ''
+    if isinstance(name, list):
+        raise ValueError("name may only be given once")
+    amenities = data.get('amenities')
+    if is_blank(amenities):
+        amenities = []
+    elif isinstance(amenities, str):
+        amenities = [amenities]
+    return {
+        'price_min': parse_number(data, 'priceMin', float, required=require_price),
+        'price_max': parse_number(data, 'priceMax', float, required=require_price),
+        'name': name,
+        'bedrooms': parse_number(data, 'bedrooms', float),
+        'people': parse_number(data, 'people', int),
+        'rating': parse_number(data, 'rating', float),
+        'amenities': [element for element in amenities if not is_blank(element)],
+    }
+
+def like_pattern(text):
+    """ Substring pattern matching text literally """
+    return '%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+class Statement:
+    """ SQL with $n placeholders, their Postgres types and the values to bind """
+
+    def __init__(self, sql, types, params):
+        self.sql = sql
+        self.types = types
+        self.params = params
+
+    @property
+    def name(self):
+        return 'search_' + hashlib.md5(f"{self.sql}|{','.join(self.types)}".encode()).hexdigest()[:16]
+
+    def prepare_sql(self):
+        types = f" ({', '.join(self.types)})" if self.types else ''
+        return f"PREPARE {self.name}{types} AS {self.sql}"
+
+    def execute_sql(self):
+        if not self.params:
+            return f"EXECUTE {self.name}", None
+        return f"EXECUTE {self.name} ({', '.join(['%s'] * len(self.params))})", list(self.params)
+
+    def inline_sql(self):
+        """ The statement with %s placeholders, for cursors that cannot run EXECUTE (e.g. named cursors) """
+        return re.sub(r'\$(\d+)', lambda match: f"%s::{self.types[int(match.group(1)) - 1]}", self.sql), list(self.params)
+
+
+class StatementBuilder:
+    def __init__(self):
+        self.types = []
+        self.params = []
+
+    def param(self, value, type_name):
+        self.params.append(value)
+        self.types.append(type_name)
+        return f"${len(self.params)}"
+
+    def statement(self, sql):
+        return Statement(sql, self.types, self.params)
+
+def search_conditions(builder, filters):
+    """ The filter predicates shared by searches, counts and facets """
+    conditions = []
+    if filters['price_min'] is not None:
+        conditions.append(f"price >= {builder.param(filters['price_min'], 'float8')}")
+    if filters['price_max'] is not None:
+        conditions.append(f"price <= {builder.param(filters['price_max'], 'float8')}")
+    # ILIKE on name is served by the trigram index; an empty name filters nothing
+    if filters['name']:
+        conditions.append(f"name ILIKE {builder.param(like_pattern(filters['name']), 'text')}")
+    if filters['bedrooms'] is not None:
+        conditions.append(f"beds = {builder.param(filters['bedrooms'], 'float8')}")
+    if filters['people'] is not None:
+        conditions.append(f"accommodates = {builder.param(filters['people'], 'int4')}")
+    if filters['rating'] is not None:
+        conditions.append(f"review_scores_rating >= {builder.param(filters['rating'], 'float8')}")
+
+    # Vocabulary terms are answered by the GIN index on amenity_tags in a single containment check
+    tagged = [element for element in filters['amenities'] if element in AMENITY_VOCABULARY]
+    if tagged:
+        conditions.append(f"amenity_tags @> {builder.param(tagged, 'text[]')}")
+    untagged = [like_pattern(element) for element in filters['amenities'] if element not in AMENITY_VOCABULARY]
+    if untagged:
+        conditions.append(f"amenities LIKE ALL ({builder.param(untagged, 'text[]')})")
+    return conditions
+
+def where_sql(conditions):
+    return f" WHERE {' AND '.join(conditions)}" if conditions else ''
+
+def search_where(builder, filters):
+    """ Builds the WHERE clause shared by single- and cross-city searches """
+    return where_sql(search_conditions(builder, filters))
+
+def search_statement(city_schema, filters, columns, order_by=None, limit=None, after=None):
+    """ Matching listings, optionally ordered, resumed after a (price, id) keyset cursor and limited """
+    builder = StatementBuilder()
+    conditions = search_conditions(builder, filters)
+    if after is not None:
+        conditions.append(f"(price, id) > ({builder.param(after[0], 'float8')}, {builder.param(after[1], 'int8')})")
+    sql = search_select_sql(columns, city_schema) + where_sql(conditions)
+    if order_by:
+        sql += f" ORDER BY {order_by}"
+    if limit is not None:
+        sql += f" LIMIT {builder.param(limit, 'int4')}"
+    return builder.statement(sql)
+
+def listings_by_id_statement(city_schema, columns, ids):
+    """ The search projection of the given listings, for ids found by an in-memory ListingIndex """
+    builder = StatementBuilder()
+    return builder.statement(search_select_sql(columns, city_schema) + f" WHERE {city_schema}.listings.id = ANY({builder.param(ids, 'int8[]')})")
+
+def count_statement(city_schema, filters):
+    builder = StatementBuilder()
+    return builder.statement(f"SELECT COUNT(*) FROM {city_schema}.listings" + search_where(builder, filters))
+
+
+prepared_statements = weakref.WeakKeyDictionary()  # connection -> OrderedDict of prepared statement names
+prepared_lock = threading.Lock()
+
+def prepare_commands(conn, statement):
+    """ Statements to run on this connection before EXECUTE: DEALLOCATE of evicted entries and PREPARE if new """
+    with prepared_lock:
+        names = prepared_statements.setdefault(conn, OrderedDict())
+        if statement.name in names:
+            names.move_to_end(statement.name)
+            return []
+        commands = []
+        while len(names) >= PREPARED_STATEMENTS_PER_CONNECTION:
+            evicted, _ = names.popitem(last=False)
+            commands.append(f"DEALLOCATE {evicted}")
+        names[statement.name] = True
+    return commands + [statement.prepare_sql()]
+
+def forget_prepared(conn, statement):
+    with prepared_lock:
+        names = prepared_statements.get(conn)
+        if names is not None:
+            names.pop(statement.name, None)
+
+def execute_prepared(cursor, statement):
+    """ Runs a statement through its per-connection prepared statement (psycopg2 cursors) """
+    conn = cursor.connection
+    try:
+        for command in prepare_commands(conn, statement):
+            cursor.execute(command)
+    except Exception:
+        # Not prepared after all; a failed EXECUTE, on the other hand, leaves the prepared statement in place
+        forget_prepared(conn, statement)
+        raise
+    cursor.execute(*statement.execute_sql())
+
+async def execute_prepared_async(cursor, statement):
+    """ Same as execute_prepared for psycopg 3 async client cursors """
+    conn = cursor.connection
+    try:
+        for command in prepare_commands(conn, statement):
+            await cursor.execute(command)
+    except Exception:
+        forget_prepared(conn, statement)
+        raise
+    await cursor.execute(*statement.execute_sql())
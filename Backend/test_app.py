@@ -0,0 +1,258 @@
+import io
+import pytest
+import app
+from db_pool import PoolExhausted
+
+
+@pytest.fixture
+def pools(fake_pools, monkeypatch):
+    monkeypatch.setattr(app, 'db_pools', fake_pools)
+    return fake_pools
+
+
+def test_finished_stream_returns_its_connection_once(pools):
+    with app.app.test_request_context():
+        conn = pools.getconn('a')
+        conn.rows = [(1,), (2,)]
+        response = app.stream_json_rows(conn, "SELECT id FROM listings", None, lambda row: {'id': row[0]})
+        assert ''.join(response.response) == '[{"id": 1},{"id": 2}]'
+        # The pool hands the returned connection to the next request ...
+        other = pools.getconn('a')
+        assert other is conn
+        other.status = 'in another transaction'
+        rollbacks = other.rollbacks
+        # ... which closing the finished response must not take away from it
+        response.close()
+        assert pools.stats()['a']['in_use'] == 1
+        assert other.rollbacks == rollbacks
+        assert pools.getconn('a') is not conn
+
+def test_stream_closed_before_the_first_chunk_returns_its_connection(pools):
+    with app.app.test_request_context():
+        conn = pools.getconn('a')
+        response = app.stream_json_rows(conn, "SELECT id FROM listings", None, lambda row: {'id': row[0]})
+        response.close()
+        assert pools.stats()['a']['in_use'] == 0
+        assert pools.getconn('a') is conn
+
+@pytest.mark.parametrize('listing_id', ['abc', '12.7', 'inf', None])
+def test_invalid_listing_ids_are_rejected_before_routing(listing_id):
+    client = app.app.test_client()
+    query = {'city': 'Boston'} if listing_id is None else {'city': 'Boston', 'listing_id': listing_id}
+    for response in (client.get('/getReviews', query_string=query), client.get('/removeAllReviews', query_string=query),
+                     client.post('/addReview', json={**query, 'reviewer_name': 'Guest', 'comments': 'Nice'})):
+        assert response.status_code == 400
+        assert response.get_json()['success'] is False
+        assert 'Invalid listing id' in response.get_json()['message']
+
+def test_reviews_select_only_the_returned_columns(pools, monkeypatch):
+    monkeypatch.setattr(app.city_router, 'lookup', lambda city: ('a', 'boston'))
+    conn = pools.getconn('a')
+    conn.rows = [('r1', 'u1', 'Guest', 'Nice')]
+    pools.putconn(conn)
+    response = app.app.test_client().get('/getReviews', query_string={'city': 'Boston', 'listing_id': '42'})
+    assert response.get_json() == [{'id': 'r1', 'reviewer_id': 'u1', 'reviewer_name': 'Guest', 'comments': 'Nice'}]
+    sql, params = conn.executed[-1]
+    assert 'SELECT boston.reviews.id, reviewer_id, reviewer_name, comments FROM' in sql and '*' not in sql
+    assert params == (42,)
+
+@pytest.mark.parametrize('limit', ['x', '1.5', ['10', '20']])
+def test_invalid_search_limit_is_a_client_error(limit):
+    with pytest.raises(ValueError, match="^limit m"):
+        app.single_city_search_options({'limit': limit})
+
+def test_search_limit_is_clamped():
+    assert app.single_city_search_options({})[1] is None
+    assert app.single_city_search_options({'limit': '0'})[1] == 1
+    assert app.single_city_search_options({'limit': '100000'})[1] == app.SEARCH_MAX_PAGE_SIZE
+
+def test_search_rejects_a_non_integer_limit_with_400():
+    response = app.app.test_client().get('/search', query_string={'city': 'Boston', 'priceMin': 1, 'priceMax': 100, 'limit': 'x'})
+    assert response.status_code == 400
+    assert response.get_json() == {'success': False, 'message': 'limit must be an integer'}
+
+def test_cross_city_limit_is_validated():
+    assert app.cross_city_search_options({})[1] == app.SEARCH_MAX_PAGE_SIZE
+    with pytest.raises(ValueError, match="limit must be an integer"):
+        app.cross_city_search_options({'limit': 'x'})
+
+def test_rating_added_for_the_merge_is_not_returned():
+    columns, limit, _, sort_key, merge_only = app.cross_city_search_options({'fields': 'id,name', 'sort': 'rating', 'limit': '2'})
+    assert 'review_scores_rating' in columns and merge_only == ['review_scores_rating']
+    per_city = [[{'id': '1', 'name': 'a', 'price': 10.0, 'review_scores_rating': 4.9}, {'id': '3', 'name': 'c', 'price': 10.0, 'review_scores_rating': 4.1}],
+                [{'id': '2', 'name': 'b', 'price': 10.0, 'review_scores_rating': 4.5}]]
+    merged = app.merge_city_results(per_city, sort_key, limit, ['Boston', 'Austin'], {}, merge_only)
+    assert merged['results'] == [{'id': '1', 'name': 'a', 'price': 10.0}, {'id': '2', 'name': 'b', 'price': 10.0}]
+
+def test_requested_rating_is_kept():
+    columns, _, _, _, merge_only = app.cross_city_search_options({'fields': 'id,review_scores_rating', 'sort': 'rating'})
+    assert 'review_scores_rating' in columns and merge_only == []
+    assert app.cross_city_search_options({'fields': 'id'})[4] == []
+
+def upload(rows):
+    body = 'City,Listing_id,Comment\n' + ''.join(f"{city},{listing_id},{comment}\n" for city, listing_id, comment in rows)
+    response = app.app.test_client().post('/upload_csv', data={'file': (io.BytesIO(body.encode()), 'reviews.csv')}, content_type='multipart/form-data')
+    return response.get_json()
+
+@pytest.fixture
+def inserted(pools, monkeypatch):
+    """ Lines inserted per batch, in place of insert_review_batch """
+    batches = []
+
+    def insert_review_batch(conn, city, batch, report):
+        batches.append((city, [line for line, _, _ in batch]))
+        report['accepted'] += len(batch)
+
+    monkeypatch.setattr(app, 'insert_review_batch', insert_review_batch)
+    return batches
+
+def test_upload_rejects_cities_only_on_a_routing_miss(inserted, monkeypatch):
+    failures = [Exception("could not connect to the cities database")]
+
+    def lookup(city):
+        if city == 'Nowhere':
+            return None
+        if failures:
+            raise failures.pop()
+        return ('a', 'boston')
+
+    monkeypatch.setattr(app.city_router, 'lookup', lookup)
+    report = upload([('Boston', 1, 'first'), ('Boston', 1, 'second'), ('Nowhere', 1, 'x'), ('Boston', 2, 'third'), ('Nowhere', 2, 'y')])
+    assert inserted == [('Boston', [3, 5])]
+    assert report['accepted'] == 2 and report['rejected'] == 3
+    assert [(error['line'], error['error']) for error in report['errors']] == [
+        (2, "could not connect to the cities database"),
+        (4, "No database entry found for city: Nowhere"),
+        (6, "No database entry found for city: Nowhere"),
+    ]
+
+def test_upload_checkout_failure_rejects_only_its_batch(inserted, monkeypatch):
+    monkeypatch.setattr(app.city_router, 'lookup', lambda city: ('a', 'boston'))
+    monkeypatch.setattr(app, 'UPLOAD_BATCH_SIZE', 2)
+    checkout = app.find_db_connection_from_city
+    failures = [PoolExhausted("No free connection to a after 10s")]
+
+    def find_db_connection_from_city(city):
+        if failures:
+            raise failures.pop()
+        return checkout(city)
+
+    monkeypatch.setattr(app, 'find_db_connection_from_city', find_db_connection_from_city)
+    report = upload([('Boston', 1, 'a'), ('Boston', 1, 'b'), ('Boston', 1, 'c'), ('Boston', 1, 'd'), ('Boston', 1, 'e')])
+    assert inserted == [('Boston', [4, 5]), ('Boston', [6])]
+    assert report['accepted'] == 3 and report['rejected'] == 2
+    assert {error['line'] for error in report['errors']} == {2, 3}
+
+def test_insert_into_a_known_city_checks_out_only_its_shard(pools, monkeypatch):
+    monkeypatch.setattr(app.city_router, 'lookup', lambda city: ('b', 'boston'))
+    checkouts = []
+    monkeypatch.setattr(app, 'checkout_connection', lambda db_name: checkouts.append(db_name) or pools.getconn(db_name))
+    monkeypatch.setattr(app, 'insert_property_data', lambda data, conn, city: 42)
+    monkeypatch.setattr(app, 'add_to_listing_index', lambda city_name, conn, listing_id: None)
+    response = app.app.test_client().post('/insert', json={'city': 'Boston', 'name': 'Loft'})
+    assert response.status_code == 201
+    assert checkouts == ['b']
+
+@pytest.fixture
+def city_info(pools):
+    """ Rows the cities database returns for city_info, and the queries run against it """
+    conn = pools.getconn('cities')
+    conn.rows = [('Boston', 'b')]
+    pools.putconn(conn)
+    return conn
+
+def test_router_serves_lookups_from_memory_until_the_ttl_expires(city_info):
+    router = app.CityRouter(ttl=60, miss_reload_interval=60)
+    assert router.lookup('Boston') == ('b', 'boston')
+    assert router.lookup('Boston') == ('b', 'boston')
+    assert len(city_info.executed) == 1
+    router.ttl = -1
+    city_info.rows = [('Boston', 'b_overflow')]
+    assert router.lookup('Boston') == ('b_overflow', 'boston')
+    assert len(city_info.executed) == 2
+
+def test_router_invalidate_forces_a_reload(city_info):
+    router = app.CityRouter(ttl=60, miss_reload_interval=60)
+    assert router.city_names() == ['Boston']
+    city_info.rows = [('Boston', 'b'), ('Austin', 'a')]
+    assert router.city_names() == ['Boston']
+    router.invalidate()
+    assert router.city_names() == ['Boston', 'Austin']
+
+def test_router_reloads_on_a_miss_at_most_once_per_interval(city_info):
+    router = app.CityRouter(ttl=60, miss_reload_interval=60)
+    router.lookup('Boston')
+    city_info.rows = [('Boston', 'b'), ('Austin', 'a')]
+    assert router.lookup('Austin') is None
+    assert len(city_info.executed) == 1
+    router.miss_reload_interval = -1
+    assert router.lookup('Austin') == ('a', 'austin')
+    assert router.lookup('Nowhere') is None
+    assert len(city_info.executed) == 3
+
+@pytest.fixture
+def placement(monkeypatch):
+    """ A ShardPlacement over two known databases; created holds the overflow databases it makes """
+    existing = {'a': ['austin', 'boston'], 'b': []}
+    created = []
+    monkeypatch.setattr(app, 'database_exists', lambda db_name: db_name in existing)
+    monkeypatch.setattr(app, 'get_schema_names', lambda db_name: existing[db_name])
+    monkeypatch.setattr(app, 'create_database', lambda db_name: created.append(db_name) or existing.setdefault(db_name, []))
+    placement = app.ShardPlacement(capacity=3)
+    monkeypatch.setattr(app, 'shard_placement', placement)
+    placement.seed(['a', 'b'])
+    placement.created = created
+    return placement
+
+def test_placement_counts_schemas_without_querying_again(placement, monkeypatch):
+    monkeypatch.setattr(app, 'get_schema_names', lambda db_name: pytest.fail("schemas were queried again"))
+    assert placement.stats() == {'a': 2, 'b': 0}
+    placement.record_schema('a', 'athens')
+    placement.record_schema('a', 'athens')
+    assert placement.schema_count('a') == 3
+
+def test_placement_spills_into_one_overflow_database_at_capacity(placement):
+    assert placement.place('a') == 'a'
+    placement.record_schema('a', 'athens')
+    assert placement.place('a') == 'a_overflow'
+    placement.record_schema('a_overflow', 'amsterdam')
+    assert placement.place('a') == 'a_overflow'
+    assert placement.created == ['a_overflow']
+    assert placement.stats() == {'a': 3, 'b': 0, 'a_overflow': 1}
+    assert placement.place('b') == 'b'
+
+def review_stats(conn, city_schema):
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT listing_id, review_count, total_comment_length FROM {city_schema}.listing_review_stats ORDER BY listing_id")
+        return cursor.fetchall()
+
+def stored_comments(conn, city_schema):
+    with conn.cursor() as cursor:
+        cursor.execute(f"""SELECT lr.listing_id, r.comments FROM {city_schema}.reviews r
+                           INNER JOIN {city_schema}.listings_reviews lr ON lr.review_id = r.id ORDER BY r.comments""")
+        return cursor.fetchall()
+
+def new_report():
+    return {'accepted': 0, 'rejected': 0, 'errors': [], 'errors_truncated': False}
+
+def test_upload_batch_inserts_reviews_and_their_stats_in_one_transaction(city_db):
+    conn, city_schema = city_db
+    report = new_report()
+    app.insert_review_batch(conn, city_schema, [(2, 1, 'great'), (3, 1, 'ok'), (4, 2, 'fine')], report)
+    assert report == {**new_report(), 'accepted': 3}
+    assert stored_comments(conn, city_schema) == [(2, 'fine'), (1, 'great'), (1, 'ok')]
+    assert review_stats(conn, city_schema) == [(1, 2, 7), (2, 1, 4)]
+
+def test_failed_upload_batch_falls_back_to_row_by_row_inserts(city_db):
+    conn, city_schema = city_db
+    with conn.cursor() as cursor:
+        cursor.execute(f"ALTER TABLE {city_schema}.reviews ADD CONSTRAINT no_spam CHECK (comments <> 'spam')")
+    conn.commit()
+    report = new_report()
+    app.insert_review_batch(conn, city_schema, [(2, 1, 'great'), (3, 1, 'spam'), (4, 2, 'fine')], report)
+    assert report['accepted'] == 2 and report['rejected'] == 1
+    assert [(error['line'], error['city']) for error in report['errors']] == [(3, city_schema)]
+    assert 'no_spam' in report['errors'][0]['error']
+    # Only the surviving rows are stored and counted
+    assert stored_comments(conn, city_schema) == [(2, 'fine'), (1, 'great')]
+    assert review_stats(conn, city_schema) == [(1, 1, 5), (2, 1, 4)]
@@ -0,0 +1,46 @@
+import asyncio
+import pytest
+import asgi_app
+
+
+@pytest.mark.parametrize('listing_id', ['abc', '12.7'])
+def test_invalid_listing_ids_are_rejected_before_routing(listing_id):
+    async def requests():
+        client = asgi_app.app.test_client()
+        query = {'city': 'Boston', 'listing_id': listing_id}
+        return [await client.get('/getReviews', query_string=query), await client.get('/removeAllReviews', query_string=query),
+                await client.post('/addReview', json={**query, 'reviewer_name': 'Guest', 'comments': 'Nice'})]
+
+    for response in asyncio.run(requests()):
+        assert response.status_code == 400
+        body = asyncio.run(response.get_json())
+        assert body['success'] is False and 'Invalid listing id' in body['message']
+
+def test_bulk_delete_fails_only_the_unreachable_shard(city_db, monkeypatch):
+    conn, city_schema = city_db
+    routes = {'Testville': (conn.info.dbname, city_schema), 'Downville': ('no_such_shard', 'downville')}
+
+    async def lookup(city_name):
+        return routes.get(city_name)
+
+    monkeypatch.setattr(asgi_app.city_router, 'lookup', lookup)
+    monkeypatch.setattr(asgi_app, 'ASYNC_POOL_CHECKOUT_TIMEOUT', 1)
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            INSERT INTO {city_schema}.reviews (id, comments) VALUES ('r1', 'good');
+            INSERT INTO {city_schema}.listings_reviews (listing_id, review_id) VALUES (1, 'r1');
+        """)
+    conn.commit()
+
+    async def bulk_delete():
+        try:
+            response = await asgi_app.app.test_client().post('/bulkDeleteReviews', json={'reviews': [
+                {'city': 'Testville', 'review_id': 'r1'}, {'city': 'Downville', 'review_id': 'r1'},
+            ]})
+            return response.status_code, await response.get_json()
+        finally:
+            await asgi_app.db_pools.closeall()
+
+    status, body = asyncio.run(bulk_delete())
+    assert status == 200
+    assert [result['status'] for result in body['results']] == ['deleted', 'failed']
@@ -0,0 +1,57 @@
+import csv
+from createDBs import LISTINGS_COLUMNS, REVIEWS_COLUMNS, insert_data_into_tables
+
+
+def write_city(city_path, listings, reviews):
+    """ Writes listings.csv and reviews.csv; listings are (id, name, price), reviews (id, listing_id, comments) """
+    city_path.mkdir(exist_ok=True)
+    with open(city_path / 'listings.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(LISTINGS_COLUMNS)
+        for listing_id, name, price in listings:
+            writer.writerow([listing_id, name, 'Downtown', 'Loft', 2, '1 bath', 1, '["Wifi"]', price, 4.5])
+    with open(city_path / 'reviews.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(REVIEWS_COLUMNS)
+        for review_id, listing_id, comments in reviews:
+            writer.writerow([review_id, listing_id, f"u{review_id}", 'Guest', comments])
+
+def query(conn, sql):
+    with conn.cursor() as cursor:
+        cursor.execute(sql)
+        return cursor.fetchall()
+
+def test_incremental_refresh_applies_only_the_differences(city_db, tmp_path):
+    conn, city_schema = city_db
+    city_path = tmp_path / 'City'
+    write_city(city_path, [('1.0', 'One', 10), (2, 'Two', 20), (3, 'Three', 30)],
+               [('r1', 1, 'good'), ('r2', 1, 'fine'), ('r3', 3, 'bad')])
+    stats = insert_data_into_tables(city_schema, str(city_path), conn)
+    assert (stats['inserted_listings'], stats['inserted_reviews']) == (3, 3)
+    with conn.cursor() as cursor:
+        # Added through the app, so it has no row_hash and no source row
+        cursor.execute(f"INSERT INTO {city_schema}.listings (id, name, price) VALUES (99, 'App', 50)")
+    conn.commit()
+
+    write_city(city_path, [(1, 'One', 12), (2, 'Two', 20), (4, 'Four', 40)],
+               [('r1', 2, 'good'), ('r2', 1, 'much better'), ('r4', 4, 'new')])
+    stats = insert_data_into_tables(city_schema, str(city_path), conn, incremental=True)
+    assert {key: stats[key] for key in ('inserted_listings', 'updated_listings', 'deleted_listings')} == \
+        {'inserted_listings': 1, 'updated_listings': 1, 'deleted_listings': 1}
+    assert {key: stats[key] for key in ('inserted_reviews', 'updated_reviews', 'deleted_reviews')} == \
+        {'inserted_reviews': 1, 'updated_reviews': 1, 'deleted_reviews': 1}
+
+    assert query(conn, f"SELECT id, price FROM {city_schema}.listings ORDER BY id") == [(1, 12.0), (2, 20.0), (4, 40.0), (99, 50.0)]
+    assert query(conn, f"SELECT listing_id, review_id FROM {city_schema}.listings_reviews ORDER BY review_id") == [(2, 'r1'), (1, 'r2'), (4, 'r4')]
+    # Listing 3 lost its only review and r1 moved from listing 1 to 2
+    assert query(conn, f"SELECT listing_id, review_count, total_comment_length FROM {city_schema}.listing_review_stats ORDER BY listing_id") == \
+        [(1, 1, len('much better')), (2, 1, len('good')), (4, 1, len('new'))]
+
+def test_unchanged_incremental_refresh_writes_nothing(city_db, tmp_path):
+    conn, city_schema = city_db
+    city_path = tmp_path / 'City'
+    write_city(city_path, [(1, 'One', 10), (2, 'Two', 20)], [('r1', 1, 'good')])
+    insert_data_into_tables(city_schema, str(city_path), conn)
+    stats = insert_data_into_tables(city_schema, str(city_path), conn, incremental=True)
+    assert [stats[key] for key in ('inserted_listings', 'updated_listings', 'deleted_listings',
+                                   'inserted_reviews', 'updated_reviews', 'deleted_reviews')] == [0] * 6
@@ -0,0 +1,112 @@
+import threading
+import time
+import pytest
+from psycopg2 import extensions
+from conftest import FakeConnection
+from db_pool import ConnectionPool, PoolExhausted, PoolManager
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(ConnectionPool, '_connect', lambda self: FakeConnection())
+    return ConnectionPool('a', minconn=1, maxconn=2, idle_timeout=60, health_check_interval=30, checkout_timeout=0.1)
+
+
+def test_checkout_reuses_the_most_recently_returned_connection(pool):
+    first = pool.getconn()
+    second = pool.getconn()
+    assert first is not second
+    pool.putconn(first)
+    pool.putconn(second)
+    assert pool.getconn() is second
+    assert pool.stats()['created'] == 2 and pool.stats()['checkouts'] == 3
+
+def test_checkout_times_out_when_every_connection_is_in_use(pool):
+    pool.getconn()
+    pool.getconn()
+    with pytest.raises(PoolExhausted):
+        pool.getconn(timeout=0.05)
+    assert pool.stats()['timeouts'] == 1
+
+def test_waiting_checkout_gets_a_returned_connection(pool):
+    first = pool.getconn()
+    pool.getconn()
+    threading.Timer(0.05, pool.putconn, args=(first,)).start()
+    assert pool.getconn(timeout=2) is first
+    assert pool.stats()['waits'] >= 1
+
+def test_return_rolls_back_open_transactions_and_resets_autocommit(pool):
+    conn = pool.getconn()
+    conn.status = extensions.TRANSACTION_STATUS_INTRANS
+    conn.autocommit = True
+    pool.putconn(conn)
+    assert conn.rollbacks == 1 and conn.autocommit is False
+    assert pool.stats()['in_use'] == 0 and pool.stats()['idle'] == 1
+
+def test_returning_twice_or_a_foreign_connection_is_ignored(pool):
+    conn = pool.getconn()
+    pool.putconn(conn)
+    pool.putconn(conn)
+    pool.putconn(FakeConnection())
+    assert pool.stats()['idle'] == 1
+
+def test_broken_connections_are_closed_instead_of_pooled(pool):
+    conn = pool.getconn()
+    conn.closed = 1
+    pool.putconn(conn)
+    assert pool.stats()['idle'] == 0
+    conn = pool.getconn()
+    pool.putconn(conn, close=True)
+    assert conn.closed and pool.stats()['idle'] == 0
+
+def test_idle_connections_past_the_timeout_are_evicted_down_to_minconn(pool):
+    first = pool.getconn()
+    second = pool.getconn()
+    pool.putconn(first)
+    pool.putconn(second)
+    pool.idle_timeout = 0
+    time.sleep(0.01)
+    pool.evict_idle()
+    assert pool.stats()['idle'] == 1 and pool.stats()['evicted'] == 1
+    assert first.closed and not second.closed
+
+def test_stale_idle_connections_are_health_checked(pool):
+    conn = pool.getconn()
+    pool.putconn(conn)
+    pool.health_check_interval = 0
+    conn.closed = 1  # the server went away while it sat idle
+    replacement = pool.getconn()
+    assert replacement is not conn
+    assert pool.stats()['health_check_failures'] == 1
+
+def test_failed_connect_releases_its_slot(pool, monkeypatch):
+    pool.getconn()
+
+    def connect():
+        raise OSError("connection refused")
+
+    monkeypatch.setattr(pool, '_connect', connect)
+    with pytest.raises(OSError):
+        pool.getconn()
+    monkeypatch.setattr(pool, '_connect', FakeConnection)
+    pool.getconn()
+    assert pool.stats()['in_use'] == 2
+
+def test_manager_returns_connections_to_their_own_pool(fake_pools):
+    a = fake_pools.getconn('a')
+    b = fake_pools.getconn('b')
+    fake_pools.putconn(a)
+    fake_pools.putconn(a)
+    assert fake_pools.stats()['a']['idle'] == 1 and fake_pools.stats()['b']['in_use'] == 1
+    fake_pools.putconn(b)
+    assert fake_pools.getconn('b') is b
+
+def test_manager_creates_one_pool_per_database_under_concurrency(fake_pools):
+    pools = []
+    threads = [threading.Thread(target=lambda: pools.append(fake_pools.get_pool('a'))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({id(pool) for pool in pools}) == 1
+    assert isinstance(fake_pools, PoolManager) and list(fake_pools.stats()) == ['a']
@@ -0,0 +1,78 @@
+import math
+import random
+import pytest
+from facets import FACET_PRICE_BUCKET, facet_counts, facet_statement, price_bucket_range, summary_answers
+
+
+def bucket(price):
+    """ floor(l.price / FACET_PRICE_BUCKET)::int on a float8 price """
+    return math.floor(price / FACET_PRICE_BUCKET)
+
+def edge_bounds(statement, first, last):
+    """ The price bounds of the lower and upper edge, bound right after their bucket """
+    params = iter(statement.params)
+    lower = upper = None
+    if first is not None:
+        assert next(params) == first
+        lower = next(params)
+    if last is not None:
+        assert next(params) == last
+        upper = next(params)
+    return lower, upper
+
+def test_summary_answers_only_price_bounds(filters):
+    assert summary_answers(filters())
+    assert summary_answers(filters(priceMin=10, priceMax=500))
+    for extra in ({'people': 2}, {'bedrooms': 1}, {'rating': 4.5}, {'name': 'loft'}, {'amenities': 'Wifi'}):
+        assert not summary_answers(filters(**extra))
+
+def test_price_bucket_range_only_covers_whole_buckets(filters):
+    assert price_bucket_range(filters()) == (None, None)
+    assert price_bucket_range(filters(priceMin=100, priceMax=300)) == (3, 5)
+    assert price_bucket_range(filters(priceMin=120, priceMax=349.5)) == (3, 5)
+    assert price_bucket_range(filters(priceMin=-20)) == (0, None)
+
+def test_facet_statement_sources(filters):
+    assert facet_statement('boston', filters())[1] == 'summary'
+    assert facet_statement('boston', filters(priceMin=100, priceMax=300))[1] == 'summary'
+    # Narrower than a bucket: nothing for the summary to answer
+    assert facet_statement('boston', filters(priceMin=101, priceMax=149))[1] == 'listings'
+    assert facet_statement('boston', filters(priceMin=100, priceMax=300, people=2))[1] == 'listings'
+
+def test_facet_statement_unfiltered_reads_only_the_summary(filters):
+    statement, _ = facet_statement('boston', filters())
+    assert 'boston.listings' not in statement.sql
+    assert statement.params == []
+
+@pytest.mark.parametrize('price_min, price_max', [(100, 300), (99.99, 300), (120.5, 349.5), (None, 275), (62, None), (-75, 60)])
+def test_edge_split_partitions_matching_listings(price_min, price_max, filters):
+    """ Every listing inside the bounds is counted exactly once: from a whole summary bucket or from one edge """
+    data = {key: value for key, value in (('priceMin', price_min), ('priceMax', price_max)) if value is not None}
+    search = filters(**data)
+    first, last = price_bucket_range(search)
+    statement, source = facet_statement('boston', search)
+    assert source == 'summary'
+    lower, upper = edge_bounds(statement, first, last)
+
+    rng = random.Random(1090)
+    prices = [round(rng.uniform(-100, 500), 2) for _ in range(5000)]
+    prices += [price_min or 0, price_max or 0, 100, 150, 299.99, 300, 349.99]
+    for price in prices:
+        matches = (price_min is None or price >= price_min) and (price_max is None or price <= price_max)
+        in_summary = (first is None or bucket(price) >= first) and (last is None or bucket(price) <= last)
+        in_lower = first is not None and matches and price < lower and bucket(price) < first
+        in_upper = last is not None and matches and price > upper and bucket(price) > last
+        assert not in_summary or matches, price
+        assert in_summary + in_lower + in_upper == matches, price
+
+def test_facet_counts_builds_the_response():
+    rows = [('total', '', 7), ('property_type', 'Entire home', 4), ('property_type', '', 3), ('neighbourhood', 'Harbour', 7),
+            ('amenity', 'Wifi', 5), ('amenity', 'not a term', 2), ('price_bucket', '2', 3), ('price_bucket', '-1', 1)]
+    facets = facet_counts(rows, 'summary')
+    assert facets['total'] == 7
+    assert facets['property_types'] == {'Entire home': 4}
+    assert facets['neighbourhoods'] == {'Harbour': 7}
+    assert facets['amenities'] == {'Wifi': 5}
+    assert facets['price_histogram'] == [{'min': -FACET_PRICE_BUCKET, 'max': 0, 'count': 1},
+                                         {'min': 2 * FACET_PRICE_BUCKET, 'max': 3 * FACET_PRICE_BUCKET, 'count': 3}]
+    assert facets['source'] == 'summary'
@@ -0,0 +1,113 @@
+import threading
+import numpy as np
+import pytest
+from listing_index import ListingIndex, ListingIndexes
+
+# Rows of INDEX_COLUMNS: id, price, rating, accommodates, beds, property_type, neighbourhood, amenity_tags, name
+ROWS = [
+    (5, 120.0, 4.8, 2, 1.0, 'Entire home', 'Harbour', ['Wifi', 'Kitchen'], 'Cozy LOFT by the sea'),
+    (3, 80.0, None, None, None, None, None, None, None),
+    (9, None, 4.2, 4, 2.0, 'Private room in home', 'Old Town', ['Wifi'], '50%_off studio'),
+    (2, 120.0, 3.9, 2, 1.0, 'Entire home', 'Old Town', [], 'Garden loft'),
+    (7, 200.0, 4.9, 6, 3.0, 'Entire loft', 'Harbour', ['Kitchen'], 'Bright suite'),
+]
+
+@pytest.fixture
+def search(filters):
+    def run(index, limit=None, after=None, **data):
+        return index.search(filters(**data), limit=limit, after=after)
+    return run
+
+
+def test_sorted_by_price_then_id_with_null_prices_last(search):
+    index = ListingIndex.from_rows(ROWS)
+    assert search(index) == ([3, 2, 5, 7, 9], 5)
+
+def test_null_columns_never_match_a_filter(search):
+    index = ListingIndex.from_rows(ROWS)
+    assert search(index, priceMin=0) == ([3, 2, 5, 7], 4)
+    assert search(index, rating=0) == ([2, 5, 7, 9], 4)
+    assert search(index, people=2) == ([2, 5], 2)
+    # No sentinel value stands in for NULL
+    assert search(index, people=-1) == ([], 0)
+    assert search(index, bedrooms=-1) == ([], 0)
+
+def test_amenities_must_all_be_present(filters, search):
+    index = ListingIndex.from_rows(ROWS)
+    assert search(index, amenities='Wifi') == ([5, 9], 2)
+    assert index.search({**filters(), 'amenities': ['Wifi', 'Kitchen']}) == ([5], 1)
+
+def test_name_matches_substrings_case_insensitively_like_ilike(search):
+    index = ListingIndex.from_rows(ROWS)
+    assert search(index, name='loft') == ([2, 5], 2)
+    # % and _ are literal, as like_pattern escapes them
+    assert search(index, name='50%_') == ([9], 1)
+    assert search(index, name='0%') == ([9], 1)
+    assert search(index, name='g_rden') == ([], 0)
+
+def test_keyset_pages_follow_price_and_id(search):
+    index = ListingIndex.from_rows(ROWS)
+    assert search(index, limit=2, priceMin=0) == ([3, 2], 4)
+    # Ties on price continue by id, and the total ignores the cursor
+    assert search(index, limit=2, after=(120.0, 2), priceMin=0) == ([5, 7], 4)
+    assert search(index, limit=2, after=(200.0, 7), priceMin=0) == ([], 4)
+
+def test_add_returns_a_new_index(filters, search):
+    index = ListingIndex.from_rows(ROWS)
+    added = index.add((4, 100.0, 4.0, None, None, 'Entire home', 'Riverside', ['Wifi'], 'New place'))
+    assert search(index) == ([3, 2, 5, 7, 9], 5)
+    assert search(added) == ([3, 4, 2, 5, 7, 9], 6)
+    assert search(added, people=-1) == ([], 0)
+    assert added.facets(filters())['neighbourhoods'] == {'Harbour': 2, 'Old Town': 2, 'Riverside': 1}
+
+def test_facets_count_matching_listings(filters):
+    facets = ListingIndex.from_rows(ROWS).facets(filters(priceMax=150))
+    assert facets['total'] == 3
+    assert facets['property_types'] == {'Entire home': 2}
+    assert facets['amenities'] == {'Wifi': 1, 'Kitchen': 1}
+    assert facets['price_histogram'] == [{'min': 50, 'max': 100, 'count': 1}, {'min': 100, 'max': 150, 'count': 2}]
+
+def test_listing_added_during_a_load_survives_the_swap(search):
+    indexes = None
+
+    def load_rows(city_schema):
+        # The insert commits after the rows were read
+        indexes.add_listing(city_schema, (1, 10.0, None, None, None, None, None, None, 'Late'))
+        return ROWS
+
+    indexes = ListingIndexes(['boston'], load_rows)
+    assert search(indexes.get('boston')) == ([1, 3, 2, 5, 7, 9], 6)
+    assert indexes.get('cambridge') is None
+
+def test_concurrent_first_requests_load_the_city_once(search):
+    loading = threading.Event()
+    release = threading.Event()
+    loads = []
+
+    def load_rows(city):
+        loads.append(city)
+        loading.set()
+        release.wait(5)
+        return ROWS
+
+    indexes = ListingIndexes(['Boston'], load_rows)
+    first = threading.Thread(target=indexes.get, args=('Boston',))
+    first.start()
+    assert loading.wait(5)
+    # Served from Postgres while the first request builds the index
+    assert indexes.get('Boston') is None
+    release.set()
+    first.join(5)
+    assert loads == ['Boston']
+    assert search(indexes.get('Boston')) == ([3, 2, 5, 7, 9], 5)
+
+def test_interned_codes_widen_past_uint16():
+    names = [f"Neighbourhood {number}" for number in range(70000)]
+    rows = [(number, 10.0, None, None, None, None, name, None, None) for number, name in enumerate(names[:65535])]
+    index = ListingIndex.from_rows(rows)
+    assert index.neighbourhoods.dtype == np.uint16
+    for number in range(65535, 65538):
+        index = index.add((number, 10.0, None, None, None, None, names[number], None, None))
+    assert index.neighbourhoods.dtype == np.uint32
+    assert index.neighbourhood_values.values[index.neighbourhoods[-1]] == names[65537]
+    assert ListingIndex.from_rows([(number, 10.0, None, None, None, None, name, None, None) for number, name in enumerate(names)]).neighbourhoods.dtype == np.uint32
@@ -0,0 +1,40 @@
+import pytest
+from metrics import explain, normalize_sql
+
+
+@pytest.mark.parametrize('sql, expected', [
+    ("SELECT * FROM boston.listings WHERE id = 42", "SELECT * FROM boston.listings WHERE id = ?"),
+    ("SELECT 1.5,  'it''s'\n  FROM t", "SELECT ?, ? FROM t"),
+    ("SELECT * FROM t WHERE name ILIKE '%loft%' AND price <= 99.99", "SELECT * FROM t WHERE name ILIKE ? AND price <= ?"),
+    # Digits inside identifiers are part of the shape
+    ("SELECT col1 FROM search_1a2b LIMIT $3", "SELECT col1 FROM search_1a2b LIMIT $?"),
+])
+def test_normalize_sql_groups_statements_by_shape(sql, expected):
+    assert normalize_sql(sql) == expected
+
+def test_explain_returns_the_plan_without_running_the_statement(city_db):
+    conn, city_schema = city_db
+    plan = explain(conn, f"DELETE FROM {city_schema}.listings WHERE id = %s", (1,))
+    assert plan and any('Delete on' in line for line in plan)
+    with conn.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {city_schema}.listings (id) VALUES (1)")
+        explain(conn, f"DELETE FROM {city_schema}.listings WHERE id = %s", (1,))
+        cursor.execute(f"SELECT COUNT(*) FROM {city_schema}.listings")
+        assert cursor.fetchone()[0] == 1
+
+@pytest.mark.parametrize('sql', ["VACUUM listings", "SELECT 1; DROP TABLE listings", "", "  "])
+def test_explain_skips_statements_it_cannot_explain(city_db, sql):
+    conn, _ = city_db
+    assert explain(conn, sql, None) is None
+
+def test_failed_explain_keeps_the_transaction_usable(city_db):
+    conn, city_schema = city_db
+    with conn.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {city_schema}.listings (id) VALUES (1)")
+        assert explain(conn, "SELECT * FROM no_such_table", None) is None
+        cursor.execute(f"SELECT COUNT(*) FROM {city_schema}.listings")
+        assert cursor.fetchone()[0] == 1
+    conn.rollback()
+    conn.autocommit = True
+    assert explain(conn, "SELECT * FROM no_such_table", None) is None
+    assert explain(conn, "SELECT 1", None)
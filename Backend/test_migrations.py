@@ -0,0 +1,25 @@
+import pytest
+from migrations import BIGINT_MAX, BIGINT_MIN, parse_listing_id
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('123', 123),
+    ('123.0', 123),
+    (' 42 ', 42),
+    (7, 7),
+    (1.0e3, 1000),
+    ('1.2e3', 1200),
+    ('987654321098765432', 987654321098765432),
+    (str(BIGINT_MAX), BIGINT_MAX),
+    (str(BIGINT_MIN), BIGINT_MIN),
+])
+def test_parses_integral_ids(value, expected):
+    assert parse_listing_id(value) == expected
+
+@pytest.mark.parametrize('value', [
+    '', 'abc', None, '12.7', 12.5, 'inf', '-Infinity', 'nan', float('nan'), float('inf'),
+    str(BIGINT_MAX + 1), str(BIGINT_MIN - 1), '1e30',
+])
+def test_rejects_invalid_ids(value):
+    with pytest.raises(ValueError, match="Invalid listing id"):
+        parse_listing_id(value)
@@ -0,0 +1,90 @@
+import pytest
+import app
+from moderation import (DELETE_REVIEWS, MODERATION_MAX_ITEMS, REMOVE_LISTING_REVIEWS, UPDATE_REVIEWS, deleted_review_results,
+                        moderation_summary, removed_listing_results, updated_review_results)
+
+
+def test_deleted_reviews_report_each_item_and_the_listings_to_recompute():
+    results, listing_ids = deleted_review_results([(0, 'r1'), (2, 'r9'), (3, 'r2')], [('r1', 1), ('r1', 2), ('r2', None)])
+    assert results == {0: {'status': 'deleted'}, 2: {'status': 'not_found'}, 3: {'status': 'deleted'}}
+    assert listing_ids == {1, 2}
+
+def test_updated_reviews_report_each_item_including_repeats():
+    results, listing_ids = updated_review_results([(0, ('r1', 'a')), (1, ('r9', 'b')), (2, ('r1', 'c'))], [('r1', 5)])
+    assert results == {0: {'status': 'updated'}, 1: {'status': 'not_found'}, 2: {'status': 'updated'}}
+    assert listing_ids == {5}
+
+def test_removed_listings_report_their_deleted_review_counts():
+    results, listing_ids = removed_listing_results([(0, 1), (1, 2)], [(1, 3)])
+    assert results == {0: {'status': 'removed', 'reviews_deleted': 3}, 1: {'status': 'removed', 'reviews_deleted': 0}}
+    assert listing_ids == set()
+
+@pytest.mark.parametrize('data', [None, {}, {'reviews': []}, {'reviews': 'r1'}, {'reviews': [{}] * (MODERATION_MAX_ITEMS + 1)}])
+def test_bulk_requests_need_a_bounded_list_of_items(data):
+    with pytest.raises(ValueError, match="reviews"):
+        DELETE_REVIEWS.items(data)
+
+def test_results_echo_the_item_identity():
+    assert REMOVE_LISTING_REVIEWS.result({'city': 'Boston', 'listing_id': '7', 'extra': 1}, {'status': 'removed'}) == \
+        {'city': 'Boston', 'listing_id': '7', 'status': 'removed'}
+    assert UPDATE_REVIEWS.result('not an item', {'status': 'failed'}) == {'status': 'failed'}
+    assert moderation_summary([{'status': 'deleted'}, {'status': 'failed'}, {'status': 'deleted'}])['counts'] == {'deleted': 2, 'failed': 1}
+
+@pytest.fixture
+def moderated_city(city_db, monkeypatch):
+    """ Routes Testville to the city_db schema and Downville to a shard that cannot be reached """
+    conn, city_schema = city_db
+    routes = {'Testville': (conn.info.dbname, city_schema), 'Downville': ('no_such_shard', 'downville')}
+    monkeypatch.setattr(app.city_router, 'lookup', routes.get)
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            INSERT INTO {city_schema}.reviews (id, comments) VALUES ('r1', 'good'), ('r2', 'bad'), ('r3', 'fine');
+            INSERT INTO {city_schema}.listings_reviews (listing_id, review_id) VALUES (1, 'r1'), (1, 'r2'), (2, 'r3');
+            INSERT INTO {city_schema}.listing_review_stats VALUES (1, 2, 'r2', 7), (2, 1, 'r3', 4);
+        """)
+    conn.commit()
+    return conn, city_schema
+
+def review_stats(conn, city_schema):
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT listing_id, review_count, total_comment_length FROM {city_schema}.listing_review_stats ORDER BY listing_id")
+        stats = cursor.fetchall()
+    conn.commit()
+    return stats
+
+def test_bulk_delete_reports_per_item_results_and_fails_only_the_unreachable_shard(moderated_city):
+    conn, city_schema = moderated_city
+    response = app.app.test_client().post('/bulkDeleteReviews', json={'reviews': [
+        {'city': 'Testville', 'review_id': 'r2'},
+        {'city': 'Testville', 'review_id': 'r404'},
+        {'city': 'Nowhere', 'review_id': 'r1'},
+        {'city': 'Downville', 'review_id': 'r1'},
+        {'city': 'Testville'},
+    ]})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert [(result['city'], result['review_id'], result['status']) for result in body['results']] == [
+        ('Testville', 'r2', 'deleted'), ('Testville', 'r404', 'not_found'), ('Nowhere', 'r1', 'failed'),
+        ('Downville', 'r1', 'failed'), ('Testville', None, 'failed'),
+    ]
+    assert body['results'][2]['message'] == "No database entry found for city: Nowhere"
+    assert 'no_such_shard' in body['results'][3]['message']
+    assert body['counts'] == {'deleted': 1, 'not_found': 1, 'failed': 3}
+    assert review_stats(conn, city_schema) == [(1, 1, 4), (2, 1, 4)]
+
+def test_bulk_update_and_remove_keep_the_review_stats_in_step(moderated_city):
+    conn, city_schema = moderated_city
+    client = app.app.test_client()
+    response = client.post('/bulkUpdateReviews', json={'reviews': [
+        {'city': 'Testville', 'review_id': 'r1', 'comments': 'excellent'},
+        {'city': 'Testville', 'review_id': 'r3'},
+    ]})
+    assert [result['status'] for result in response.get_json()['results']] == ['updated', 'failed']
+    assert review_stats(conn, city_schema) == [(1, 2, 12), (2, 1, 4)]
+
+    response = client.post('/bulkRemoveReviews', json={'listings': [
+        {'city': 'Testville', 'listing_id': 1}, {'city': 'Testville', 'listing_id': '3'}, {'city': 'Testville', 'listing_id': 'x'},
+    ]})
+    assert [(result['status'], result.get('reviews_deleted')) for result in response.get_json()['results']] == \
+        [('removed', 2), ('removed', 0), ('failed', None)]
+    assert review_stats(conn, city_schema) == [(2, 1, 4)]
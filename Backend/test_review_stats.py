@@ -0,0 +1,53 @@
+from review_stats import rebuild_review_stats, recompute_review_stats, record_added_reviews
+
+
+def add_reviews(cursor, city_schema, reviews):
+    """ Stores (listing_id, review_id, comment) rows without touching the aggregates """
+    for listing_id, review_id, comment in reviews:
+        cursor.execute(f"INSERT INTO {city_schema}.reviews (id, comments) VALUES (%s, %s)", (review_id, comment))
+        cursor.execute(f"INSERT INTO {city_schema}.listings_reviews (listing_id, review_id) VALUES (%s, %s)", (listing_id, review_id))
+
+def stats(cursor, city_schema):
+    cursor.execute(f"SELECT * FROM {city_schema}.listing_review_stats ORDER BY listing_id")
+    return cursor.fetchall()
+
+def rebuilt_stats(cursor, city_schema):
+    """ The aggregates recomputed from scratch, leaving the table as it was """
+    cursor.execute("SAVEPOINT rebuilt")
+    rebuild_review_stats(cursor, city_schema)
+    rebuilt = stats(cursor, city_schema)
+    cursor.execute("ROLLBACK TO SAVEPOINT rebuilt")
+    return rebuilt
+
+def test_recorded_additions_match_a_full_rebuild(city_db):
+    conn, city_schema = city_db
+    with conn.cursor() as cursor:
+        add_reviews(cursor, city_schema, [(1, 'r1', 'good'), (1, 'r2', None), (2, 'r3', 'fine')])
+        rebuild_review_stats(cursor, city_schema)
+        added = [(1, 'r4', 'much better'), (3, 'r5', ''), (3, 'r6', 'late')]
+        add_reviews(cursor, city_schema, added)
+        record_added_reviews(cursor, city_schema, added)
+        assert stats(cursor, city_schema) == rebuilt_stats(cursor, city_schema)
+        assert stats(cursor, city_schema) == [(1, 3, 'r4', 15), (2, 1, 'r3', 4), (3, 2, 'r6', 4)]
+
+def test_recompute_after_removals_matches_a_full_rebuild(city_db):
+    conn, city_schema = city_db
+    with conn.cursor() as cursor:
+        add_reviews(cursor, city_schema, [(1, 'r1', 'good'), (1, 'r2', 'bad'), (2, 'r3', 'fine'), (3, 'r4', 'ok')])
+        rebuild_review_stats(cursor, city_schema)
+        cursor.execute(f"DELETE FROM {city_schema}.listings_reviews WHERE review_id IN ('r2', 'r3')")
+        cursor.execute(f"UPDATE {city_schema}.reviews SET comments = 'okay' WHERE id = 'r4'")
+        recompute_review_stats(cursor, city_schema, [1, 2, 3])
+        assert stats(cursor, city_schema) == rebuilt_stats(cursor, city_schema)
+        # Listing 2 has no reviews left, so it has no aggregate row
+        assert stats(cursor, city_schema) == [(1, 1, 'r1', 4), (3, 1, 'r4', 4)]
+
+def test_recompute_leaves_other_listings_alone(city_db):
+    conn, city_schema = city_db
+    with conn.cursor() as cursor:
+        add_reviews(cursor, city_schema, [(1, 'r1', 'good'), (2, 'r2', 'fine')])
+        rebuild_review_stats(cursor, city_schema)
+        cursor.execute(f"UPDATE {city_schema}.reviews SET comments = 'longer comment'")
+        recompute_review_stats(cursor, city_schema, [1])
+        recompute_review_stats(cursor, city_schema, [])
+        assert stats(cursor, city_schema) == [(1, 1, 'r1', 14), (2, 1, 'r2', 4)]
@@ -0,0 +1,56 @@
+from search_cache import SearchCache
+
+PARAMS = (('priceMin', ('10',)), ('priceMax', ('500',)))
+
+
+def test_hit_after_put():
+    cache = SearchCache()
+    key = cache.make_key(PARAMS, ['boston'])
+    assert cache.get(key) is None
+    cache.put(key, b'[]')
+    assert cache.get(key) == b'[]'
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+def test_invalidation_drops_entries_of_that_city_only():
+    cache = SearchCache()
+    boston = cache.make_key(PARAMS, ['boston'])
+    both = cache.make_key(PARAMS, ['boston', 'seattle'])
+    seattle = cache.make_key(PARAMS, ['seattle'])
+    for key in (boston, both, seattle):
+        cache.put(key, b'[]')
+    cache.invalidate_city('boston')
+    assert cache.get(boston) is None and cache.get(both) is None
+    assert cache.get(seattle) == b'[]'
+    # Keys made after the write carry the new generation
+    assert cache.make_key(PARAMS, ['boston']) != boston
+
+def test_response_built_across_a_write_is_not_stored():
+    cache = SearchCache()
+    key = cache.make_key(PARAMS, ['boston'])
+    cache.invalidate_city('boston')  # a write commits while the search runs
+    cache.put(key, b'stale')
+    assert cache.get(key) is None
+    assert cache.stats()['entries'] == 0
+
+def test_key_ignores_city_order_and_duplicates():
+    cache = SearchCache()
+    assert cache.make_key(PARAMS, ['seattle', 'boston', 'boston']) == cache.make_key(PARAMS, ['boston', 'seattle'])
+
+def test_size_bound_evicts_least_recently_used():
+    cache = SearchCache(max_bytes=10)
+    first = cache.make_key(PARAMS, ['boston'])
+    second = cache.make_key(PARAMS, ['seattle'])
+    cache.put(first, b'12345')
+    cache.put(second, b'12345')
+    cache.get(first)
+    cache.put(cache.make_key(PARAMS, ['austin']), b'12345')
+    assert cache.get(second) is None
+    assert cache.get(first) == b'12345'
+    assert cache.stats()['bytes'] == 10
+
+def test_expired_entries_are_misses():
+    cache = SearchCache(ttl=-1)
+    key = cache.make_key(PARAMS, ['boston'])
+    cache.put(key, b'[]')
+    assert cache.get(key) is None
+    assert cache.stats()['expirations'] == 1
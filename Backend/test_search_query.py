@@ -0,0 +1,87 @@
+import re
+import pytest
+import search_query
+from search_query import StatementBuilder, count_statement, execute_prepared, search_statement
+from conftest import FakeConnection
+
+
+def placeholders(sql):
+    return [int(number) for number in re.findall(r'\$(\d+)', sql)]
+
+def test_placeholders_are_numbered_in_bind_order(filters):
+    statement = search_statement('boston', filters(priceMin=10, priceMax=100, name='loft', people=2, amenities='Wifi'),
+                                 ['id', 'price'], order_by='price, id', limit=20, after=(55.0, 7))
+    assert placeholders(statement.sql) == list(range(1, 9))
+    assert statement.params == [10.0, 100.0, '%loft%', 2, ['Wifi'], 55.0, 7, 20]
+    assert statement.types == ['float8', 'float8', 'text', 'int4', 'text[]', 'float8', 'int8', 'int4']
+
+def test_the_shape_depends_on_which_filters_are_present_not_their_values(filters):
+    cheap = count_statement('boston', filters(priceMin=1, priceMax=50))
+    dear = count_statement('boston', filters(priceMin=100, priceMax=900))
+    assert cheap.sql == dear.sql and cheap.name == dear.name
+    assert count_statement('boston', filters(priceMin=1)).name != cheap.name
+    assert count_statement('austin', filters(priceMin=1, priceMax=50)).name != cheap.name
+
+def test_inline_sql_replaces_every_placeholder_with_its_type():
+    builder = StatementBuilder()
+    sql = ' AND '.join(f"c{index} = {builder.param(index, 'int4' if index < 10 else 'text')}" for index in range(1, 12))
+    inline, params = builder.statement(sql).inline_sql()
+    assert inline.endswith("c9 = %s::int4 AND c10 = %s::text AND c11 = %s::text")
+    assert '$' not in inline and params == list(range(1, 12))
+
+def test_execute_binds_the_params_in_order():
+    builder = StatementBuilder()
+    statement = builder.statement(f"SELECT {builder.param(1, 'int4')}, {builder.param('a', 'text')}")
+    assert statement.prepare_sql() == f"PREPARE {statement.name} (int4, text) AS SELECT $1, $2"
+    assert statement.execute_sql() == (f"EXECUTE {statement.name} (%s, %s)", [1, 'a'])
+    plain = StatementBuilder().statement("SELECT 1")
+    assert plain.prepare_sql() == f"PREPARE {plain.name} AS SELECT 1"
+    assert plain.execute_sql() == (f"EXECUTE {plain.name}", None)
+
+def statement(number):
+    return StatementBuilder().statement(f"SELECT {number}")
+
+def commands(conn):
+    return [sql.split(' (')[0] for sql, _ in conn.executed]
+
+def test_statements_are_prepared_once_per_connection_and_evicted_least_recently_used(monkeypatch):
+    monkeypatch.setattr(search_query, 'PREPARED_STATEMENTS_PER_CONNECTION', 2)
+    conn, other = FakeConnection(), FakeConnection()
+    one, two, three = statement(1), statement(2), statement(3)
+    for executed in (one, two, one, three, two):
+        execute_prepared(conn.cursor(), executed)
+    assert commands(conn) == [
+        one.prepare_sql(), f"EXECUTE {one.name}",
+        two.prepare_sql(), f"EXECUTE {two.name}",
+        f"EXECUTE {one.name}",
+        f"DEALLOCATE {two.name}", three.prepare_sql(), f"EXECUTE {three.name}",
+        f"DEALLOCATE {one.name}", two.prepare_sql(), f"EXECUTE {two.name}",
+    ]
+    execute_prepared(other.cursor(), one)
+    assert commands(other) == [one.prepare_sql(), f"EXECUTE {one.name}"]
+
+def test_a_failed_prepare_is_retried_on_the_next_execute():
+    conn = FakeConnection()
+    cursor = conn.cursor()
+    failing = statement(4)
+
+    def execute(sql, params=None):
+        raise RuntimeError("server closed the connection")
+
+    cursor.execute = execute
+    with pytest.raises(RuntimeError):
+        execute_prepared(cursor, failing)
+    execute_prepared(conn.cursor(), failing)
+    assert commands(conn) == [failing.prepare_sql(), f"EXECUTE {failing.name}"]
+
+def test_prepared_search_runs_on_postgres(city_db, filters):
+    conn, city_schema = city_db
+    with conn.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {city_schema}.listings (id, name, price, amenity_tags) VALUES (1, 'Sunny Loft', 80, '{{Wifi}}'), (2, 'Loft', 300, '{{}}')")
+        search = search_statement(city_schema, filters(priceMin=10, priceMax=100, name='loft', amenities='Wifi'), ['id', 'price'],
+                                  order_by='price, id', limit=5)
+        for _ in range(2):
+            execute_prepared(cursor, search)
+            assert cursor.fetchall() == [(1, 80.0)]
+        cursor.execute("SELECT COUNT(*) FROM pg_prepared_statements WHERE name = %s", (search.name,))
+        assert cursor.fetchone()[0] == 1